@@ -18,16 +18,22 @@ class BillingTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
         cls.client1 = ClientFactory()
-        cls.billed_orders = OrderFactory.create_batch(
-            10,
-            delivery_date=datetime.datetime.today(),
-            client=cls.client1, status="D", )
-        cls.orders = OrderFactory.create_batch(
-            10,
-            delivery_date=datetime.datetime.today(),
-            client=ClientFactory(),
-            status="O",
-        )
+        # A client has at most one active order per day: the orders are
+        # on the first ten days of the month.
+        today = datetime.datetime.today()
+        cls.billed_orders = [
+            OrderFactory(
+                delivery_date=today.replace(day=day),
+                client=cls.client1, status="D", )
+            for day in range(1, 11)]
+        client2 = ClientFactory()
+        cls.orders = [
+            OrderFactory(
+                delivery_date=today.replace(day=day),
+                client=client2,
+                status="O",
+            )
+            for day in range(1, 11)]
 
     def test_get_billable_orders(self):
         """
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class DeliveryConfig(AppConfig):
     name = 'delivery'
+
+    def ready(self):
+        # import signal handlers
+        # (every models imported inside handlers will be instantiated as
+        # soon as the registry is fully populated.)
+        import delivery.signals.handlers  # noqa
@@ -0,0 +1,209 @@
+"""Store of the generated PDF reports.
+
+A report is an artifact keyed by its kind, its delivery date and the
+hash of the inputs it is generated from. Reports generated at the same
+time do not overwrite each other, and a report is not generated again
+while its inputs do not change. The files are in
+settings.REPORT_ARTIFACTS_DIR (MEDIA_ROOT/reports by default), and the
+artifacts that have not been used for REPORT_ARTIFACT_RETENTION are
+deleted.
+"""
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.http import FileResponse, Http404
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.functional import Promise
+
+from .models import (ReportArtifact, ReportJob, REPORT_ARTIFACT_RETENTION,
+                     REPORT_KIND_KITCHEN_COUNT, REPORT_KIND_LABELS,
+                     REPORT_KIND_ROUTE_SHEETS)
+
+# Prefix of the name of the downloaded files, per kind of report.
+DOWNLOAD_PREFIXES = {
+    REPORT_KIND_KITCHEN_COUNT: 'kitchencount',
+    REPORT_KIND_LABELS: 'labels',
+    REPORT_KIND_ROUTE_SHEETS: 'routesheets',
+}
+
+# Part of every content hash: increase it when the layout of the reports
+# changes, so that the reports kept are generated again.
+LAYOUT_VERSION = 1
+
+
+def artifacts_dir():
+    """The directory in which the report files are stored."""
+    return getattr(settings, 'REPORT_ARTIFACTS_DIR',
+                   os.path.join(settings.MEDIA_ROOT, 'reports'))
+
+
+def artifact_path(artifact):
+    """The absolute path of the file of a ReportArtifact."""
+    return os.path.join(artifacts_dir(), artifact.path)
+
+
+def canonical(value):
+    """Convert the inputs of a report into a canonical JSON value.
+
+    Namedtuples become objects of their fields, sets become sorted
+    lists, and keys of dictionaries become strings, so that equal inputs
+    give the same JSON whatever the order in which sets and
+    dictionaries were filled. The order of lists and tuples is kept,
+    since it is the order of the lines of the reports.
+
+    Raises:
+        TypeError : The value contains an object that is not part of
+            the reports' inputs (a model instance for example).
+    """
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return {field: canonical(item)
+                for field, item in zip(value._fields, value)}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((canonical(item) for item in value),
+                      key=lambda item: json.dumps(item, sort_keys=True))
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, Promise)):
+        return force_text(value)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise TypeError("{!r} is not a report input".format(value))
+
+
+def content_hash(*inputs):
+    """Hash of the values a report is generated from, see canonical.
+
+    Returns:
+        A string of 64 hexadecimal digits.
+    """
+    text = json.dumps([LAYOUT_VERSION, canonical(inputs)],
+                      sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_or_generate(kind, delivery_date, inputs, generate):
+    """Find the artifact of a report, or generate it.
+
+    The file is generated under a temporary name and renamed once it is
+    complete, so that it is never read while it is being written. The
+    hits and misses of the artifact are counted, see
+    ReportArtifactManager.cache_stats.
+
+    Args:
+        kind : One of REPORT_KINDS.
+        delivery_date : A datetime.date object.
+        inputs : A tuple of everything the content of the report depends
+            on, see content_hash.
+        generate : A function that writes the report in the file whose
+            name is given and returns the number of pages or labels
+            generated.
+
+    Returns:
+        A ReportArtifact object, or None if no file was written.
+    """
+    digest = content_hash(*inputs)
+    artifact = ReportArtifact.objects.filter(
+        kind=kind, delivery_date=delivery_date,
+        content_hash=digest).first()
+    if artifact is not None and os.path.exists(artifact_path(artifact)):
+        ReportArtifact.objects.filter(pk=artifact.pk).update(
+            used_at=timezone.now(), hits=F('hits') + 1)
+        artifact.refresh_from_db()
+        return artifact
+
+    relative_path = os.path.join(
+        kind, delivery_date.strftime('%Y-%m-%d'), digest + '.pdf')
+    path = os.path.join(artifacts_dir(), relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        num_items = generate(temporary_path)
+        written = os.path.getsize(temporary_path) > 0
+        if written:
+            os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    if not written:
+        return None
+
+    key = {'kind': kind,
+           'delivery_date': delivery_date,
+           'content_hash': digest}
+    values = {'path': relative_path,
+              'num_items': num_items,
+              'used_at': timezone.now()}
+    # The row exists if its file was deleted, or if the report was
+    # generated by another process at the same time.
+    if not ReportArtifact.objects.filter(**key).update(
+            misses=F('misses') + 1, **values):
+        try:
+            with transaction.atomic():
+                ReportArtifact.objects.create(misses=1, **dict(key, **values))
+        except IntegrityError:
+            ReportArtifact.objects.filter(**key).update(
+                misses=F('misses') + 1, **values)
+    purge()
+    return ReportArtifact.objects.get(**key)
+
+
+def purge(now=None):
+    """Delete the artifacts that have not been used for a while.
+
+    See REPORT_ARTIFACT_RETENTION. The report jobs finished for this time
+    are deleted too, see ReportJobManager.purge.
+
+    Returns:
+        The number of artifacts deleted.
+    """
+    if now is None:
+        now = timezone.now()
+    expired = list(ReportArtifact.objects.filter(
+        used_at__lt=now - REPORT_ARTIFACT_RETENTION))
+    for artifact in expired:
+        path = artifact_path(artifact)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            # remove the directory of the date once it is empty
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    ReportArtifact.objects.filter(
+        pk__in=[artifact.pk for artifact in expired]).delete()
+    ReportJob.objects.purge(now)
+    return len(expired)
+
+
+def file_response(artifact):
+    """Stream the file of an artifact as a PDF download.
+
+    Raises:
+        Http404 : The file does not exist.
+    """
+    try:
+        f = open(artifact_path(artifact), 'rb')
+    except FileNotFoundError:
+        raise Http404("File " + artifact.path + " does not exist")
+    response = FileResponse(f, content_type='application/pdf')
+    response['Content-Disposition'] = \
+        'attachment; filename="{}{}.pdf"'.format(
+            DOWNLOAD_PREFIXES[artifact.kind],
+            artifact.delivery_date.strftime("%Y%m%d"))
+    return response
@@ -0,0 +1,100 @@
+"""Benchmarks of the route optimisation, in the pytest-benchmark style.
+
+They are not run by the test suite. Run them on their own, from the src
+directory, with pytest-django and pytest-benchmark installed:
+
+    pytest delivery/benchmark_routing.py --ds=sous_chef.settings_test
+
+The routes are the clustered instances of delivery.benchmarks. The
+running times can be compared between runs with the --benchmark-autosave
+and --benchmark-compare options of pytest-benchmark. The tours are
+compared with delivery/benchmark_baseline.json, see the benchmarktsp
+command.
+"""
+import os
+
+import pytest
+
+from . import benchmarks, tsp
+from .models import RouteOptimisation
+from .views import calculateRoutePointsEuclidean
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__),
+                             'benchmark_baseline.json')
+BASELINE, BASELINE_SETTINGS = benchmarks.load_baseline(BASELINE_FILE)
+
+# Number of stops of the benchmark routes. A solve of the largest one of
+# BENCHMARK_SIZES takes half a minute.
+SIZES = [size for size in benchmarks.BENCHMARK_SIZES if size <= 200]
+# Ratios to the baseline above which a change is a regression. The
+# running time depends on the machine.
+LENGTH_TOLERANCE = 1.01
+TIME_TOLERANCE = 3.0
+# calculateRoutePointsEuclidean stops after ROUTE_OPTIMISATION_TIME_LIMIT_MS,
+# its tours may be longer than those of the baseline, which has no limit.
+TIME_LIMITED_LENGTH_TOLERANCE = 1.10
+
+pytestmark = pytest.mark.django_db
+
+
+def tour_length(nodes, ids):
+    """Length of the tour visiting the nodes of a clustered instance in
+    the order of `ids`, with the metric of the baseline.
+    """
+    matrix = tsp.DistanceMatrix(nodes, BASELINE_SETTINGS['metric'])
+    index = {node.id: i for i, node in enumerate(nodes)}
+    return matrix.tour_distance([0] + [index[i] for i in ids])
+
+
+def record(benchmark, nodes, length):
+    """Keep the length of the tour and its gap in the results."""
+    matrix = tsp.DistanceMatrix(nodes, BASELINE_SETTINGS['metric'])
+    benchmark.extra_info['length'] = length
+    benchmark.extra_info['gap'] = length / benchmarks.lower_bound(matrix)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_tsp_solve(benchmark, size):
+    nodes = benchmarks.clustered_instance(size, BASELINE_SETTINGS['seed'])
+    solved = benchmark.pedantic(
+        tsp.solve, args=(nodes,),
+        kwargs={'metric': BASELINE_SETTINGS['metric'],
+                'construction': BASELINE_SETTINGS['construction'],
+                'time_limit_ms': BASELINE_SETTINGS['time_limit']},
+        rounds=3, iterations=1)
+    length = tour_length(nodes, [node.id for node in solved[1:]])
+    record(benchmark, nodes, length)
+    assert length <= BASELINE[size].length * LENGTH_TOLERANCE
+    assert (benchmark.stats.stats.min <=
+            BASELINE[size].seconds * TIME_TOLERANCE)
+
+
+def waypoints(nodes):
+    """The waypoints of a clustered instance, without its starting point."""
+    return [{'id': node.id, 'latitude': node.latitude,
+             'longitude': node.longitude} for node in nodes[1:]]
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_calculate_route_points(benchmark, size):
+    nodes = benchmarks.clustered_instance(size, BASELINE_SETTINGS['seed'])
+
+    def setup():
+        # every round optimises the route, none is cached
+        RouteOptimisation.objects.all().delete()
+        return (waypoints(nodes),), {}
+
+    optimised = benchmark.pedantic(calculateRoutePointsEuclidean,
+                                   setup=setup, rounds=3)
+    length = tour_length(nodes, [waypoint['id'] for waypoint in optimised])
+    record(benchmark, nodes, length)
+    assert length <= (BASELINE[size].length *
+                      TIME_LIMITED_LENGTH_TOLERANCE)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_calculate_route_points_cached(benchmark, size):
+    nodes = benchmarks.clustered_instance(size, BASELINE_SETTINGS['seed'])
+    optimised = calculateRoutePointsEuclidean(waypoints(nodes))
+    cached = benchmark(calculateRoutePointsEuclidean, waypoints(nodes))
+    assert cached == optimised
@@ -0,0 +1,167 @@
+import collections
+import json
+import random
+import time
+import tracemalloc
+
+import numpy
+
+from . import tsp
+from .settings import DELIVERY_STARTING_POINT_LAT_LONG
+
+
+# Number of stops of the benchmark routes.
+BENCHMARK_SIZES = (50, 100, 200, 500)
+# Average number of stops per cluster of clients.
+STOPS_PER_CLUSTER = 25
+# Standard deviation of the latitudes around the centre of a cluster.
+CLUSTER_SPREAD = 0.006
+
+BenchmarkResult = collections.namedtuple(  # Measures of one solve.
+    'BenchmarkResult',
+    ['size',                        # Number of stops
+     'seconds',                     # Running time of the solver
+     'length',                      # Length of the tour found
+     'lower_bound',                 # Lower bound of the optimal length
+     'peak_memory'])                # Bytes allocated at most, or None
+
+
+def clustered_instance(size, seed=0, clusters=None):
+    """Builds a reproducible route shaped like the Montreal deliveries.
+
+    Clients are grouped in neighbourhoods, spread around the starting
+    point of the deliveries.
+
+    Args:
+        size: The number of stops.
+        seed: The seed of the random generator.
+        clusters: The number of neighbourhoods, one per
+            STOPS_PER_CLUSTER stops by default.
+
+    Returns:
+        A list of nodes. The first one is the starting point, the ids
+        of the others go from 0 to size - 1.
+    """
+    latitude, longitude = DELIVERY_STARTING_POINT_LAT_LONG
+    rng = random.Random(seed)
+    if clusters is None:
+        clusters = max(1, size // STOPS_PER_CLUSTER)
+    centres = [(latitude + rng.uniform(-0.05, 0.05),
+                longitude + rng.uniform(-0.07, 0.07))
+               for _ in range(clusters)]
+    nodes = [tsp.Node(None, latitude, longitude)]
+    for i in range(size):
+        centre_latitude, centre_longitude = rng.choice(centres)
+        # A degree of longitude is about 0.7 degree of latitude in
+        # Montreal: the clusters are round on the map.
+        nodes.append(tsp.Node(
+            i,
+            rng.gauss(centre_latitude, CLUSTER_SPREAD),
+            rng.gauss(centre_longitude, CLUSTER_SPREAD / 0.7)))
+    return nodes
+
+
+def lower_bound(matrix):
+    """Lower bound of the length of the shortest tour (1-tree bound).
+
+    Without its starting point, a tour is a path visiting all the other
+    nodes, which is at least as long as their minimum spanning tree. The
+    two edges of the starting point are at least as long as its two
+    shortest edges.
+
+    https://en.wikipedia.org/wiki/Travelling_salesman_problem
+
+    Args:
+        matrix: A tsp.DistanceMatrix.
+    """
+    n = len(matrix)
+    if n < 3:
+        return matrix.tour_distance(range(n))
+    # Prim's algorithm on the nodes other than the starting point
+    distances = matrix.array[1:, 1:]
+    in_tree = numpy.zeros(n - 1, dtype=bool)
+    in_tree[0] = True
+    closest = distances[0].copy()
+    tree = 0.0
+    for _ in range(n - 2):
+        candidates = numpy.where(in_tree, numpy.inf, closest)
+        node = int(numpy.argmin(candidates))
+        tree += candidates[node]
+        in_tree[node] = True
+        closest = numpy.minimum(closest, distances[node])
+    return tree + numpy.sort(matrix.array[0, 1:])[:2].sum()
+
+
+def run_benchmark(size, seed=0, metric=tsp.SQUARED_EUCLIDEAN,
+                  construction=None, time_limit_ms=None,
+                  measure_memory=True):
+    """Solves a clustered instance and measures the solver.
+
+    The peak memory is measured during a second solve, since tracing
+    the allocations slows the solver down.
+
+    Args:
+        size: The number of stops, see clustered_instance.
+        seed: The seed of the random generator.
+        metric, construction, time_limit_ms: See tsp.solve.
+        measure_memory: False to skip the measure of the memory.
+
+    Returns:
+        A BenchmarkResult object. Lengths are measured with the metric.
+    """
+    nodes = clustered_instance(size, seed)
+    start = time.perf_counter()
+    solved = tsp.solve(nodes, metric=metric, time_limit_ms=time_limit_ms,
+                       construction=construction)
+    seconds = time.perf_counter() - start
+
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            tsp.solve(nodes, metric=metric, time_limit_ms=time_limit_ms,
+                      construction=construction)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    matrix = tsp.DistanceMatrix(nodes, metric)
+    index = {node: i for i, node in enumerate(nodes)}
+    return BenchmarkResult(
+        size=size,
+        seconds=seconds,
+        length=matrix.tour_distance(index[node] for node in solved),
+        lower_bound=float(lower_bound(matrix)),
+        peak_memory=peak_memory)
+
+
+def save_baseline(path, results, settings):
+    """Writes benchmark results to a JSON file.
+
+    Args:
+        path: The path of the file.
+        results: A list of BenchmarkResult objects.
+        settings: A dictionary of the settings of the benchmark (seed,
+            metric...), so that results are only compared with results
+            of the same benchmark.
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'settings': settings,
+            'results': [result._asdict() for result in results],
+        }, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    """Reads benchmark results written by save_baseline.
+
+    Returns:
+        A tuple (results, settings). `results` is a dictionary
+        {<size>: <BenchmarkResult>, ...}.
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    results = {}
+    for result in baseline['results']:
+        results[result['size']] = BenchmarkResult(**result)
+    return results, baseline['settings']
@@ -36,3 +36,42 @@ class DishIngredientsForm(forms.Form):
             raise forms.ValidationError(
                 _("Please choose some Sides ingredients"))
         return data
+
+
+class KitchenCountRangeForm(forms.Form):
+    # Longest range of dates, in days
+    MAX_DAYS = 62
+
+    start_date = forms.DateField(
+        label=_("From"),
+        widget=forms.TextInput(
+            attrs={
+                'class': 'ui calendar',
+                'placeholder': _('YYYY-MM-DD')
+            }
+        ),
+    )
+
+    end_date = forms.DateField(
+        label=_("To"),
+        widget=forms.TextInput(
+            attrs={
+                'class': 'ui calendar',
+                'placeholder': _('YYYY-MM-DD')
+            }
+        ),
+    )
+
+    def clean(self):
+        cleaned_data = super(KitchenCountRangeForm, self).clean()
+        start_date = cleaned_data.get('start_date')
+        end_date = cleaned_data.get('end_date')
+        if start_date and end_date:
+            if end_date < start_date:
+                raise forms.ValidationError(
+                    _("The end date must be after the start date."))
+            if (end_date - start_date).days >= self.MAX_DAYS:
+                raise forms.ValidationError(
+                    _("The range cannot be longer than %(days)s days."),
+                    params={'days': self.MAX_DAYS})
+        return cleaned_data
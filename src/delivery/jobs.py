@@ -0,0 +1,120 @@
+"""Background generation of the kitchen count and labels PDFs.
+
+The jobs are ReportJob rows, so no message broker is needed. They are
+run by a worker thread started in the web process when a job is queued
+(unless settings.REPORT_WORKER_THREAD is False), or by the reportworker
+management command. The optimisation of the routes of a day is queued
+the same way. The meal labels and the routes are only rendered and
+solved in parallel processes by the reportworker command, since the web
+process must not be forked.
+"""
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone, translation
+
+from .models import (ReportJob, REPORT_JOB_KIND_REPORTS,
+                     REPORT_JOB_KIND_ROUTES, REPORT_JOB_STATUS_DONE,
+                     REPORT_JOB_STATUS_FAILED, REPORT_JOB_STATUS_PENDING)
+
+_worker_lock = threading.Lock()
+_worker = None          # local worker thread, if running
+_worker_wakeup = False  # a job was queued while the worker was running
+
+
+def enqueue(delivery_date, content_hash='', language=None,
+            kind=REPORT_JOB_KIND_REPORTS):
+    """Queue the reports of a date and make sure that a worker runs them.
+
+    See ReportJobManager.enqueue.
+
+    Returns:
+        A ReportJob object.
+    """
+    job = ReportJob.objects.enqueue(delivery_date, content_hash, language,
+                                    kind)
+    if (job.status == REPORT_JOB_STATUS_PENDING and
+            getattr(settings, 'REPORT_WORKER_THREAD', True)):
+        transaction.on_commit(start_local_worker)
+    return job
+
+
+def run_job(job, workers=1):
+    """Generate the reports of a claimed job and save its result.
+
+    The reports are generated in the language of the job, since the
+    worker does not run in the request of the user.
+
+    Args:
+        job : A ReportJob object.
+        workers : The number of processes rendering the meal labels or
+            optimising the routes, see kcr_make_labels and
+            optimise_delivery_routes.
+    """
+    # This needs to be placed on the top when the report generation is
+    # moved out of the views. It causes a circular dependancy otherwise.
+    from .views import kcr_make_reports, optimise_delivery_routes  # noqa
+    try:
+        with translation.override(job.language):
+            if job.kind == REPORT_JOB_KIND_ROUTES:
+                optimise_delivery_routes(job.delivery_date, workers)
+            else:
+                job.num_pages, job.num_labels = kcr_make_reports(
+                    job.delivery_date, workers)
+        job.status = REPORT_JOB_STATUS_DONE
+    except Exception:
+        job.error = traceback.format_exc()
+        job.status = REPORT_JOB_STATUS_FAILED
+    job.finished_at = timezone.now()
+    job.save()
+
+
+def run_pending_jobs(workers=1):
+    """Run the queued jobs, one after the other, until there is none.
+
+    Args:
+        workers : See run_job.
+
+    Returns:
+        The number of jobs run.
+    """
+    count = 0
+    job = ReportJob.objects.claim()
+    while job is not None:
+        run_job(job, workers)
+        count += 1
+        job = ReportJob.objects.claim()
+    return count
+
+
+def start_local_worker():
+    """Start the worker thread of this process, unless it is running."""
+    global _worker, _worker_wakeup
+    with _worker_lock:
+        if _worker is not None:
+            # The worker looks for new jobs once more before stopping.
+            _worker_wakeup = True
+            return
+        _worker = threading.Thread(target=_local_worker,
+                                   name='report-worker', daemon=True)
+        _worker.start()
+
+
+def _local_worker():
+    global _worker, _worker_wakeup
+    try:
+        while True:
+            run_pending_jobs()
+            with _worker_lock:
+                if not _worker_wakeup:
+                    _worker = None
+                    return
+                _worker_wakeup = False
+    except Exception:
+        with _worker_lock:
+            _worker = None
+        raise
+    finally:
+        connection.close()
@@ -0,0 +1,143 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from delivery import benchmarks, tsp
+
+
+class Command(BaseCommand):
+    help = 'Measure the route optimisation solver on reproducible routes\
+            shaped like the Montreal deliveries: running time, length\
+            of the tour compared with a lower bound and peak memory.\
+            Results can be saved as a JSON baseline, and compared with\
+            it after a change, and with the reference 2-opt\
+            implementation on small routes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            help='Comma separated list of the number of stops per route.',
+            default=','.join(str(s) for s in benchmarks.BENCHMARK_SIZES),
+        )
+        parser.add_argument(
+            '--seed',
+            help='Seed of the random generator, for reproducible routes.',
+            default=0,
+            type=int
+        )
+        parser.add_argument(
+            '--reference-max',
+            help=(
+                'Largest route size on which the reference solver is run. '
+                'It takes several minutes on 200 stops.'
+            ),
+            default=200,
+            type=int
+        )
+        parser.add_argument(
+            '--metric',
+            help='Distance metric of the solver.',
+            choices=sorted(tsp.METRICS),
+            default=tsp.SQUARED_EUCLIDEAN,
+        )
+        parser.add_argument(
+            '--construction',
+            help='Construction heuristic building the initial tour.',
+            choices=sorted(tsp.CONSTRUCTIONS),
+            default=None,
+        )
+        parser.add_argument(
+            '--time-limit',
+            help='Time budget of the solver in milliseconds (no limit).',
+            default=None,
+            type=int
+        )
+        parser.add_argument(
+            '--no-memory',
+            help='Do not measure the peak memory (twice as fast).',
+            action='store_true',
+        )
+        parser.add_argument(
+            '--baseline',
+            help=(
+                'JSON file of previous results to compare with. '
+                'delivery/benchmark_baseline.json was measured with '
+                '--reference-max 0 --metric haversine --construction greedy.'
+            ),
+            default=None,
+        )
+        parser.add_argument(
+            '--save-baseline',
+            help='JSON file in which the results are saved.',
+            default=None,
+        )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        settings = {
+            'seed': options['seed'],
+            'metric': options['metric'],
+            'construction': options['construction'],
+            'time_limit': options['time_limit'],
+        }
+        baseline = {}
+        if options['baseline']:
+            baseline, baseline_settings = benchmarks.load_baseline(
+                options['baseline'])
+            if baseline_settings != settings:
+                print("Warning: the baseline was measured with other "
+                      "settings: {}".format(baseline_settings))
+
+        print("{0:>6} {1:>10} {2:>7} {3:>10} {4:>10} {5:>9} {6:>7} "
+              "{7:>10} {8:>10}".format(
+                  'stops', 'solve (s)', 'gap', 'mem. (MB)', 'ref. (s)',
+                  'speed-up', 'length', 'base time', 'base len.'))
+        results = []
+        for size in sizes:
+            result = benchmarks.run_benchmark(
+                size, seed=options['seed'], metric=options['metric'],
+                construction=options['construction'],
+                time_limit_ms=options['time_limit'],
+                measure_memory=not options['no_memory'])
+            results.append(result)
+            # Ratio of the length of the tour to its lower bound: the
+            # tour is at most that much longer than the optimal one.
+            columns = [size, "{:.3f}".format(result.seconds),
+                       "{:.3f}".format(result.length / result.lower_bound)]
+            if result.peak_memory is None:
+                columns.append('-')
+            else:
+                columns.append("{:.1f}".format(result.peak_memory / 1e6))
+
+            if size > options['reference_max']:
+                columns += ['-', '-', '-']
+            else:
+                tour = benchmarks.clustered_instance(size, options['seed'])
+                start = time.perf_counter()
+                reference = tsp.solve_exhaustive(tour)
+                reference_elapsed = time.perf_counter() - start
+                matrix = tsp.DistanceMatrix(tour, options['metric'])
+                index = {node: i for i, node in enumerate(tour)}
+                # Ratio of the tour lengths: lower or equal to 1 means
+                # that the new solver is at least as good as the
+                # reference one.
+                columns += [
+                    "{:.3f}".format(reference_elapsed),
+                    "{:.1f}x".format(reference_elapsed / result.seconds),
+                    "{:.3f}".format(result.length / matrix.tour_distance(
+                        index[node] for node in reference))]
+
+            # Ratios to the baseline: lower than 1 is an improvement.
+            if size in baseline:
+                columns += [
+                    "{:.2f}".format(result.seconds / baseline[size].seconds),
+                    "{:.3f}".format(result.length / baseline[size].length)]
+            else:
+                columns += ['-', '-']
+            print("{0:>6} {1:>10} {2:>7} {3:>10} {4:>10} {5:>9} {6:>7} "
+                  "{7:>10} {8:>10}".format(*columns))
+
+        if options['save_baseline']:
+            benchmarks.save_baseline(options['save_baseline'], results,
+                                     settings)
+            print("Results saved in {}".format(options['save_baseline']))
@@ -0,0 +1,38 @@
+from datetime import datetime
+import time
+
+from django.core.management.base import BaseCommand
+
+from delivery.views import optimise_delivery_routes
+
+
+class Command(BaseCommand):
+    help = 'Optimise the delivery sequence of every route having orders\
+            on a day, and save it in the delivery history of the route.\
+            The routes are solved in parallel, one process per core by\
+            default.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='The delivery date in the format YYYY-MM-DD, today by '
+                 'default.',
+        )
+        parser.add_argument(
+            '--workers',
+            help='The number of processes solving the routes, one per '
+                 'core by default.',
+            type=int
+        )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            delivery_date = datetime.strptime(
+                options['date'], '%Y-%m-%d').date()
+        else:
+            delivery_date = datetime.today().date()
+        start = time.perf_counter()
+        sequences = optimise_delivery_routes(delivery_date,
+                                             options['workers'])
+        print("{0} route(s) optimised for {1} in {2:.2f}s.".format(
+            len(sequences), delivery_date, time.perf_counter() - start))
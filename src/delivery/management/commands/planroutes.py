@@ -0,0 +1,55 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from delivery import vrp
+from member.models import Route
+
+
+class Command(BaseCommand):
+    help = 'Split the shippable orders of a day among vehicles, within\
+            their capacity in meals, and print the delivery sequence of\
+            each vehicle. By default, there is one vehicle per route,\
+            of the kind of vehicle of the route.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='The delivery date in the format YYYY-MM-DD, today by '
+                 'default.',
+        )
+        parser.add_argument(
+            '--vehicles',
+            help='Comma separated list of the kinds of the vehicles, one '
+                 'item per vehicle (ex. driving,cycling,cycling).',
+        )
+        parser.add_argument(
+            '--time-limit-ms',
+            help='The time budget of the whole solve, in milliseconds.',
+            default=2000,
+            type=int
+        )
+
+    def handle(self, *args, **options):
+        delivery_date = None
+        if options['date']:
+            delivery_date = datetime.strptime(
+                options['date'], '%Y-%m-%d').date()
+        if options['vehicles']:
+            kinds = options['vehicles'].split(',')
+        else:
+            kinds = Route.objects.order_by('pk').values_list(
+                'vehicle', flat=True)
+        try:
+            routes = vrp.plan_delivery_routes(
+                vrp.make_vehicles(kinds), delivery_date,
+                time_limit_ms=options['time_limit_ms'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        for i, route in enumerate(routes, 1):
+            print("Vehicle {0} ({1}): {2}/{3} meals, {4} stops, "
+                  "{5:.1f} km: {6}".format(
+                      i, route.vehicle.kind, route.load,
+                      route.vehicle.capacity, len(route.stops),
+                      route.distance,
+                      ",".join(str(stop.id) for stop in route.stops)))
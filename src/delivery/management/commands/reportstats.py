@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from delivery.models import ReportArtifact, REPORT_KINDS
+
+
+class Command(BaseCommand):
+    help = 'Show how often the PDF reports kept in REPORT_ARTIFACTS_DIR\
+            were served again (hits) instead of being generated\
+            (misses), per kind of report.'
+
+    def handle(self, *args, **options):
+        stats = ReportArtifact.objects.cache_stats()
+        print("{0:<15} {1:>8} {2:>8} {3:>8} {4:>10}".format(
+            'report', 'hits', 'misses', 'hit rate', 'artifacts'))
+        for kind, name in REPORT_KINDS:
+            if kind not in stats:
+                continue
+            kind_stats = stats[kind]
+            requests = kind_stats.hits + kind_stats.misses
+            print("{0:<15} {1:>8} {2:>8} {3:>8} {4:>10}".format(
+                kind, kind_stats.hits, kind_stats.misses,
+                "{:.0%}".format(kind_stats.hits / requests)
+                if requests else '-',
+                kind_stats.artifacts))
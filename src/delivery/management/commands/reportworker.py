@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from delivery import jobs
+
+
+class Command(BaseCommand):
+    help = 'Generate the kitchen count and labels PDF files queued by the\
+            Kitchen Count page, and optimise the routes queued by the\
+            Routes page. Run it when the worker thread of the web\
+            process is disabled (REPORT_WORKER_THREAD = False).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            help='Run the queued jobs then stop.',
+            action='store_true',
+        )
+        parser.add_argument(
+            '--interval',
+            help='Seconds between two checks of the queue.',
+            default=2.0,
+            type=float
+        )
+        parser.add_argument(
+            '--workers',
+            help='The number of processes rendering the meal labels or '
+                 'optimising the routes, one per core by default.',
+            type=int
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = jobs.run_pending_jobs(options['workers'])
+            if count:
+                print("{} report job(s) run.".format(count))
+            if options['once']:
+                break
+            time.sleep(options['interval'])
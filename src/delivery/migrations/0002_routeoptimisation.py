@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 00:58
+from __future__ import unicode_literals
+
+import annoying.fields
+from django.db import migrations, models
+import json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0001_fix004a'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteOptimisation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True, verbose_name='fingerprint of the stops and starting point')),
+                ('client_id_sequence', annoying.fields.JSONField(default=[], deserializer=json.loads, serializer=annoying.fields.dumps, verbose_name='IDs of clients in delivery order (as a JSON list)')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'route optimisation',
+                'verbose_name_plural': 'route optimisations',
+                'ordering': ['-updated_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:24
+from __future__ import unicode_literals
+
+import annoying.fields
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0031_client_option_allow_reverse_relation'),
+        ('delivery', '0002_routeoptimisation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KitchenSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='date of the delivery')),
+            ],
+            options={
+                'verbose_name': 'kitchen snapshot',
+                'verbose_name_plural': 'kitchen snapshots',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='KitchenSnapshotItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kitchen_item', annoying.fields.JSONField(default=None, deserializer=json.loads, null=True, serializer=annoying.fields.dumps, verbose_name='kitchen item (as JSON)')),
+                ('dirty', models.BooleanField(default=False, verbose_name='must be computed again')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='member.Client', verbose_name='client')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='delivery.KitchenSnapshot', verbose_name='snapshot')),
+            ],
+            options={
+                'verbose_name': 'kitchen snapshot item',
+                'verbose_name_plural': 'kitchen snapshot items',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='kitchensnapshotitem',
+            unique_together=set([('snapshot', 'client')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0004_reportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportArtifact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('kitchen_count', 'Kitchen count'), ('labels', 'Meal labels'), ('route_sheets', 'Route sheets')], max_length=20, verbose_name='kind of report')),
+                ('delivery_date', models.DateField(verbose_name='date of the delivery')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='hash of the inputs of the report')),
+                ('path', models.CharField(max_length=255, verbose_name='path of the file in the report directory')),
+                ('num_items', models.IntegerField(default=0, verbose_name='pages or labels')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('used_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='last used at')),
+            ],
+            options={
+                'verbose_name': 'report artifact',
+                'verbose_name_plural': 'report artifacts',
+                'ordering': ['-used_at'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='reportartifact',
+            unique_together=set([('kind', 'delivery_date', 'content_hash')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0005_reportartifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportartifact',
+            name='hits',
+            field=models.IntegerField(default=0, verbose_name='times found with the same inputs'),
+        ),
+        migrations.AddField(
+            model_name='reportartifact',
+            name='misses',
+            field=models.IntegerField(default=0, verbose_name='times generated'),
+        ),
+    ]
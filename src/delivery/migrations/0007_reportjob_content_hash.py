@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 03:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0006_reportartifact_hits_misses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportjob',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, verbose_name='hash of the inputs of the reports'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 03:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0007_reportjob_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportjob',
+            name='language',
+            field=models.CharField(default='en', max_length=10, verbose_name='language of the reports'),
+        ),
+    ]
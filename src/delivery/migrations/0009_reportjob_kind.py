@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 03:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0008_reportjob_language'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportjob',
+            name='kind',
+            field=models.CharField(choices=[('R', 'Kitchen count reports'), ('O', 'Optimisation of the routes')], default='R', max_length=1, verbose_name='kind'),
+        ),
+    ]
@@ -1,8 +1,64 @@
-from django.db import models
+import collections
+import datetime
+
+from annoying.fields import JSONField
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.translation import get_language
 from django.utils.translation import ugettext_lazy as _
 
+from order.models import Order, KitchenItem, MealComponent
+
 # Create your models here.
 
+# Kitchen snapshots of dates older than this are deleted.
+KITCHEN_SNAPSHOT_RETENTION = datetime.timedelta(days=30)
+
+# Number of recent optimisations compared with a new set of stops.
+WARM_START_CANDIDATES = 100
+# Maximum number of stops added or removed for a warm start.
+WARM_START_MAX_DIFFERENCES = 5
+# Number of optimised sequences kept, the most recently updated ones.
+ROUTE_OPTIMISATION_CACHE_SIZE = 10 * WARM_START_CANDIDATES
+
+REPORT_JOB_STATUS = (
+    ('P', _('Pending')),
+    ('R', _('Running')),
+    ('D', _('Done')),
+    ('F', _('Failed')),
+)
+
+REPORT_JOB_STATUS_PENDING = REPORT_JOB_STATUS[0][0]
+REPORT_JOB_STATUS_RUNNING = REPORT_JOB_STATUS[1][0]
+REPORT_JOB_STATUS_DONE = REPORT_JOB_STATUS[2][0]
+REPORT_JOB_STATUS_FAILED = REPORT_JOB_STATUS[3][0]
+
+REPORT_JOB_KINDS = (
+    ('R', _('Kitchen count reports')),
+    ('O', _('Optimisation of the routes')),
+)
+
+REPORT_JOB_KIND_REPORTS = REPORT_JOB_KINDS[0][0]
+REPORT_JOB_KIND_ROUTES = REPORT_JOB_KINDS[1][0]
+
+# A running job is considered abandoned by its worker after this time.
+REPORT_JOB_TIMEOUT = datetime.timedelta(minutes=10)
+
+REPORT_KINDS = (
+    ('kitchen_count', _('Kitchen count')),
+    ('labels', _('Meal labels')),
+    ('route_sheets', _('Route sheets')),
+)
+
+REPORT_KIND_KITCHEN_COUNT = REPORT_KINDS[0][0]
+REPORT_KIND_LABELS = REPORT_KINDS[1][0]
+REPORT_KIND_ROUTE_SHEETS = REPORT_KINDS[2][0]
+
+# Report artifacts that have not been used for this time are deleted.
+REPORT_ARTIFACT_RETENTION = datetime.timedelta(days=7)
+
 
 class Delivery(models.Model):
 
@@ -10,3 +66,519 @@ class Delivery(models.Model):
         verbose_name_plural = _('deliveries')
 
     pass
+
+
+class RouteOptimisationManager(models.Manager):
+
+    def get_sequence(self, fingerprint, client_ids):
+        """Find a cached sequence for a set of stops.
+
+        Args:
+            fingerprint : The fingerprint of the stops and starting point.
+            client_ids : The IDs of the clients on the route.
+
+        Returns:
+            A tuple (sequence, exact). `sequence` is the cached list of
+            client IDs, or None if nothing was found. `exact` is False
+            when the sequence comes from a similar set of stops, which
+            differs by at most WARM_START_MAX_DIFFERENCES clients and
+            can be used as a warm start.
+        """
+        try:
+            return self.get(fingerprint=fingerprint).client_id_sequence, True
+        except self.model.DoesNotExist:
+            pass
+        client_ids = set(client_ids)
+        sequence = None
+        fewest_differences = WARM_START_MAX_DIFFERENCES + 1
+        for optimisation in self.all()[:WARM_START_CANDIDATES]:
+            differences = len(client_ids.symmetric_difference(
+                optimisation.client_id_sequence))
+            if differences < fewest_differences:
+                sequence = optimisation.client_id_sequence
+                fewest_differences = differences
+        return sequence, False
+
+    def store(self, fingerprint, client_id_sequence):
+        """Cache the optimised sequence of a set of stops.
+
+        Only the ROUTE_OPTIMISATION_CACHE_SIZE most recently updated
+        sequences are kept.
+        """
+        self.update_or_create(
+            fingerprint=fingerprint,
+            defaults={'client_id_sequence': client_id_sequence})
+        stale = list(self.order_by('-updated_at', '-pk').values_list(
+            'pk', flat=True)[ROUTE_OPTIMISATION_CACHE_SIZE:])
+        if stale:
+            self.filter(pk__in=stale).delete()
+
+
+class RouteOptimisation(models.Model):
+    """Optimised delivery sequence, cached by the fingerprint of its stops.
+
+    See also: delivery.views.calculateRoutePointsEuclidean
+    """
+
+    class Meta:
+        verbose_name = _('route optimisation')
+        verbose_name_plural = _('route optimisations')
+        ordering = ['-updated_at']
+
+    fingerprint = models.CharField(
+        max_length=64,
+        unique=True,
+        verbose_name=_('fingerprint of the stops and starting point')
+    )
+    client_id_sequence = JSONField(
+        verbose_name=_('IDs of clients in delivery order (as a JSON list)'),
+        default=[]
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name=_('updated at')
+    )
+
+    objects = RouteOptimisationManager()
+
+    def __str__(self):
+        return "RouteOptimisation: {}".format(self.fingerprint)
+
+
+def kitchen_item_to_json(kitchen_item):
+    """Convert a KitchenItem into a value that can be stored as JSON."""
+    value = kitchen_item._asdict()
+    value['meal_components'] = {
+        group: list(component)
+        for group, component in kitchen_item.meal_components.items()}
+    return value
+
+
+def kitchen_item_from_json(value):
+    """Convert a value made by kitchen_item_to_json into a KitchenItem."""
+    value = dict(value)
+    value['meal_components'] = {
+        group: MealComponent(*component)
+        for group, component in value['meal_components'].items()}
+    return KitchenItem(**value)
+
+
+class KitchenSnapshotManager(models.Manager):
+
+    def get_kitchen_items(self, delivery_date):
+        """Same as Order.get_kitchen_items, using the snapshot of the date.
+
+        The snapshot is created the first time. Then, only the kitchen
+        items of the clients marked as dirty are computed again.
+        """
+        with transaction.atomic():
+            snapshot, created = self.get_or_create(date=delivery_date)
+            if created:
+                self.purge(keep=delivery_date)
+            items = {item.client_id: item for item in snapshot.items.all()}
+            dirty = [client_id for client_id, item in items.items()
+                     if item.dirty]
+            if created or len(dirty) > len(items) / 2:
+                # cheaper than a query on many ids
+                kitchen_list = Order.get_kitchen_items(delivery_date)
+                dirty = set(items) | set(kitchen_list)
+            else:
+                kitchen_list = Order.get_kitchen_items(delivery_date,
+                                                       client_ids=dirty)
+            new_items = []
+            for client_id in dirty:
+                item = items.get(client_id)
+                if client_id not in kitchen_list:
+                    if item is not None:
+                        item.delete()
+                        del items[client_id]
+                    continue
+                value = kitchen_item_to_json(kitchen_list[client_id])
+                if item is None:
+                    items[client_id] = KitchenSnapshotItem(
+                        snapshot=snapshot, client_id=client_id,
+                        kitchen_item=value)
+                    new_items.append(items[client_id])
+                elif item.dirty or item.kitchen_item != value:
+                    item.kitchen_item = value
+                    item.dirty = False
+                    item.save()
+            KitchenSnapshotItem.objects.bulk_create(new_items)
+        return {client_id: kitchen_item_from_json(item.kitchen_item)
+                for client_id, item in items.items()}
+
+    def mark_dirty(self, client_ids, delivery_date=None):
+        """Mark the kitchen items of clients as needing to be computed again.
+
+        Args:
+            client_ids: A list of client ids.
+            delivery_date: If given, only the snapshot of this date is
+                updated, and the clients are added to it if necessary.
+                Otherwise, the clients are marked in all the snapshots.
+        """
+        items = KitchenSnapshotItem.objects.filter(client_id__in=client_ids)
+        if delivery_date is None:
+            items.update(dirty=True)
+            return
+        snapshot = self.filter(date=delivery_date).first()
+        if snapshot is None:
+            return
+        items.filter(snapshot=snapshot).update(dirty=True)
+        existing = set(items.filter(snapshot=snapshot).values_list(
+            'client_id', flat=True))
+        KitchenSnapshotItem.objects.bulk_create([
+            KitchenSnapshotItem(snapshot=snapshot, client_id=client_id,
+                                dirty=True)
+            for client_id in set(client_ids) - existing])
+
+    def invalidate(self, delivery_date):
+        """Drop the snapshot of a date, when all its clients may change."""
+        self.filter(date=delivery_date).delete()
+
+    def purge(self, today=None, keep=None):
+        """Delete the snapshots of the dates older than the retention.
+
+        This is done each time a snapshot is created, see
+        KITCHEN_SNAPSHOT_RETENTION.
+
+        Args:
+            today: The current date, today by default.
+            keep: If given, the date of a snapshot that is not deleted.
+
+        Returns:
+            The number of snapshots deleted.
+        """
+        if today is None:
+            today = timezone.localdate()
+        snapshots = self.filter(date__lt=today - KITCHEN_SNAPSHOT_RETENTION)
+        if keep is not None:
+            snapshots = snapshots.exclude(date=keep)
+        count = snapshots.count()
+        if count:
+            snapshots.delete()
+        return count
+
+
+class KitchenSnapshot(models.Model):
+    """Kitchen items of all the clients for a delivery date.
+
+    The Kitchen Count Report reads its data from this snapshot instead
+    of computing it again at each page view. The signal handlers of
+    delivery.signals.handlers keep it up to date.
+
+    See also: Order.get_kitchen_items
+    """
+
+    class Meta:
+        verbose_name = _('kitchen snapshot')
+        verbose_name_plural = _('kitchen snapshots')
+        ordering = ['-date']
+
+    date = models.DateField(
+        unique=True,
+        verbose_name=_('date of the delivery')
+    )
+
+    objects = KitchenSnapshotManager()
+
+    def __str__(self):
+        return "KitchenSnapshot: {}".format(self.date)
+
+
+class KitchenSnapshotItem(models.Model):
+    """Kitchen item of a client in a KitchenSnapshot."""
+
+    class Meta:
+        verbose_name = _('kitchen snapshot item')
+        verbose_name_plural = _('kitchen snapshot items')
+        unique_together = ('snapshot', 'client')
+
+    snapshot = models.ForeignKey(
+        KitchenSnapshot,
+        on_delete=models.CASCADE,
+        verbose_name=_('snapshot'),
+        related_name='items'
+    )
+    client = models.ForeignKey(
+        'member.Client',
+        on_delete=models.CASCADE,
+        verbose_name=_('client'),
+        related_name='+'
+    )
+    kitchen_item = JSONField(
+        verbose_name=_('kitchen item (as JSON)'),
+        null=True,
+        default=None
+    )
+    dirty = models.BooleanField(
+        verbose_name=_('must be computed again'),
+        default=False
+    )
+
+    def __str__(self):
+        return "KitchenSnapshotItem: client {} on {}".format(
+            self.client_id, self.snapshot.date)
+
+
+class ReportJobManager(models.Manager):
+
+    def enqueue(self, delivery_date, content_hash='', language=None,
+                kind=REPORT_JOB_KIND_REPORTS):
+        """Queue the generation of the kitchen count reports of a date.
+
+        A job of the same kind, date and language that is still pending
+        is reused, and so is the latest job of the kind, date and
+        language that is running or done, if the reports are generated
+        from the same inputs.
+
+        Args:
+            delivery_date : A datetime.date object.
+            content_hash : The hash of the inputs of the reports, see
+                delivery.artifacts.content_hash.
+            language : The language of the reports, the active language
+                by default.
+            kind : One of REPORT_JOB_KINDS, the kitchen count reports by
+                default.
+
+        Returns:
+            A ReportJob object.
+        """
+        if language is None:
+            language = get_language() or settings.LANGUAGE_CODE
+        jobs = self.filter(delivery_date=delivery_date, language=language,
+                           kind=kind)
+        job = jobs.filter(
+            status=REPORT_JOB_STATUS_PENDING).order_by('pk').first()
+        if job is None and content_hash:
+            job = jobs.exclude(
+                status=REPORT_JOB_STATUS_PENDING
+            ).order_by('-created_at', '-pk').first()
+            if job is not None and (
+                    job.status not in (REPORT_JOB_STATUS_RUNNING,
+                                       REPORT_JOB_STATUS_DONE) or
+                    job.content_hash != content_hash):
+                job = None
+        if job is None:
+            job = self.create(delivery_date=delivery_date,
+                              content_hash=content_hash,
+                              language=language, kind=kind)
+        elif job.content_hash != content_hash and content_hash:
+            job.content_hash = content_hash
+            job.save(update_fields=['content_hash'])
+        return job
+
+    def claim(self):
+        """Take the oldest pending job, which becomes running.
+
+        Jobs that have been running for longer than REPORT_JOB_TIMEOUT
+        are taken again, since their worker has stopped.
+
+        Returns:
+            A ReportJob object, or None if there is no job to run.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            job = self.select_for_update().filter(
+                Q(status=REPORT_JOB_STATUS_PENDING) |
+                Q(status=REPORT_JOB_STATUS_RUNNING,
+                  started_at__lt=now - REPORT_JOB_TIMEOUT)
+            ).order_by('created_at', 'pk').first()
+            if job is not None:
+                job.status = REPORT_JOB_STATUS_RUNNING
+                job.started_at = now
+                job.save(update_fields=['status', 'started_at'])
+        return job
+
+    def purge(self, now=None):
+        """Delete the jobs finished for longer than the retention.
+
+        This is done with the purge of the report artifacts, see
+        REPORT_ARTIFACT_RETENTION and delivery.artifacts.purge.
+
+        Returns:
+            The number of jobs deleted.
+        """
+        if now is None:
+            now = timezone.now()
+        jobs = self.filter(
+            status__in=(REPORT_JOB_STATUS_DONE, REPORT_JOB_STATUS_FAILED),
+            finished_at__lt=now - REPORT_ARTIFACT_RETENTION)
+        count = jobs.count()
+        if count:
+            jobs.delete()
+        return count
+
+
+class ReportJob(models.Model):
+    """Background generation of the kitchen count and labels PDFs.
+
+    The optimisation of all the routes of a day is run the same way.
+    Jobs are run by delivery.jobs, see run_pending_jobs.
+    """
+
+    class Meta:
+        verbose_name = _('report job')
+        verbose_name_plural = _('report jobs')
+        ordering = ['-created_at']
+
+    kind = models.CharField(
+        max_length=1,
+        choices=REPORT_JOB_KINDS,
+        default=REPORT_JOB_KIND_REPORTS,
+        verbose_name=_('kind')
+    )
+    delivery_date = models.DateField(
+        verbose_name=_('date of the delivery')
+    )
+    status = models.CharField(
+        max_length=1,
+        choices=REPORT_JOB_STATUS,
+        default=REPORT_JOB_STATUS_PENDING,
+        verbose_name=_('status')
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('created at')
+    )
+    started_at = models.DateTimeField(
+        null=True,
+        verbose_name=_('started at')
+    )
+    finished_at = models.DateTimeField(
+        null=True,
+        verbose_name=_('finished at')
+    )
+    num_pages = models.IntegerField(
+        default=0,
+        verbose_name=_('pages of the kitchen count report')
+    )
+    num_labels = models.IntegerField(
+        default=0,
+        verbose_name=_('meal labels')
+    )
+    error = models.TextField(
+        blank=True,
+        verbose_name=_('error')
+    )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name=_('hash of the inputs of the reports')
+    )
+    # The worker has no request: the reports are generated in this
+    # language.
+    language = models.CharField(
+        max_length=10,
+        default=settings.LANGUAGE_CODE,
+        verbose_name=_('language of the reports')
+    )
+
+    objects = ReportJobManager()
+
+    def __str__(self):
+        return "ReportJob: {} ({})".format(self.delivery_date,
+                                           self.get_status_display())
+
+    @property
+    def is_finished(self):
+        return self.status in (REPORT_JOB_STATUS_DONE,
+                               REPORT_JOB_STATUS_FAILED)
+
+
+ReportCacheStats = collections.namedtuple(  # Use of the kept reports.
+    'ReportCacheStats',
+    ['hits',                        # Reports found with the same inputs
+     'misses',                      # Reports generated
+     'artifacts'])                  # Reports kept
+
+
+class ReportArtifactManager(models.Manager):
+
+    def latest_of(self, kind, delivery_date=None):
+        """The most recently used artifact of a kind of report.
+
+        Args:
+            kind : One of REPORT_KINDS.
+            delivery_date : A datetime.date object, or None for any date.
+
+        Returns:
+            A ReportArtifact object, or None if there is none.
+        """
+        artifacts = self.filter(kind=kind)
+        if delivery_date is not None:
+            artifacts = artifacts.filter(delivery_date=delivery_date)
+        return artifacts.order_by('-used_at', '-pk').first()
+
+    def cache_stats(self):
+        """How often the kept reports were found instead of generated.
+
+        Returns:
+            A dictionary {<kind>: <ReportCacheStats>, ...} with an item
+            per kind of report having artifacts.
+        """
+        stats = {}
+        for row in self.values('kind').annotate(
+                hits=models.Sum('hits'),
+                misses=models.Sum('misses'),
+                artifacts=models.Count('pk')).order_by('kind'):
+            stats[row['kind']] = ReportCacheStats(
+                hits=row['hits'],
+                misses=row['misses'],
+                artifacts=row['artifacts'])
+        return stats
+
+
+class ReportArtifact(models.Model):
+    """A generated PDF report, keyed by the hash of its inputs.
+
+    The files are managed by delivery.artifacts.
+    """
+
+    class Meta:
+        verbose_name = _('report artifact')
+        verbose_name_plural = _('report artifacts')
+        ordering = ['-used_at']
+        unique_together = ('kind', 'delivery_date', 'content_hash')
+
+    kind = models.CharField(
+        max_length=20,
+        choices=REPORT_KINDS,
+        verbose_name=_('kind of report')
+    )
+    delivery_date = models.DateField(
+        verbose_name=_('date of the delivery')
+    )
+    content_hash = models.CharField(
+        max_length=64,
+        verbose_name=_('hash of the inputs of the report')
+    )
+    path = models.CharField(
+        max_length=255,
+        verbose_name=_('path of the file in the report directory')
+    )
+    num_items = models.IntegerField(
+        default=0,
+        verbose_name=_('pages or labels')
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('created at')
+    )
+    used_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name=_('last used at')
+    )
+    hits = models.IntegerField(
+        default=0,
+        verbose_name=_('times found with the same inputs')
+    )
+    misses = models.IntegerField(
+        default=0,
+        verbose_name=_('times generated')
+    )
+
+    objects = ReportArtifactManager()
+
+    def __str__(self):
+        return "ReportArtifact: {} of {} ({})".format(
+            self.kind, self.delivery_date, self.content_hash[:12])
@@ -0,0 +1,2 @@
+# Starting point of the delivery routes: Santropol Roulant.
+DELIVERY_STARTING_POINT_LAT_LONG = (45.516564, -73.575145)
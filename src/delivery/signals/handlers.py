@@ -0,0 +1,139 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from member.models import (Client, Member, Client_option, Restriction,
+                           Client_avoid_ingredient, Route)
+from meal.models import (Component, Component_ingredient, Incompatibility,
+                         Ingredient, Menu, Menu_component, Restricted_item)
+from order.models import Order, Order_item
+from ..models import KitchenSnapshot
+
+
+# Keep the kitchen snapshots up to date: changes to an order or to the
+# requirements of a client only affect the kitchen items of this client,
+# changes to a menu affect all the clients of its date. The kitchen items
+# also contain the names of routes, components, ingredients and
+# restricted items, so renaming one affects the clients or the dates
+# that use it.
+
+
+@receiver(post_save, sender=Order,
+          dispatch_uid="post_save.kitchen_snapshot_order")
+@receiver(post_delete, sender=Order,
+          dispatch_uid="post_delete.kitchen_snapshot_order")
+def order_changed(sender, instance, **kwargs):
+    # The delivery date may have changed: mark all the snapshots.
+    KitchenSnapshot.objects.mark_dirty([instance.client_id])
+    KitchenSnapshot.objects.mark_dirty([instance.client_id],
+                                       instance.delivery_date)
+
+
+@receiver(post_save, sender=Order_item,
+          dispatch_uid="post_save.kitchen_snapshot_order_item")
+@receiver(post_delete, sender=Order_item,
+          dispatch_uid="post_delete.kitchen_snapshot_order_item")
+def order_item_changed(sender, instance, **kwargs):
+    order = Order.objects.filter(pk=instance.order_id).values(
+        'client_id', 'delivery_date').first()
+    if order is not None:
+        KitchenSnapshot.objects.mark_dirty([order['client_id']],
+                                           order['delivery_date'])
+
+
+@receiver(post_save, sender=Component_ingredient,
+          dispatch_uid="post_save.kitchen_snapshot_component_ingredient")
+@receiver(post_delete, sender=Component_ingredient,
+          dispatch_uid="post_delete.kitchen_snapshot_component_ingredient")
+def component_ingredient_changed(sender, instance, **kwargs):
+    if instance.date:
+        KitchenSnapshot.objects.invalidate(instance.date)
+
+
+@receiver(post_save, sender=Menu_component,
+          dispatch_uid="post_save.kitchen_snapshot_menu_component")
+@receiver(post_delete, sender=Menu_component,
+          dispatch_uid="post_delete.kitchen_snapshot_menu_component")
+def menu_component_changed(sender, instance, **kwargs):
+    menu_date = Menu.objects.filter(
+        pk=instance.menu_id).values_list('date', flat=True).first()
+    if menu_date is not None:
+        KitchenSnapshot.objects.invalidate(menu_date)
+
+
+@receiver(post_save, sender=Restriction,
+          dispatch_uid="post_save.kitchen_snapshot_restriction")
+@receiver(post_delete, sender=Restriction,
+          dispatch_uid="post_delete.kitchen_snapshot_restriction")
+@receiver(post_save, sender=Client_avoid_ingredient,
+          dispatch_uid="post_save.kitchen_snapshot_avoid_ingredient")
+@receiver(post_delete, sender=Client_avoid_ingredient,
+          dispatch_uid="post_delete.kitchen_snapshot_avoid_ingredient")
+@receiver(post_save, sender=Client_option,
+          dispatch_uid="post_save.kitchen_snapshot_client_option")
+@receiver(post_delete, sender=Client_option,
+          dispatch_uid="post_delete.kitchen_snapshot_client_option")
+@receiver(post_save, sender=Client,
+          dispatch_uid="post_save.kitchen_snapshot_client")
+def client_requirement_changed(sender, instance, **kwargs):
+    client_id = instance.pk if sender is Client else instance.client_id
+    KitchenSnapshot.objects.mark_dirty([client_id])
+
+
+@receiver(post_save, sender=Member,
+          dispatch_uid="post_save.kitchen_snapshot_member")
+def member_changed(sender, instance, **kwargs):
+    KitchenSnapshot.objects.mark_dirty(
+        Client.objects.filter(member=instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Incompatibility,
+          dispatch_uid="post_save.kitchen_snapshot_incompatibility")
+@receiver(post_delete, sender=Incompatibility,
+          dispatch_uid="post_delete.kitchen_snapshot_incompatibility")
+def incompatibility_changed(sender, instance, **kwargs):
+    KitchenSnapshot.objects.mark_dirty(
+        Restriction.objects.filter(
+            restricted_item_id=instance.restricted_item_id
+        ).values_list('client_id', flat=True))
+
+
+@receiver(post_save, sender=Route,
+          dispatch_uid="post_save.kitchen_snapshot_route")
+def route_changed(sender, instance, created, **kwargs):
+    if not created:
+        KitchenSnapshot.objects.mark_dirty(
+            Client.objects.filter(route=instance).values_list(
+                'pk', flat=True))
+
+
+@receiver(post_save, sender=Component,
+          dispatch_uid="post_save.kitchen_snapshot_component")
+def component_changed(sender, instance, created, **kwargs):
+    if not created:
+        for menu_date in set(Menu_component.objects.filter(
+                component=instance).values_list('menu__date', flat=True)):
+            KitchenSnapshot.objects.invalidate(menu_date)
+
+
+@receiver(post_save, sender=Ingredient,
+          dispatch_uid="post_save.kitchen_snapshot_ingredient")
+def ingredient_changed(sender, instance, created, **kwargs):
+    if not created:
+        # The clients avoiding the ingredient, and those having a
+        # restricted item incompatible with it.
+        KitchenSnapshot.objects.mark_dirty(
+            set(Client_avoid_ingredient.objects.filter(
+                ingredient=instance).values_list('client_id', flat=True)) |
+            set(Restriction.objects.filter(
+                restricted_item_id__in=Incompatibility.objects.filter(
+                    ingredient=instance).values('restricted_item_id')
+            ).values_list('client_id', flat=True)))
+
+
+@receiver(post_save, sender=Restricted_item,
+          dispatch_uid="post_save.kitchen_snapshot_restricted_item")
+def restricted_item_changed(sender, instance, created, **kwargs):
+    if not created:
+        KitchenSnapshot.objects.mark_dirty(
+            Restriction.objects.filter(
+                restricted_item=instance).values_list('client_id', flat=True))
@@ -1,7 +1,31 @@
+from array import array
 import itertools
+import time
+
+import numpy
+
+
+SQUARED_EUCLIDEAN = 'squared_euclidean'
+HAVERSINE = 'haversine'
+EQUIRECTANGULAR = 'equirectangular'
+
+EARTH_RADIUS_KM = 6371.0088  # mean Earth radius
+
+NEAREST_NEIGHBOUR = 'nearest_neighbour'
+GREEDY = 'greedy'
+SPACE_FILLING_CURVE = 'space_filling_curve'
+
+# Lengths of the segments relocated by Or-opt moves.
+OR_OPT_SEGMENT_LENGTHS = (1, 2, 3)
+
+# Or-opt and 3-opt moves must shorten the tour by more than this
+# fraction of its length, so that rounding errors cannot make the
+# search cycle between equivalent tours.
+RELATIVE_TOLERANCE = 1e-9
 
 
 class Node:
+    __slots__ = ('id', 'latitude', 'longitude')
 
     def __init__(self, id, latitude, longitude):
         self.id = id
@@ -17,12 +41,290 @@ class Node:
 
 
 class Solution:
+    __slots__ = ('tour', 'value')
 
     def __init__(self, tour, value):
         self.tour = tour
         self.value = value
 
 
+def squared_euclidean(lat1, lon1, lat2, lon2):
+    """Squared euclidean distances between coordinates, in degrees².
+
+    The arguments are NumPy arrays (or numbers) which are broadcast
+    together.
+    """
+    return (lat1 - lat2) ** 2 + (lon1 - lon2) ** 2
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distances between coordinates, in kilometres.
+
+    The arguments are NumPy arrays (or numbers) which are broadcast
+    together.
+
+    https://en.wikipedia.org/wiki/Haversine_formula
+    """
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    dlat = lat1 - lat2
+    dlon = numpy.radians(lon1) - numpy.radians(lon2)
+    h = (numpy.sin(dlat / 2.0) ** 2 +
+         numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS_KM * numpy.arcsin(
+        numpy.sqrt(numpy.clip(h, 0.0, 1.0)))
+
+
+def equirectangular(lat1, lon1, lat2, lon2):
+    """Distances between coordinates projected on a plane, in kilometres.
+
+    Cheaper than the haversine formula and accurate enough at the scale
+    of a city. The arguments are NumPy arrays (or numbers) which are
+    broadcast together.
+
+    https://en.wikipedia.org/wiki/Equirectangular_projection
+    """
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    x = ((numpy.radians(lon1) - numpy.radians(lon2)) *
+         numpy.cos((lat1 + lat2) / 2.0))
+    y = lat1 - lat2
+    return EARTH_RADIUS_KM * numpy.sqrt(x ** 2 + y ** 2)
+
+
+def squared_euclidean_matrix(latitudes, longitudes):
+    """Squared euclidean distances between coordinates, in degrees²."""
+    return squared_euclidean(
+        latitudes[:, numpy.newaxis], longitudes[:, numpy.newaxis],
+        latitudes[numpy.newaxis, :], longitudes[numpy.newaxis, :])
+
+
+def haversine_matrix(latitudes, longitudes):
+    """Great-circle distances between coordinates, in kilometres."""
+    return haversine(
+        latitudes[:, numpy.newaxis], longitudes[:, numpy.newaxis],
+        latitudes[numpy.newaxis, :], longitudes[numpy.newaxis, :])
+
+
+def equirectangular_matrix(latitudes, longitudes):
+    """Distances between coordinates projected on a plane, in kilometres."""
+    return equirectangular(
+        latitudes[:, numpy.newaxis], longitudes[:, numpy.newaxis],
+        latitudes[numpy.newaxis, :], longitudes[numpy.newaxis, :])
+
+
+METRICS = {
+    SQUARED_EUCLIDEAN: squared_euclidean_matrix,
+    HAVERSINE: haversine_matrix,
+    EQUIRECTANGULAR: equirectangular_matrix,
+}
+
+# Distances between pairs of coordinates, without the whole matrix.
+DISTANCES = {
+    SQUARED_EUCLIDEAN: squared_euclidean,
+    HAVERSINE: haversine,
+    EQUIRECTANGULAR: equirectangular,
+}
+
+
+class DistanceMatrix:
+    """Distances between every pair of nodes, computed once.
+
+    Nodes are referred to by their index in the list given to the
+    constructor: the solver only handles these indices and the
+    coordinates (latitudes and longitudes), the nodes themselves are
+    only used to return the solution.
+
+    Args:
+        nodes: List of nodes (Node).
+        metric: The name of one of the METRICS, or a callable taking
+            two NumPy arrays (latitudes and longitudes, in degrees) and
+            returning the square matrix of distances.
+    """
+
+    def __init__(self, nodes, metric=SQUARED_EUCLIDEAN):
+        self.nodes = list(nodes)
+        if callable(metric):
+            function = metric
+        else:
+            try:
+                function = METRICS[metric]
+            except KeyError:
+                raise ValueError("Unknown distance metric: {}".format(metric))
+        self.latitudes = numpy.array(
+            [node.latitude for node in self.nodes], dtype=float)
+        self.longitudes = numpy.array(
+            [node.longitude for node in self.nodes], dtype=float)
+        self.array = numpy.ascontiguousarray(
+            function(self.latitudes, self.longitudes), dtype=float)
+        # Indexing arrays of the standard library is much faster than
+        # indexing a NumPy array one element at a time in the solver
+        # loops, and they take a third of the memory of nested lists.
+        self.rows = [array('d', row.tobytes()) for row in self.array]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def distance(self, i, j):
+        return self.rows[i][j]
+
+    def tour_distance(self, indices):
+        """Distance of a tour given as node indices, including the return
+        to the starting point."""
+        indices = list(indices)
+        rows = self.rows
+        return sum(rows[a][b] for a, b in pairwise(indices + indices[:1]))
+
+
+def nearest_neighbour_tour(matrix):
+    """Builds a tour by always going to the closest unvisited node.
+
+    Args:
+        matrix: A DistanceMatrix.
+
+    Returns:
+        A list of node indices starting with 0.
+    """
+    n = len(matrix)
+    if n == 0:
+        return []
+    visited = numpy.zeros(n, dtype=bool)
+    visited[0] = True
+    order = [0]
+    for _ in range(n - 1):
+        row = numpy.where(visited, numpy.inf, matrix.array[order[-1]])
+        closest = int(numpy.argmin(row))
+        visited[closest] = True
+        order.append(closest)
+    return order
+
+
+def greedy_tour(matrix):
+    """Builds a tour by adding the shortest edges first.
+
+    An edge is added if both its nodes have less than two edges and if
+    it does not close a cycle before all nodes are connected.
+
+    https://en.wikipedia.org/wiki/Greedy_algorithm
+
+    Args:
+        matrix: A DistanceMatrix.
+
+    Returns:
+        A list of node indices starting with 0.
+    """
+    n = len(matrix)
+    if n < 3:
+        return list(range(n))
+
+    # The fragment (path) a node belongs to, see union-find.
+    fragment = list(range(n))
+
+    def find(i):
+        while fragment[i] != i:
+            fragment[i] = fragment[fragment[i]]
+            i = fragment[i]
+        return i
+
+    neighbours = [[] for _ in range(n)]
+    rows, columns = numpy.triu_indices(n, 1)
+    edges = numpy.argsort(matrix.array[rows, columns], kind='mergesort')
+    added = 0
+    for edge in edges.tolist():
+        a = int(rows[edge])
+        b = int(columns[edge])
+        if len(neighbours[a]) == 2 or len(neighbours[b]) == 2:
+            continue
+        root_a = find(a)
+        root_b = find(b)
+        if root_a == root_b:
+            continue
+        fragment[root_a] = root_b
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+        added += 1
+        if added == n - 1:
+            break
+
+    # Walk along the Hamiltonian path from one of its ends, then
+    # rotate it so that the tour starts with the first node.
+    current = next(i for i in range(n) if len(neighbours[i]) < 2)
+    previous = None
+    path = []
+    for _ in range(n):
+        path.append(current)
+        following = [i for i in neighbours[current] if i != previous]
+        previous, current = current, (following[0] if following else None)
+    start = path.index(0)
+    return path[start:] + path[:start]
+
+
+def hilbert_index(x, y, order):
+    """Position of the cell (x, y) along a Hilbert curve.
+
+    https://en.wikipedia.org/wiki/Hilbert_curve
+
+    Args:
+        x, y: Integers between 0 and 2 ** order - 1.
+        order: The order of the curve.
+    """
+    index = 0
+    side = 1 << order
+    s = side >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = side - 1 - x
+                y = side - 1 - y
+            x, y = y, x
+        s >>= 1
+    return index
+
+
+def space_filling_curve_tour(matrix, order=16):
+    """Builds a tour visiting the nodes along a Hilbert curve.
+
+    Very fast, and nodes close to each other on the map end up close
+    to each other in the tour.
+
+    Args:
+        matrix: A DistanceMatrix.
+        order: The order of the Hilbert curve covering the nodes.
+
+    Returns:
+        A list of node indices starting with 0.
+    """
+    n = len(matrix)
+    if n == 0:
+        return []
+    side = (1 << order) - 1
+
+    def scale(values):
+        low = values.min()
+        extent = values.max() - low
+        if extent == 0:
+            return numpy.zeros(len(values), dtype=int)
+        return ((values - low) / extent * side).astype(int)
+
+    xs = scale(matrix.longitudes).tolist()
+    ys = scale(matrix.latitudes).tolist()
+    path = sorted(range(n),
+                  key=lambda i: hilbert_index(xs[i], ys[i], order))
+    start = path.index(0)
+    return path[start:] + path[:start]
+
+
+CONSTRUCTIONS = {
+    NEAREST_NEIGHBOUR: nearest_neighbour_tour,
+    GREEDY: greedy_tour,
+    SPACE_FILLING_CURVE: space_filling_curve_tour,
+}
+
+
 def pairwise(iterable):
     """s -> (s0,s1), (s1,s2), (s2, s3), ...
     Source:
@@ -38,7 +340,8 @@ def reverse_subtour(tour, start, end):
     return tour[:start] + list(reversed(tour[start:end + 1])) + tour[end + 1:]
 
 
-def solve(tour):
+def solve(tour, metric=SQUARED_EUCLIDEAN, time_limit_ms=None,
+          construction=None):
     """Solves the Traveling Salesman Problem (TSP) with a heuristic.
 
     Args:
@@ -46,16 +349,340 @@ def solve(tour):
             starts and ends at the same node, the last node in the
             list must be the last destination visited before returning
             to the starting point.
+        metric: The distance metric, see DistanceMatrix.
+        time_limit_ms: If given, the search stops after about this many
+            milliseconds and returns the best tour found so far.
+        construction: The name of one of the CONSTRUCTIONS, or a
+            callable taking a DistanceMatrix and returning a list of
+            node indices starting with 0. If given, the search starts
+            from the tour it builds, unless the initial tour is shorter.
 
     Returns:
         A tour with a distance less or equal to the distance of the
         initial tour.
 
     """
+    deadline = None
+    if time_limit_ms is not None:
+        deadline = time.perf_counter() + time_limit_ms / 1000.0
+
+    matrix = DistanceMatrix(tour, metric)
+    order = array('i', range(len(matrix)))
+    if construction is not None:
+        if not callable(construction):
+            try:
+                construction = CONSTRUCTIONS[construction]
+            except KeyError:
+                raise ValueError(
+                    "Unknown construction heuristic: {}".format(construction))
+        constructed = array('i', construction(matrix))
+        if matrix.tour_distance(constructed) < matrix.tour_distance(order):
+            order = constructed
+    local_search(order, matrix.rows, deadline)
+    return [matrix.nodes[i] for i in order]
+
+
+def local_search(order, dist, deadline=None):
+    """Improves a tour in place until it is a local optimum.
+
+    The tour is first improved with 2-opt moves. When none of them
+    improves it, Or-opt moves and then 3-opt moves are tried, going
+    back to 2-opt after each improvement. The first node of the tour
+    never moves.
+
+    Args:
+        order: Node indices representing a tour, as a list or an array
+            of integers.
+        dist: Distances between nodes, as rows of a matrix (see
+            DistanceMatrix.rows).
+        deadline: A time.perf_counter() value after which the search
+            stops, or None to search until a local optimum is reached.
+    """
+    length = sum(dist[a][b] for a, b in pairwise(order + order[:1]))
+    tolerance = RELATIVE_TOLERANCE * length
+
+    while not time_is_up(deadline):
+        if two_opt_move(order, dist, deadline):
+            continue
+        if or_opt_move(order, dist, tolerance, deadline):
+            continue
+        if three_opt_move(order, dist, tolerance, deadline):
+            continue
+        break
+
+
+def time_is_up(deadline):
+    return deadline is not None and time.perf_counter() >= deadline
+
+
+def two_opt_move(order, dist, deadline=None):
+    """Applies the best 2-opt move to a tour.
+
+    Reversing order[i:j + 1] only replaces the edges (order[i - 1],
+    order[i]) and (order[j], order[j + 1]) with (order[i - 1],
+    order[j]) and (order[i], order[j + 1]), so the gain of every
+    neighbor is computed in constant time and the tour is only
+    modified when the best move is applied.
+
+    https://en.wikipedia.org/wiki/2-opt
+
+    Returns:
+        True if the tour has been improved.
+    """
+    n = len(order)
+    best_delta = 0
+    best_move = None
+
+    for start in range(1, n - 1):
+        if time_is_up(deadline):
+            break
+        a = order[start - 1]
+        b = order[start]
+        dist_a = dist[a]
+        dist_b = dist[b]
+        ab = dist_a[b]
+        for end in range(start + 1, n):
+            c = order[end]
+            d = order[(end + 1) % n]
+            delta = (dist_a[c] - ab) + (dist_b[d] - dist[c][d])
+            if delta < best_delta:
+                best_delta = delta
+                best_move = (start, end)
+
+    if best_move is None:
+        return False
+    start, end = best_move
+    order[start:end + 1] = order[start:end + 1][::-1]
+    return True
+
+
+def or_opt_move(order, dist, tolerance=0, deadline=None):
+    """Applies the first improving Or-opt move to a tour.
+
+    An Or-opt move relocates a segment of a few consecutive nodes
+    between two other adjacent nodes, in either direction.
+
+    Returns:
+        True if the tour has been improved.
+    """
+    n = len(order)
+    for length in OR_OPT_SEGMENT_LENGTHS:
+        for start in range(1, n - length + 1):
+            if time_is_up(deadline):
+                return False
+            end = start + length - 1
+            first = order[start]
+            last = order[end]
+            before = order[start - 1]
+            after = order[(end + 1) % n]
+            # What we save by removing the segment from its position
+            gain = (dist[before][first] + dist[last][after] -
+                    dist[before][after])
+            if gain <= tolerance:
+                continue
+            dist_first = dist[first]
+            dist_last = dist[last]
+            for k in range(n):
+                if start - 1 <= k <= end:
+                    # The edge (order[k], order[k + 1]) touches the segment
+                    continue
+                x = order[k]
+                y = order[(k + 1) % n]
+                xy = dist[x][y]
+                forward = dist[x][first] + dist_last[y] - xy
+                backward = dist[x][last] + dist_first[y] - xy
+                if min(forward, backward) - gain < -tolerance:
+                    segment = order[start:end + 1]
+                    if backward < forward:
+                        segment.reverse()
+                    del order[start:end + 1]
+                    position = k + 1 if k < start else k + 1 - length
+                    order[position:position] = segment
+                    return True
+    return False
+
+
+def three_opt_move(order, dist, tolerance=0, deadline=None):
+    """Applies the first improving 3-opt move to a tour.
+
+    The move removes three edges, splitting the tour after the fixed
+    part into two consecutive segments s1 = order[i:j + 1] and
+    s2 = order[j + 1:k + 1], and reconnects them in one of the four
+    ways that replace all three edges: s2 s1, s2 reversed(s1),
+    reversed(s2) s1 and reversed(s1) reversed(s2).
+
+    https://en.wikipedia.org/wiki/3-opt
+
+    Returns:
+        True if the tour has been improved.
+    """
+    n = len(order)
+    for i in range(1, n - 1):
+        if time_is_up(deadline):
+            return False
+        p = order[i - 1]
+        s1a = order[i]
+        dist_p = dist[p]
+        dist_s1a = dist[s1a]
+        removed_p = dist_p[s1a]
+        for j in range(i, n - 1):
+            s1b = order[j]
+            s2a = order[j + 1]
+            dist_s1b = dist[s1b]
+            dist_s2a = dist[s2a]
+            removed_ps = removed_p + dist_s1b[s2a]
+            for k in range(j + 1, n):
+                s2b = order[k]
+                q = order[(k + 1) % n]
+                dist_s2b = dist[s2b]
+                removed = removed_ps + dist_s2b[q]
+                added = (
+                    dist_p[s2a] + dist_s2b[s1a] + dist_s1b[q],
+                    dist_p[s2a] + dist_s2b[s1b] + dist_s1a[q],
+                    dist_p[s2b] + dist_s2a[s1a] + dist_s1b[q],
+                    dist_p[s1b] + dist_s1a[s2b] + dist_s2a[q],
+                )
+                best = min(added)
+                if best - removed < -tolerance:
+                    s1 = order[i:j + 1]
+                    s2 = order[j + 1:k + 1]
+                    case = added.index(best)
+                    if case == 0:
+                        order[i:k + 1] = s2 + s1
+                    elif case == 1:
+                        order[i:k + 1] = s2 + s1[::-1]
+                    elif case == 2:
+                        order[i:k + 1] = s2[::-1] + s1
+                    else:
+                        order[i:k + 1] = s1[::-1] + s2[::-1]
+                    return True
+    return False
+
+
+def pair_distances(metric, lat1, lon1, lat2, lon2):
+    """Distances between pairs of coordinates, without the whole matrix.
+
+    Args:
+        metric: The distance metric, see DistanceMatrix.
+        lat1, lon1, lat2, lon2: NumPy arrays (or numbers) which are
+            broadcast together.
+
+    Returns:
+        A NumPy array of distances.
+    """
+    if not callable(metric):
+        try:
+            return DISTANCES[metric](lat1, lon1, lat2, lon2)
+        except KeyError:
+            raise ValueError("Unknown distance metric: {}".format(metric))
+    # A custom metric only computes matrices: use one per pair.
+    coordinates = numpy.broadcast_arrays(
+        *[numpy.asarray(values, dtype=float)
+          for values in (lat1, lon1, lat2, lon2)])
+    return numpy.array([
+        metric(numpy.array([a, c]), numpy.array([b, d]))[0][1]
+        for a, b, c, d in zip(*[values.ravel() for values in coordinates])
+    ]).reshape(coordinates[0].shape)
+
+
+def insert_node(tour, node, metric=SQUARED_EUCLIDEAN):
+    """Inserts a node where it lengthens the tour the least.
+
+    This is the cheapest insertion, in O(n): the tour is not solved
+    again.
+
+    Args:
+        tour: List of nodes (Node). The first node is the starting
+            point and stays first.
+        node: The node to insert.
+        metric: The distance metric, see DistanceMatrix.
+
+    Returns:
+        A new tour.
+    """
+    if not tour:
+        return [node]
+    latitudes = numpy.array([n.latitude for n in tour], dtype=float)
+    longitudes = numpy.array([n.longitude for n in tour], dtype=float)
+    next_latitudes = numpy.roll(latitudes, -1)
+    next_longitudes = numpy.roll(longitudes, -1)
+    added = (
+        pair_distances(metric, latitudes, longitudes,
+                       node.latitude, node.longitude) +
+        pair_distances(metric, node.latitude, node.longitude,
+                       next_latitudes, next_longitudes) -
+        pair_distances(metric, latitudes, longitudes,
+                       next_latitudes, next_longitudes))
+    position = int(numpy.argmin(added)) + 1
+    return tour[:position] + [node] + tour[position:]
+
+
+def remove_node(tour, position, metric=SQUARED_EUCLIDEAN):
+    """Removes a node and repairs the tour around the gap, in O(n).
+
+    The nodes before and after the removed one become neighbours. The
+    best 2-opt move replacing this new edge is then applied, if it
+    shortens the tour.
+
+    Args:
+        tour: List of nodes (Node). The first node is the starting
+            point and stays first.
+        position: The index of the node to remove in the tour.
+        metric: The distance metric, see DistanceMatrix.
 
-    # This function implements a local search heuristic with a 2-opt
-    # neighborhood to solve an Euclidean TSP.
+    Returns:
+        A new tour.
 
+    Raises:
+        ValueError: The position is the one of the starting point.
+    """
+    if position == 0:
+        raise ValueError("The starting point cannot be removed.")
+    tour = tour[:position] + tour[position + 1:]
+    n = len(tour)
+    if n < 4:
+        return tour
+    # The new edge goes from a = tour[i] to b = tour[i + 1], or to the
+    # starting point if the last node was removed.
+    i = position - 1
+    latitudes = numpy.array([node.latitude for node in tour], dtype=float)
+    longitudes = numpy.array([node.longitude for node in tour], dtype=float)
+    next_latitudes = numpy.roll(latitudes, -1)
+    next_longitudes = numpy.roll(longitudes, -1)
+    edges = pair_distances(metric, latitudes, longitudes,
+                           next_latitudes, next_longitudes)
+    # Replacing the edges (a, b) and (c, d) = (tour[j], tour[j + 1])
+    # with (a, c) and (b, d).
+    delta = (
+        pair_distances(metric, latitudes[i], longitudes[i],
+                       latitudes, longitudes) +
+        pair_distances(metric, next_latitudes[i], next_longitudes[i],
+                       next_latitudes, next_longitudes) -
+        edges[i] - edges)
+    delta[[i - 1, i, (i + 1) % n]] = numpy.inf
+    j = int(numpy.argmin(delta))
+    if delta[j] >= -RELATIVE_TOLERANCE * edges.sum():
+        return tour
+    if j > i:
+        return reverse_subtour(tour, i + 1, j)
+    return reverse_subtour(tour, j + 1, i)
+
+
+def solve_exhaustive(tour):
+    """Solves the TSP by re-evaluating every 2-opt neighbor in full.
+
+    This is the original implementation of `solve`, kept as a reference
+    for tests and benchmarks. Each pass copies and measures every
+    neighbor, so it should not be used on real routes.
+
+    Args:
+        tour: List of nodes (Node) representing a tour.
+
+    Returns:
+        A tour with a distance less or equal to the distance of the
+        initial tour.
+
+    """
     best_solution = Solution(list(tour), tour_squared_distance(tour))
 
     improved = True
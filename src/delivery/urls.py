@@ -2,9 +2,13 @@ from django.conf.urls import url
 from django.utils.translation import ugettext_lazy as _
 
 from delivery.views import (Orderlist, MealInformation, RoutesInformation,
-                            KitchenCount, MealLabels, DeliveryRouteSheet,
+                            KitchenCount, KitchenCountRange, MealLabels,
+                            DeliveryRouteSheet,
                             RefreshOrderView, CreateDeliveryOfToday,
-                            EditDeliveryOfToday)
+                            EditDeliveryOfToday, OptimiseDeliveriesOfToday,
+                            InsertClientInDeliveryOfToday,
+                            RemoveClientFromDeliveryOfToday,
+                            ReportJobStatus)
 
 app_name = "delivery"
 
@@ -13,13 +17,25 @@ urlpatterns = [
     url(_(r'^meal/$'), MealInformation.as_view(), name='meal'),
     url(_(r'^meal/(?P<id>\d+)/$'), MealInformation.as_view(), name='meal_id'),
     url(_(r'^routes/$'), RoutesInformation.as_view(), name='routes'),
+    url(_(r'^routes/optimise/$'),
+        OptimiseDeliveriesOfToday.as_view(), name='optimise_routes'),
     url(_(r'^route/(?P<pk>\d+)/$'),
         EditDeliveryOfToday.as_view(), name='edit_delivery_of_today'),
     url(_(r'^route/(?P<pk>\d+)/create/$'),
         CreateDeliveryOfToday.as_view(), name='create_delivery_of_today'),
+    url(_(r'^route/(?P<pk>\d+)/insert/(?P<client_pk>\d+)/$'),
+        InsertClientInDeliveryOfToday.as_view(),
+        name='insert_client_in_delivery_of_today'),
+    url(_(r'^route/(?P<pk>\d+)/remove/(?P<client_pk>\d+)/$'),
+        RemoveClientFromDeliveryOfToday.as_view(),
+        name='remove_client_from_delivery_of_today'),
     url(_(r'^kitchen_count/$'), KitchenCount.as_view(), name='kitchen_count'),
     url(_(r'^kitchen_count/(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d+)/$'),
         KitchenCount.as_view(), name='kitchen_count_date'),
+    url(_(r'^kitchen_count/range/$'),
+        KitchenCountRange.as_view(), name='kitchen_count_range'),
+    url(_(r'^report_job/(?P<pk>\d+)/$'),
+        ReportJobStatus.as_view(), name='report_job'),
     url(_(r'^viewDownloadKitchenCount/$'),
         KitchenCount.as_view(), name='downloadKitchenCount'),
     url(_(r'^viewMealLabels/$'), MealLabels.as_view(), name='mealLabels'),
@@ -1,6 +1,12 @@
 import collections
+from concurrent.futures import ProcessPoolExecutor
+import csv
 import datetime
 from datetime import date
+import functools
+import hashlib
+import io
+import itertools
 import json
 import os
 import textwrap
@@ -15,7 +21,7 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
 from django.utils.decorators import method_decorator
-from django.utils.translation import ugettext
+from django.utils.translation import get_language, ugettext
 from django.utils.translation import ugettext_lazy as _
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
@@ -24,10 +30,13 @@ from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.http import JsonResponse
 from django.urls import reverse_lazy, reverse
 from django.contrib.admin.models import LogEntry, ADDITION
+from django.db import connections
+from django.db.models import Q
 from django.db.models.functions import Lower
 from django_filters.views import FilterView
 
 import labels  # package pylabels
+import pdfrw
 
 from reportlab.graphics import shapes as rl_shapes
 from reportlab.lib import (
@@ -55,17 +64,18 @@ from meal.models import (
 from member.models import Client, Route, ROUTE_VEHICLES, DeliveryHistory
 from order.models import (
     Order, component_group_sorting, SIZE_CHOICES_REGULAR, SIZE_CHOICES_LARGE)
-from .models import Delivery
+from .models import (
+    Delivery, KitchenSnapshot, ReportArtifact, ReportJob, RouteOptimisation,
+    REPORT_JOB_KIND_ROUTES, REPORT_KIND_KITCHEN_COUNT, REPORT_KIND_LABELS,
+    REPORT_KIND_ROUTE_SHEETS)
 from .filters import KitchenCountOrderFilter
-from .forms import DishIngredientsForm
-from . import tsp
+from .forms import DishIngredientsForm, KitchenCountRangeForm
+from . import artifacts, jobs, tsp, vrp
+from .settings import DELIVERY_STARTING_POINT_LAT_LONG
 
-MEAL_LABELS_FILE = os.path.join(settings.BASE_DIR, "meal_labels.pdf")
-KITCHEN_COUNT_FILE = os.path.join(settings.BASE_DIR, "kitchen_count.pdf")
-ROUTE_SHEETS_FILE = os.path.join(settings.BASE_DIR, "route_sheets.pdf")
 LOGO_IMAGE = os.path.join(settings.BASE_DIR,
                           "160widthSR-Logo-Screen-PurpleGreen-HI-RGB1.jpg")
-DELIVERY_STARTING_POINT_LAT_LONG = (45.516564, -73.575145)  # Santropol Roulant
+ROUTE_OPTIMISATION_TIME_LIMIT_MS = 500  # time budget of the route optimiser
 
 
 class Orderlist(LoginRequiredMixin, PermissionRequiredMixin, FilterView):
@@ -328,16 +338,16 @@ class RoutesInformation(
                     'summary_lines': summary_lines,
                     'detail_lines': detail_lines
                 }
-            # generate PDF report
-            MultiRouteReport.routes_make_pages(routes_dict)
-            try:
-                f = open(ROUTE_SHEETS_FILE, "rb")
-            except:
-                raise Http404("File " + ROUTE_SHEETS_FILE + " does not exist")
-            response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = \
-                'attachment; filename="routesheets{}.pdf"'. \
-                format(datetime.date.today().strftime("%Y%m%d"))
+            # generate PDF report, unless it was generated from the
+            # same routes; the date of the day is printed on it
+            artifact = artifacts.get_or_generate(
+                REPORT_KIND_ROUTE_SHEETS, today.date(),
+                (today.date(), MultiRouteReport.routes_inputs(routes_dict)),
+                lambda path: MultiRouteReport.routes_make_pages(
+                    routes_dict, path))
+            if artifact is None:
+                raise Http404
+            response = artifacts.file_response(artifact)
             # add serializable data in response header to be used in unit tests
             routes_dict_fortest = {}
             for key, item in routes_dict.items():
@@ -347,9 +357,6 @@ class RoutesInformation(
                                      for client in item['detail_lines']],
                 }
             response['routes_dict'] = json.dumps(routes_dict_fortest)
-            #
-            response.write(f.read())
-            f.close()
             return response
 
 
@@ -421,6 +428,71 @@ class EditDeliveryOfToday(
         return response
 
 
+class InsertClientInDeliveryOfToday(
+        LoginRequiredMixin, PermissionRequiredMixin, generic.View):
+    """Inserts a client at the cheapest position of today's delivery."""
+    permission_required = 'sous_chef.edit'
+
+    def post(self, request, *args, **kwargs):
+        delivery_history = get_object_or_404(
+            DeliveryHistory.objects.select_related('route'),
+            route=self.kwargs.get('pk'),
+            date=timezone.datetime.today()
+        )
+        client = get_object_or_404(
+            Client.objects.select_related('member__address'),
+            pk=self.kwargs.get('client_pk'))
+        try:
+            vrp.insert_client(delivery_history, client)
+        except ValueError:
+            messages.add_message(
+                request, messages.ERROR,
+                _("The client %(client)s is not geolocalized.") % {
+                    'client': client.member
+                }
+            )
+        else:
+            messages.add_message(
+                request, messages.SUCCESS,
+                _("The client %(client)s has been added to today's "
+                  "delivery on route %(route_name)s.") % {
+                    'client': client.member,
+                    'route_name': delivery_history.route.name
+                }
+            )
+        return HttpResponseRedirect(reverse_lazy(
+            'delivery:edit_delivery_of_today',
+            args=[delivery_history.route.pk]))
+
+
+class RemoveClientFromDeliveryOfToday(
+        LoginRequiredMixin, PermissionRequiredMixin, generic.View):
+    """Removes a client from today's delivery and repairs the sequence."""
+    permission_required = 'sous_chef.edit'
+
+    def post(self, request, *args, **kwargs):
+        delivery_history = get_object_or_404(
+            DeliveryHistory.objects.select_related('route'),
+            route=self.kwargs.get('pk'),
+            date=timezone.datetime.today()
+        )
+        try:
+            vrp.remove_client(delivery_history,
+                              int(self.kwargs.get('client_pk')))
+        except ValueError:
+            raise Http404
+        messages.add_message(
+            request, messages.SUCCESS,
+            _("The client has been removed from today's delivery on route "
+              "%(route_name)s.") % {
+                'route_name': delivery_history.route.name
+            }
+        )
+        return HttpResponseRedirect(reverse_lazy(
+            'delivery:edit_delivery_of_today',
+            args=[delivery_history.route.pk]))
+
+
 # Route sheet report classes and functions.
 
 def defineStyles(my_styles):
@@ -575,7 +647,26 @@ class MultiRouteReport(object):
                 MultiRouteReport.route_start_page = self.page + 1
 
     # static method
-    def routes_make_pages(routes_dict):
+    def routes_inputs(routes_dict):
+        """The content of the route sheets, to be hashed.
+
+        See delivery.artifacts.content_hash. The routes are kept in the
+        order of their sheets, and only the names of the Route objects
+        are printed.
+
+        Args:
+            routes_dict : See routes_make_pages.
+
+        Returns:
+            A list of tuples (route id, route name, summary lines,
+            detail lines).
+        """
+        return [(route_id, route['route'].name,
+                 route['summary_lines'], route['detail_lines'])
+                for route_id, route in routes_dict.items()]
+
+    # static method
+    def routes_make_pages(routes_dict, route_sheets_file):
         """Generate the route sheets pages as a PDF file.
 
         Ensures that a new route starts on the front side of a sheet,
@@ -592,6 +683,7 @@ class MultiRouteReport(object):
                 'detail_lines' : A list of DeliveryClient objects
                                  (see order/models.py),
                                  sorted according to delivery history sequence.
+            route_sheets_file : The name of the PDF file.
 
         Returns:
             An integer : The number of pages generated.
@@ -662,7 +754,7 @@ class MultiRouteReport(object):
                 An integer : The number of pages generated.
             """
             doc = MultiRouteReport.RLMultiRouteDocTemplate(
-                ROUTE_SHEETS_FILE,
+                route_sheets_file,
                 leftMargin=0.5 * rl_inch,
                 rightMargin=0.5 * rl_inch,
                 bottomMargin=0.5 * rl_inch,
@@ -796,17 +888,7 @@ class KitchenCount(
     def get(self, request, *args, **kwargs):
         if reverse('delivery:downloadKitchenCount') in request.path:
             # download kitchen count report as PDF
-            try:
-                f = open(KITCHEN_COUNT_FILE, "rb")
-            except:
-                raise Http404("File " + KITCHEN_COUNT_FILE + " does not exist")
-            response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = \
-                'attachment; filename="kitchencount{}.pdf"'. \
-                format(datetime.date.today().strftime("%Y%m%d"))
-            response.write(f.read())
-            f.close()
-            return response
+            return download_report(request, REPORT_KIND_KITCHEN_COUNT)
         else:
             # Display kitchen count report for given delivery date
             #   or for today by default; generate meal labels
@@ -817,41 +899,117 @@ class KitchenCount(
             else:
                 date = datetime.date.today()
 
-            kitchen_list_unfiltered = Order.get_kitchen_items(date)
-
-            # filter out route=None clients and not geolocalized clients
-            kitchen_list = {}
-            geolocalized_client_ids = list(Client.objects.filter(
-                pk__in=kitchen_list_unfiltered.keys(),
-                member__address__latitude__isnull=False,
-                member__address__longitude__isnull=False
-            ).values_list('pk', flat=True))
-
-            for client_id, kitchen_item in kitchen_list_unfiltered.items():
-                if kitchen_item.routename is not None \
-                   and client_id in geolocalized_client_ids:
-                    kitchen_list[client_id] = kitchen_item
-
+            kitchen_list = kcr_kitchen_list(date)
             component_lines, meal_lines = kcr_make_lines(kitchen_list, date)
             if component_lines:
-                # we have orders today
-                num_pages = kcr_make_pages(     # kitchen count as PDF
-                    date,
-                    component_lines,                    # summary
-                    meal_lines)                         # detail
-                num_labels = kcr_make_labels(   # meal labels as PDF
-                    kitchen_list,                       # KitchenItems
-                    component_lines[0].name,            # main dish name
-                    component_lines[0].ingredients)     # main dish ingredients
+                # we have orders today: the PDF files are generated in
+                # the background, the page polls the status of the job
+                language = get_language()
+                job = jobs.enqueue(date, artifacts.content_hash(
+                    date, datetime.date.today(), language,
+                    component_lines, meal_lines,
+                    sorted(kitchen_list.items())), language)
             else:
                 # no orders today
-                num_pages = 0
-                num_labels = 0
+                job = None
             return render(request, 'kitchen_count.html',
                           {'component_lines': component_lines,
                            'meal_lines': meal_lines,
-                           'num_pages': num_pages,
-                           'num_labels': num_labels})
+                           'job': job})
+
+
+class ReportJobStatus(
+        LoginRequiredMixin, PermissionRequiredMixin, generic.View):
+    permission_required = 'sous_chef.read'
+
+    def get(self, request, pk):
+        job = get_object_or_404(ReportJob, pk=pk)
+        return JsonResponse({
+            'status': job.status,
+            'status_display': job.get_status_display(),
+            'finished': job.is_finished,
+            'num_pages': job.num_pages,
+            'num_labels': job.num_labels,
+        })
+
+
+def download_report(request, kind):
+    """Download the latest PDF report of a kind.
+
+    Args:
+        request : The request. Its optional `date` parameter (YYYY-MM-DD)
+            gives the delivery date of the report, the latest report
+            of any date is downloaded otherwise.
+        kind : One of REPORT_KINDS.
+    """
+    delivery_date = None
+    if request.GET.get('date'):
+        try:
+            delivery_date = datetime.datetime.strptime(
+                request.GET['date'], '%Y-%m-%d').date()
+        except ValueError:
+            raise Http404("Invalid date " + request.GET['date'])
+    artifact = ReportArtifact.objects.latest_of(kind, delivery_date)
+    if artifact is None:
+        raise Http404("No report was generated")
+    return artifacts.file_response(artifact)
+
+
+def kcr_kitchen_list(date):
+    """The KitchenItems of the clients that are delivered on a date.
+
+    Args:
+        date : A date.datetime object giving the delivery date.
+
+    Returns:
+        A dictionary of KitchenItem objects, see Order.get_kitchen_items.
+    """
+    return kcr_deliverable_items({
+        date: KitchenSnapshot.objects.get_kitchen_items(date)
+    })[date]
+
+
+def kcr_make_reports(date, workers=None):
+    """Generate the kitchen count report and the meal labels as PDF files.
+
+    This is run in the background, see delivery.jobs. The reports are
+    only generated again when their content has changed, see
+    delivery.artifacts.
+
+    Args:
+        date : A date.datetime object giving the delivery date.
+        workers : The number of processes rendering the meal labels, see
+            kcr_make_labels.
+
+    Returns:
+        A tuple (number of pages of the kitchen count, number of labels).
+    """
+    kitchen_list = kcr_kitchen_list(date)
+    component_lines, meal_lines = kcr_make_lines(kitchen_list, date)
+    if not component_lines:
+        # no orders today
+        return 0, 0
+    # the date of the day is printed on the kitchen count
+    kitchen_count = artifacts.get_or_generate(  # kitchen count as PDF
+        REPORT_KIND_KITCHEN_COUNT, date,
+        (date, datetime.date.today(), component_lines, meal_lines),
+        lambda path: kcr_make_pages(
+            date,
+            component_lines,                    # summary
+            meal_lines,                         # detail
+            path))
+    labels = artifacts.get_or_generate(  # meal labels as PDF
+        REPORT_KIND_LABELS, date,
+        (date, get_language(), sorted(kitchen_list.items()),
+         component_lines[0].name, component_lines[0].ingredients),
+        lambda path: kcr_make_labels(
+            kitchen_list,                       # KitchenItems
+            component_lines[0].name,            # main dish name
+            component_lines[0].ingredients,     # main dish ingredients
+            path,
+            workers))
+    return (kitchen_count.num_items if kitchen_count else 0,
+            labels.num_items if labels else 0)
 
 
 component_line_fields = [          # Component summary Line on Kitchen Count.
@@ -865,6 +1023,54 @@ ComponentLine = collections.namedtuple(
     'ComponentLine', component_line_fields[0::2])
 
 
+def kcr_deliverable_items(kitchen_lists):
+    """Filter out route=None clients and not geolocalized clients.
+
+    Args:
+        kitchen_lists : A dictionary {date: kitchen_list, ...} where each
+            kitchen_list is a dictionary of KitchenItem objects (see
+            Order.get_kitchen_items).
+
+    Returns:
+        A dictionary of the same shape containing only the KitchenItems
+        of the clients that can be delivered.
+    """
+    client_ids = set()
+    for kitchen_list in kitchen_lists.values():
+        client_ids.update(kitchen_list.keys())
+    geolocalized_client_ids = set(Client.objects.filter(
+        pk__in=client_ids,
+        member__address__latitude__isnull=False,
+        member__address__longitude__isnull=False
+    ).values_list('pk', flat=True))
+
+    deliverable = collections.OrderedDict()
+    for delivery_date, kitchen_list in kitchen_lists.items():
+        deliverable[delivery_date] = {
+            client_id: kitchen_item
+            for client_id, kitchen_item in kitchen_list.items()
+            if kitchen_item.routename is not None and
+            client_id in geolocalized_client_ids}
+    return deliverable
+
+
+class ComponentLineBuilder:
+    """A ComponentLine being summed up, see kcr_make_lines."""
+    __slots__ = ComponentLine._fields
+
+    def __init__(self, component_group):
+        self.component_group = component_group
+        self.rqty = 0
+        self.lqty = 0
+        self.name = ''
+        self.ingredients = ''
+
+    def freeze(self):
+        """Returns the ComponentLine named tuple."""
+        return ComponentLine(*(getattr(self, field)
+                               for field in ComponentLine._fields))
+
+
 meal_line_fields = [               # Special Meal Line on Kitchen Count.
     # field name       default value
     'client', '',     # String : Lastname and abbreviated first name
@@ -949,39 +1155,31 @@ def kcr_make_lines(kitchen_list, date):
     for k, item in kitchen_list.items():
         for component_group, meal_component \
                 in item.meal_components.items():
-            component_lines.setdefault(
-                component_group,
-                ComponentLine(
-                    # find the translated name of the component group
-                    component_group=next(cg for cg in COMPONENT_GROUP_CHOICES
-                                         if cg[0] == component_group)[1],
-                    rqty=0,
-                    lqty=0,
-                    name='',
-                    ingredients=''))
+            line = component_lines.get(component_group)
+            if line is None:
+                line = component_lines[component_group] = \
+                    ComponentLineBuilder(
+                        # find the translated name of the component group
+                        component_group=next(
+                            cg for cg in COMPONENT_GROUP_CHOICES
+                            if cg[0] == component_group)[1])
             if (component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH and
-                    component_lines[component_group].name == ''):
+                    line.name == ''):
                 # not yet got main dish name and ingredients, do it
-                component_lines[component_group] = \
-                    component_lines[component_group]._replace(
-                        name=meal_component.name,
-                        ingredients=", ".join(
-                            [ing.name for ing in
-                             Component.get_day_ingredients(
-                                 meal_component.id, date)]))
+                line.name = meal_component.name
+                line.ingredients = ", ".join(
+                    [ing.name for ing in
+                     Component.get_day_ingredients(
+                         meal_component.id, date)])
             if (component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH and
                     item.meal_size == SIZE_CHOICES_LARGE):
-                component_lines[component_group] = \
-                    component_lines[component_group]._replace(
-                        lqty=(component_lines[component_group].lqty +
-                              meal_component.qty))
+                line.lqty += meal_component.qty
             else:
-                component_lines[component_group] = \
-                    component_lines[component_group]._replace(
-                        rqty=(component_lines[component_group].rqty +
-                              meal_component.qty))
+                line.rqty += meal_component.qty
         # END FOR
     # END FOR
+    component_lines = {component_group: line.freeze()
+                       for component_group, line in component_lines.items()}
     # Sort component summary
     items = component_lines.items()
     if items:
@@ -1044,7 +1242,7 @@ def kcr_make_lines(kitchen_list, date):
     return (component_lines_sorted, meal_lines)
 
 
-def kcr_make_pages(date, component_lines, meal_lines):
+def kcr_make_pages(date, component_lines, meal_lines, kitchen_count_file):
     """Generate the kitchen count report pages as a PDF file.
 
     Uses ReportLab see http://www.reportlab.com/documentation/faq/
@@ -1056,6 +1254,7 @@ def kcr_make_pages(date, component_lines, meal_lines):
         meal_lines : A list of MealLine objects, the details of the clients
             for the date that have ingredients clashing with those in today's
             main dish.
+        kitchen_count_file : The name of the PDF file.
 
     Returns:
         An integer : The number of pages generated.
@@ -1117,7 +1316,7 @@ def kcr_make_pages(date, component_lines, meal_lines):
         Returns:
             An integer : The number of pages generated.
         """
-        doc = RLSimpleDocTemplate(KITCHEN_COUNT_FILE)
+        doc = RLSimpleDocTemplate(kitchen_count_file)
         story = []
 
         # begin Summary section
@@ -1243,6 +1442,181 @@ def kcr_make_pages(date, component_lines, meal_lines):
 # END Kitchen count report view, helper classes and functions
 
 
+# Kitchen count for a range of dates, view and helper functions
+
+KITCHEN_COUNT_RANGE_DAYS = 7        # default number of days in the range
+
+IngredientLine = collections.namedtuple(  # Ingredient total on the range.
+    'IngredientLine',
+    ['name',                        # String : ingredient name
+     'qty'])                        # Servings of components containing it
+
+
+class KitchenCountRange(
+        LoginRequiredMixin, PermissionRequiredMixin, generic.View):
+    permission_required = 'sous_chef.read'
+
+    def get(self, request, *args, **kwargs):
+        if request.GET:
+            form = KitchenCountRangeForm(request.GET)
+        else:
+            start_date = datetime.date.today()
+            form = KitchenCountRangeForm({
+                'start_date': start_date,
+                'end_date': start_date + datetime.timedelta(
+                    days=KITCHEN_COUNT_RANGE_DAYS - 1)})
+        if not form.is_valid():
+            return render(request, 'kitchen_count_range.html',
+                          {'form': form})
+
+        start_date = form.cleaned_data['start_date']
+        end_date = form.cleaned_data['end_date']
+        day_lines, total_lines = kcr_make_range_lines(
+            kcr_deliverable_items(
+                Order.get_kitchen_items_range(start_date, end_date)))
+        if request.GET.get('format') == 'csv':
+            return kcr_range_csv(start_date, end_date, day_lines, total_lines)
+        return render(request, 'kitchen_count_range.html',
+                      {'form': form,
+                       'day_lines': day_lines,
+                       'total_lines': total_lines})
+
+
+def kcr_make_range_lines(kitchen_lists):
+    """Generate the per-day and aggregate totals of a range of dates.
+
+    Only one query is run to get the ingredients, whatever the number
+    of days. The ingredients of a component are the ones chosen for the
+    day (see Component.get_day_ingredients), or the ones of its recipe
+    when they are not chosen yet, which is the case of the days ahead.
+
+    Args:
+        kitchen_lists : A dictionary {date: kitchen_list, ...} sorted by
+            date, see Order.get_kitchen_items_range.
+
+    Returns:
+        A tuple. First value is an OrderedDict {date: (component_lines,
+          ingredient_lines), ...}. The second value is the tuple
+          (component_lines, ingredient_lines) of the whole range.
+          'component_lines' are lists of ComponentLine objects, the main
+          dishes first, and 'ingredient_lines' are lists of
+          IngredientLine objects sorted by name.
+    """
+    component_ids = set()
+    for kitchen_list in kitchen_lists.values():
+        for item in kitchen_list.values():
+            for meal_component in item.meal_components.values():
+                component_ids.add(meal_component.id)
+    ingredients = collections.defaultdict(list)
+    if kitchen_lists:
+        for ci in Component_ingredient.objects.filter(
+                Q(date__isnull=True) |
+                Q(date__gte=min(kitchen_lists), date__lte=max(kitchen_lists)),
+                component__id__in=component_ids
+        ).select_related('ingredient').order_by('ingredient__name'):
+            ingredients[(ci.component_id, ci.date)].append(
+                ci.ingredient.name)
+
+    def group_name(component_group):
+        # find the translated name of the component group
+        return next(cg for cg in COMPONENT_GROUP_CHOICES
+                    if cg[0] == component_group)[1]
+
+    def sort_key(key):
+        component_group, component_id = key
+        return (component_group != COMPONENT_GROUP_CHOICES_MAIN_DISH,
+                component_group, component_id)
+
+    total_components = {}
+    total_dates = collections.defaultdict(list)  # dates of each component
+    total_ingredients = collections.Counter()
+    day_lines = collections.OrderedDict()
+    for delivery_date, kitchen_list in kitchen_lists.items():
+        components = {}
+        day_ingredients = collections.Counter()
+        for item in kitchen_list.values():
+            for component_group, meal_component \
+                    in item.meal_components.items():
+                key = (component_group, meal_component.id)
+                for lines in (components, total_components):
+                    line = lines.get(key)
+                    if line is None:
+                        line = lines[key] = ComponentLineBuilder(
+                            group_name(component_group))
+                        line.name = meal_component.name
+                    if (component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH
+                            and item.meal_size == SIZE_CHOICES_LARGE):
+                        line.lqty += meal_component.qty
+                    else:
+                        line.rqty += meal_component.qty
+        for (component_group, component_id), line in components.items():
+            total_dates[(component_group, component_id)].append(
+                delivery_date)
+            names = (ingredients.get((component_id, delivery_date)) or
+                     ingredients.get((component_id, None), []))
+            line.ingredients = ", ".join(names)
+            for name in names:
+                day_ingredients[name] += line.rqty + line.lqty
+        total_ingredients.update(day_ingredients)
+        day_lines[delivery_date] = (
+            [components[key].freeze()
+             for key in sorted(components, key=sort_key)],
+            [IngredientLine(name, qty)
+             for name, qty in sorted(day_ingredients.items())])
+
+    for (component_group, component_id), line in total_components.items():
+        # only the days on which the component is served
+        names = set()
+        for delivery_date in total_dates[(component_group, component_id)]:
+            names.update(ingredients.get((component_id, delivery_date)) or
+                         ingredients.get((component_id, None), []))
+        line.ingredients = ", ".join(sorted(names))
+    total_lines = (
+        [total_components[key].freeze()
+         for key in sorted(total_components, key=sort_key)],
+        [IngredientLine(name, qty)
+         for name, qty in sorted(total_ingredients.items())])
+    return day_lines, total_lines
+
+
+def kcr_range_csv(start_date, end_date, day_lines, total_lines):
+    """Export the totals of a range of dates as a CSV file.
+
+    The components of each day and of the whole range come first, then
+    the ingredients.
+
+    Args:
+        start_date, end_date : The first and last delivery dates.
+        day_lines, total_lines : See kcr_make_range_lines.
+
+    Returns:
+        An HttpResponse object.
+    """
+    response = HttpResponse(content_type="text/csv")
+    response['Content-Disposition'] = \
+        'attachment; filename=kitchen_count_{}_{}.csv'.format(
+            start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d"))
+    sections = list(day_lines.items()) + [(ugettext("Total"), total_lines)]
+    writer = csv.writer(response, csv.excel)
+    writer.writerow([
+        ugettext("Date"), ugettext("Component group"), ugettext("Component"),
+        ugettext("Regular"), ugettext("Large"), ugettext("Ingredients")])
+    for delivery_date, (component_lines, ingredient_lines) in sections:
+        for line in component_lines:
+            writer.writerow([delivery_date, line.component_group,
+                             line.name, line.rqty, line.lqty,
+                             line.ingredients])
+    writer.writerow([])
+    writer.writerow([
+        ugettext("Date"), ugettext("Ingredient"), ugettext("Servings")])
+    for delivery_date, (component_lines, ingredient_lines) in sections:
+        for line in ingredient_lines:
+            writer.writerow([delivery_date, line.name, line.qty])
+    return response
+
+# END Kitchen count for a range of dates, view and helper functions
+
+
 # Meal labels generation data structures and functions.
 
 meal_label_fields = [                         # Contents for Meal Labels.
@@ -1263,6 +1637,44 @@ MealLabel = collections.namedtuple(
     'MealLabel', meal_label_fields[0::2])
 
 
+# Number of different texts whose layout is kept, see label_text_lines.
+LABEL_LAYOUT_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=LABEL_LAYOUT_CACHE_SIZE)
+def label_text_lines(text, width, prefix=''):
+    """Wrap a text of the meal labels.
+
+    Many clients have the same restrictions, and the regular meals all
+    have the ingredients of the main dish: the result is memoised so that
+    each text is wrapped once.
+
+    Args:
+        text : A string.
+        width : The maximum number of characters per line.
+        prefix : A string written in another font before the text, on
+            the first line. It is the first item of the result.
+
+    Returns:
+        A tuple of strings, the lines. The prefix is not part of the
+        first line of text, although it is wrapped with it.
+    """
+    lines = textwrap.wrap(prefix + text, width=width,
+                          break_long_words=False, break_on_hyphens=False)
+    if prefix:
+        # remove prefix from first line
+        lines[0] = lines[0][len(prefix):]
+        lines.insert(0, prefix)
+    return tuple(lines)
+
+
+@functools.lru_cache(maxsize=LABEL_LAYOUT_CACHE_SIZE)
+def label_text_width(text, font_name, font_size):
+    """The width of a text of the meal labels in points, memoised."""
+    return rl_pdfmetrics.stringWidth(text, fontName=font_name,
+                                     fontSize=font_size)
+
+
 def draw_label(label, width, height, data):
     """Draw a single Meal Label on the sheet.
 
@@ -1315,8 +1727,7 @@ def draw_label(label, width, height, data):
             horiz_margin, vertic_pos, data.preparations[0],
             fontName="Helvetica", fontSize=9))
         # measure prefix length to offset first line
-        offset = rl_pdfmetrics.stringWidth(
-            data.preparations[0], fontName="Helvetica", fontSize=9)
+        offset = label_text_width(data.preparations[0], "Helvetica", 9)
         for line in data.preparations[1:]:
             label.add(rl_shapes.String(
                 horiz_margin + offset, vertic_pos, line,
@@ -1330,8 +1741,7 @@ def draw_label(label, width, height, data):
             horiz_margin, vertic_pos, data.sides_clashes[0],
             fontName="Helvetica", fontSize=9))
         # measure prefix length to offset first line
-        offset = rl_pdfmetrics.stringWidth(
-            data.sides_clashes[0], fontName="Helvetica", fontSize=9)
+        offset = label_text_width(data.sides_clashes[0], "Helvetica", 9)
         for line in data.sides_clashes[1:]:
             label.add(rl_shapes.String(
                 horiz_margin + offset, vertic_pos, line,
@@ -1354,27 +1764,11 @@ def draw_label(label, width, height, data):
             vertic_pos -= 9
 
 
-def kcr_make_labels(kitchen_list, main_dish_name, main_dish_ingredients):
-    """Generate Meal Labels sheets as a PDF file.
-
-    Generate a label for each main dish serving to be delivered. The
-    sheet format is "Avery 5162" 8,5 X 11 inches, 2 cols X 7 lines.
-
-    Uses pylabels package - see https://github.com/bcbnz/pylabels
-    and ReportLab
+LABELS_PER_SHEET = 14  # Avery 5162 : 2 columns * 7 rows
 
-    Args:
-        kitchen_list : A dictionary of KitchenItem objects (see
-            order/models) which contain detailed information about
-            all the meals that have to be prepared for the day and
-            the client requirements and restrictions.
-        main_dish_name : A string, the name of today's main dish.
-        main_dish_ingredient : A string, the comma separated list
-            of all the ingredients in today's main dish.
 
-    Returns:
-        An integer : The number of labels generated.
-    """
+def meal_labels_specification():
+    """The pylabels specification of the meal label sheets."""
     # dimensions are in millimeters; 1 inch = 25.4 mm
     # Sheet format is Avery 5162 : 2 columns * 7 rows
     sheet_height = 11.0 * 25.4
@@ -1384,7 +1778,7 @@ def kcr_make_labels(kitchen_list, main_dish_name, main_dish_ingredients):
     columns = 2
     rows = 7
     gutter = 3.0 / 16.0 * 25.4
-    specs = labels.Specification(
+    return labels.Specification(
         sheet_width=sheet_width,
         sheet_height=sheet_height,
         columns=columns,
@@ -1398,10 +1792,62 @@ def kcr_make_labels(kitchen_list, main_dish_name, main_dish_ingredients):
         right_margin=horiz_margin,
         corner_radius=1.5)
 
-    sheet = labels.Sheet(specs, draw_label, border=False)
 
-    meal_labels = []
+def kcr_render_labels_sheet(meal_labels):
+    """Render one sheet of meal labels as a PDF file.
+
+    This is run in the processes of kcr_make_labels.
+
+    Args:
+        meal_labels : A list of at most LABELS_PER_SHEET MealLabel
+            objects, in the order of the sheet.
+
+    Returns:
+        The content of the PDF file, as bytes.
+    """
+    sheet = labels.Sheet(meal_labels_specification(), draw_label,
+                         border=False)
+    # the copies of a label are drawn once
+    for label, copies in itertools.groupby(meal_labels):
+        sheet.add_label(label, count=len(list(copies)))
+    pdf = io.BytesIO()
+    sheet.save(pdf)
+    return pdf.getvalue()
+
+
+def kcr_make_labels(kitchen_list, main_dish_name, main_dish_ingredients,
+                    meal_labels_file, workers=None):
+    """Generate Meal Labels sheets as a PDF file.
+
+    Generate a label for each main dish serving to be delivered. The
+    sheet format is "Avery 5162" 8,5 X 11 inches, 2 cols X 7 lines.
+    The sheets are rendered in parallel, one process per core by
+    default, then their pages are concatenated in the order of the
+    labels with pdfrw.
+
+    Uses pylabels package - see https://github.com/bcbnz/pylabels
+    and ReportLab
+
+    Args:
+        kitchen_list : A dictionary of KitchenItem objects (see
+            order/models) which contain detailed information about
+            all the meals that have to be prepared for the day and
+            the client requirements and restrictions.
+        main_dish_name : A string, the name of today's main dish.
+        main_dish_ingredient : A string, the comma separated list
+            of all the ingredients in today's main dish.
+        meal_labels_file : The name of the PDF file.
+        workers : The number of processes, see ProcessPoolExecutor. With
+            1, the sheets are rendered by this process.
+
+    Returns:
+        An integer : The number of labels generated.
+    """
+    # one label per client, copied for each serving
+    client_labels = []
     for kititm in kitchen_list.values():
+        if kititm.meal_qty < 1:
+            continue
         meal_label = MealLabel(*meal_label_fields[1::2])
         meal_label = meal_label._replace(
             route=kititm.routename.upper(),
@@ -1412,42 +1858,28 @@ def kcr_make_labels(kitchen_list, main_dish_name, main_dish_ingredients):
         if kititm.incompatible_ingredients:
             meal_label = meal_label._replace(
                 main_dish_name='_______________________________________',
-                dish_clashes=textwrap.wrap(
+                dish_clashes=list(label_text_lines(
                     ugettext('Restrictions') + ' : {}'.format(
                         ' , '.join(kititm.incompatible_ingredients)),
-                    width=65,
-                    break_long_words=False, break_on_hyphens=False))
+                    65)))
         elif not kititm.sides_clashes:
             meal_label = meal_label._replace(
-                ingredients=textwrap.wrap(
+                ingredients=list(label_text_lines(
                     ugettext('Ingredients') + ' : {}'.format(
                         main_dish_ingredients),
-                    width=74,
-                    break_long_words=False, break_on_hyphens=False))
+                    74)))
         if kititm.preparation:
-            prefix = ugettext('Preparation') + ' : '
             # wrap all text including prefix
-            preparation_list = textwrap.wrap(
-                prefix + ' , '.join(kititm.preparation),
-                width=65,
-                break_long_words=False,
-                break_on_hyphens=False)
-            # remove prefix from first line
-            preparation_list[0] = preparation_list[0][len(prefix):]
             meal_label = meal_label._replace(
-                preparations=[prefix] + preparation_list)
+                preparations=list(label_text_lines(
+                    ' , '.join(kititm.preparation), 65,
+                    prefix=ugettext('Preparation') + ' : ')))
         if kititm.sides_clashes:
-            prefix = ugettext('Sides clashes') + ' : '
             # wrap all text including prefix
-            sides_clashes_list = textwrap.wrap(
-                prefix + ' , '.join(kititm.sides_clashes),
-                width=65,
-                break_long_words=False,
-                break_on_hyphens=False)
-            # remove prefix from first line
-            sides_clashes_list[0] = sides_clashes_list[0][len(prefix):]
             meal_label = meal_label._replace(
-                sides_clashes=[prefix] + sides_clashes_list)
+                sides_clashes=list(label_text_lines(
+                    ' , '.join(kititm.sides_clashes), 65,
+                    prefix=ugettext('Sides clashes') + ' : ')))
         other_restrictions = []
         if kititm.sides_clashes:
             other_restrictions.extend(
@@ -1465,44 +1897,58 @@ def kcr_make_labels(kitchen_list, main_dish_name, main_dish_ingredients):
                             set(kititm.incompatible_ingredients))))
         if other_restrictions:
             meal_label = meal_label._replace(
-                other_restrictions=textwrap.wrap(
+                other_restrictions=list(label_text_lines(
                     ugettext('Other restrictions') + ' : {}'.format(
                         ' , '.join(other_restrictions)),
-                    width=65,
-                    break_long_words=False, break_on_hyphens=False))
-        for j in range(1, kititm.meal_qty + 1):
-            meal_labels.append(meal_label)
+                    65)))
+        client_labels.append((meal_label, kititm.meal_qty))
 
     # find max lengths of fields to sort on
     routew = 0
     namew = 0
-    for label in meal_labels:
+    for label, qty in client_labels:
         routew = max(routew, len(label.route))
         namew = max(namew, len(label.name))
     # generate grouping and sorting key
-    for j in range(len(meal_labels)):
+    meal_labels = []
+    for label, qty in client_labels:
         route = ''  # for groups 1, 2 and 3 : sort by name
-        if meal_labels[j].dish_clashes:     # has dish restrictions
+        if label.dish_clashes:     # has dish restrictions
             group = 1
-        elif meal_labels[j].sides_clashes:  # has sides restrictions
+        elif label.sides_clashes:  # has sides restrictions
             group = 2
-        elif meal_labels[j].preparations:   # has food preparations
+        elif label.preparations:   # has food preparations
             group = 3
-        else:                               # regular meal
+        else:                      # regular meal
             group = 4
-            route = meal_labels[j].route        # sort by route, name
-        meal_labels[j] = meal_labels[j]._replace(
+            route = label.route        # sort by route, name
+        label = label._replace(
             sortkey='{grp:1}{rou:{rouw}}{nam:{namw}}'.format(
                 grp=group,
                 rou=route, rouw=routew,
-                nam=meal_labels[j].name, namw=namew))
-    # generate labels into PDF
-    for label in sorted(meal_labels, key=lambda x: x.sortkey):
-        sheet.add_label(label)
-
-    if sheet.label_count > 0:
-        sheet.save(MEAL_LABELS_FILE)
-    return sheet.label_count
+                nam=label.name, namw=namew))
+        meal_labels.extend([label] * qty)
+    # generate labels into PDF, one sheet at a time
+    meal_labels.sort(key=lambda x: x.sortkey)
+    sheets = [meal_labels[i:i + LABELS_PER_SHEET]
+              for i in range(0, len(meal_labels), LABELS_PER_SHEET)]
+    if len(sheets) > 1 and workers != 1:
+        # The worker processes must not share the connection of this one.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pdfs = list(executor.map(kcr_render_labels_sheet, sheets))
+    else:
+        pdfs = list(map(kcr_render_labels_sheet, sheets))
+
+    if pdfs:
+        readers = [pdfrw.PdfReader(io.BytesIO(pdf)) for pdf in pdfs]
+        writer = pdfrw.PdfWriter()
+        for reader in readers:
+            writer.addpages(reader.pages)
+        # the title and producer of the sheets
+        writer.trailer.Info = readers[0].Info
+        writer.write(meal_labels_file)
+    return len(meal_labels)
 
 # END Meal labels
 
@@ -1515,17 +1961,7 @@ class MealLabels(
     permission_required = 'sous_chef.read'
 
     def get(self, request, **kwargs):
-        try:
-            f = open(MEAL_LABELS_FILE, "rb")
-        except:
-            raise Http404("File " + MEAL_LABELS_FILE + " does not exist")
-        response = HttpResponse(content_type='application/pdf')
-        response['Content-Disposition'] = \
-            'attachment; filename="labels{}.pdf"'. \
-            format(datetime.date.today().strftime("%Y%m%d"))
-        response.write(f.read())
-        f.close()
-        return response
+        return download_report(request, REPORT_KIND_LABELS)
 
 
 class DeliveryRouteSheet(
@@ -1619,21 +2055,66 @@ def sort_sequence_ids(unordered_dic, seq):
 # END Delivery route sheet view, helper classes and functions
 
 
-def calculateRoutePointsEuclidean(data):
-    """Find shortest path for points on route assuming 2D plane.
+def route_fingerprint(data):
+    """Fingerprint of a set of waypoints and of the starting point.
+
+    The fingerprint does not depend on the order of the waypoints.
+
+    Args:
+        data : A list of waypoints for leaflet.js
+
+    Returns:
+        A hexadecimal SHA-256 digest.
+    """
+    stops = sorted(
+        (waypoint['id'],
+         round(float(waypoint['latitude']), 6),
+         round(float(waypoint['longitude']), 6))
+        for waypoint in data)
+    key = json.dumps([list(DELIVERY_STARTING_POINT_LAT_LONG), stops])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def sort_waypoints(data, client_id_sequence):
+    """Sort waypoints following a sequence of client IDs.
+
+    Waypoints that are not in the sequence are placed at the end, in
+    their original order.
+    """
+    position = {client_id: i for i, client_id in enumerate(client_id_sequence)}
+    return sorted(data, key=lambda waypoint: position.get(waypoint['id'],
+                                                          len(position)))
+
+
+def optimise_waypoints(data, warm_start=None):
+    """Find shortest path for points on route as the crow flies.
 
     Since the
     https://www.mapbox.com/api-documentation/#retrieve-a-duration-matrix
     endpoint is not yet available, we solve an approximation of the
-    problem by assuming the world is flat and has no obstacles (2D
-    Euclidean plane). This should still give good results.
+    problem by assuming the world has no obstacles. Distances are
+    great-circle distances between the coordinates, since a degree of
+    longitude is much shorter than a degree of latitude in Montreal.
+    This should still give good results. The search starts from a
+    greedy tour, unless the current sequence is shorter, and is stopped
+    after ROUTE_OPTIMISATION_TIME_LIMIT_MS milliseconds to bound the
+    latency.
+
+    This function does not access the database, so that it can run in
+    another process.
 
     Args:
         data : A list of waypoints for leaflet.js
+        warm_start : A list of client IDs. If given, the search starts
+            from this sequence instead of a greedy tour.
 
     Returns:
         An optimized list of waypoints.
     """
+    construction = tsp.GREEDY
+    if warm_start is not None:
+        data = sort_waypoints(data, warm_start)
+        construction = None
     node_to_waypoint = {}
     nodes = [tsp.Node(None,
                       DELIVERY_STARTING_POINT_LAT_LONG[0],
@@ -1644,12 +2125,134 @@ def calculateRoutePointsEuclidean(data):
         node_to_waypoint[node] = waypoint
         nodes.append(node)
     # Optimize waypoints by solving the Travelling Salesman Problem
-    nodes = tsp.solve(nodes)
+    nodes = tsp.solve(nodes, metric=tsp.HAVERSINE,
+                      time_limit_ms=ROUTE_OPTIMISATION_TIME_LIMIT_MS,
+                      construction=construction)
     # Guard against starting point which is not in node_to_waypoint
     return [node_to_waypoint[node] for
             node in nodes if node in node_to_waypoint]
 
 
+def calculateRoutePointsEuclidean(data):
+    """Find shortest path for points on route, using cached results.
+
+    Optimised sequences are cached by the fingerprint of the waypoints
+    and of the starting point (see RouteOptimisation). A cached sequence
+    is returned as is for the same waypoints, or used as a warm start
+    when only a few clients were added or removed. Otherwise, see
+    optimise_waypoints.
+
+    Args:
+        data : A list of waypoints for leaflet.js
+
+    Returns:
+        An optimized list of waypoints.
+    """
+    fingerprint = route_fingerprint(data)
+    sequence, exact = RouteOptimisation.objects.get_sequence(
+        fingerprint, [waypoint['id'] for waypoint in data])
+    if exact:
+        return sort_waypoints(data, sequence)
+    optimised_waypoints = optimise_waypoints(data, sequence)
+    RouteOptimisation.objects.store(
+        fingerprint, [waypoint['id'] for waypoint in optimised_waypoints])
+    return optimised_waypoints
+
+
+def optimise_delivery_routes(delivery_date, workers=None):
+    """Optimise the delivery sequence of every route having orders.
+
+    The routes are solved in parallel, one process per core by default,
+    so that the wall-clock time does not grow with the number of routes,
+    and each route gets the whole ROUTE_OPTIMISATION_TIME_LIMIT_MS.
+    Routes whose sequence is cached are not solved again (see
+    calculateRoutePointsEuclidean). The optimised sequences are saved in
+    the DeliveryHistory of each route, which is created if necessary.
+
+    This is run by the optimiseroutes command, and by a report job
+    queued by OptimiseDeliveriesOfToday, never in a request.
+
+    Args:
+        delivery_date : A datetime.date object.
+        workers : The number of processes, see ProcessPoolExecutor. With
+            1, the routes are solved by this process.
+
+    Returns:
+        A dictionary {<route id>: <list of client ids>, ...}.
+    """
+    # This needs to be placed on the top when refactoring Route module.
+    # It causes circular dependancy in current code structure.
+    from member.views import get_clients_on_delivery_history  # noqa
+    sequences = {}
+    delivery_histories = {}
+    fingerprints = {}
+    waypoints = {}
+    warm_starts = {}
+    for route in Route.objects.all():
+        if not Order.objects.get_shippable_orders_by_route(
+                route.id, delivery_date=delivery_date,
+                exclude_non_geolocalized=True).exists():
+            continue
+        delivery_history, created = DeliveryHistory.objects.get_or_create(
+            route=route, date=delivery_date,
+            defaults={'vehicle': route.vehicle})
+        delivery_histories[route.pk] = delivery_history
+        # Start from the current sequence of the route.
+        data = [
+            {'id': c.pk,
+             'latitude': c.member.address.latitude,
+             'longitude': c.member.address.longitude}
+            for c in get_clients_on_delivery_history(delivery_history)
+            if c.order_of_the_day is not None]
+        fingerprints[route.pk] = route_fingerprint(data)
+        sequence, exact = RouteOptimisation.objects.get_sequence(
+            fingerprints[route.pk], [waypoint['id'] for waypoint in data])
+        if exact:
+            sequences[route.pk] = [
+                waypoint['id'] for waypoint in sort_waypoints(data, sequence)]
+        else:
+            waypoints[route.pk] = data
+            warm_starts[route.pk] = sequence
+
+    route_ids = list(waypoints)
+    args = ([waypoints[pk] for pk in route_ids],
+            [warm_starts[pk] for pk in route_ids])
+    if len(route_ids) > 1 and workers != 1:
+        # The worker processes must not share the connection of this one.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(optimise_waypoints, *args))
+    else:
+        results = list(map(optimise_waypoints, *args))
+    for route_id, optimised_waypoints in zip(route_ids, results):
+        sequences[route_id] = [
+            waypoint['id'] for waypoint in optimised_waypoints]
+        RouteOptimisation.objects.store(fingerprints[route_id],
+                                        sequences[route_id])
+
+    for route_id, delivery_history in delivery_histories.items():
+        delivery_history.client_id_sequence = sequences[route_id]
+        delivery_history.save()
+    return sequences
+
+
+class OptimiseDeliveriesOfToday(
+        LoginRequiredMixin, PermissionRequiredMixin, generic.View):
+    permission_required = 'sous_chef.edit'
+
+    def post(self, request, *args, **kwargs):
+        # The routes are optimised in the background, see
+        # optimise_delivery_routes.
+        jobs.enqueue(timezone.datetime.today().date(),
+                     kind=REPORT_JOB_KIND_ROUTES)
+        messages.add_message(
+            request, messages.SUCCESS,
+            _("The delivery sequences of the routes are being optimised. "
+              "Reload this page in a moment to see them.")
+        )
+        return HttpResponseRedirect(reverse_lazy('delivery:routes'))
+
+
 class RefreshOrderView(
         LoginRequiredMixin, PermissionRequiredMixin, generic.View):
     permission_required = 'sous_chef.edit'
@@ -0,0 +1,339 @@
+import collections
+import math
+
+import numpy
+
+from member.models import Client, ROUTE_VEHICLES
+from meal.models import COMPONENT_GROUP_CHOICES_MAIN_DISH
+from order.models import Order
+from . import tsp
+from .settings import DELIVERY_STARTING_POINT_LAT_LONG
+
+
+# Number of meals that fit in each kind of vehicle.
+VEHICLE_CAPACITIES = {
+    'cycling': 20,
+    'walking': 10,
+    'driving': 60,
+}
+
+Vehicle = collections.namedtuple(   # A vehicle available for a delivery.
+    'Vehicle',
+    ['kind',                        # One of ROUTE_VEHICLES
+     'capacity'])                   # Maximum number of meals
+
+
+VehicleRoute = collections.namedtuple(  # Stops assigned to a vehicle.
+    'VehicleRoute',
+    ['vehicle',                     # Vehicle object
+     'stops',                       # List of Stop objects, in delivery order
+     'load',                        # Number of meals delivered
+     'distance'])                   # Length of the route, see solve()
+
+
+class Stop(tsp.Node):
+    """A delivery location and the number of meals delivered there."""
+    __slots__ = ('demand',)
+
+    def __init__(self, id, latitude, longitude, demand):
+        super().__init__(id, latitude, longitude)
+        self.demand = demand
+
+    def __str__(self):
+        return "Stop({0}, {1}, {2}, {3})".format(
+            self.id, self.latitude, self.longitude, self.demand)
+
+
+def starting_point():
+    """The starting point of the delivery routes, as a tsp.Node."""
+    return tsp.Node(None,
+                    DELIVERY_STARTING_POINT_LAT_LONG[0],
+                    DELIVERY_STARTING_POINT_LAT_LONG[1])
+
+
+def make_vehicles(kinds):
+    """Builds vehicles having the default capacity of their kind.
+
+    Args:
+        kinds: A list of vehicle kinds (see ROUTE_VEHICLES), one item
+            per vehicle.
+
+    Returns:
+        A list of Vehicle objects.
+    """
+    known = [kind for kind, trans in ROUTE_VEHICLES]
+    vehicles = []
+    for kind in kinds:
+        if kind not in known:
+            raise ValueError("Unknown vehicle: {}".format(kind))
+        vehicles.append(Vehicle(kind, VEHICLE_CAPACITIES[kind]))
+    return vehicles
+
+
+def sweep_angles(depot, stops):
+    """Polar angle of each stop around the depot, in radians.
+
+    Coordinates are projected on a plane (equirectangular projection)
+    so that angles are not distorted by the latitude.
+    """
+    latitudes = numpy.array([s.latitude for s in stops], dtype=float)
+    longitudes = numpy.array([s.longitude for s in stops], dtype=float)
+    x = ((longitudes - depot.longitude) *
+         math.cos(math.radians(depot.latitude)))
+    y = latitudes - depot.latitude
+    return numpy.arctan2(y, x)
+
+
+def assign_stops(depot, stops, vehicles):
+    """Splits the stops among the vehicles with the sweep algorithm.
+
+    Stops are sorted by their angle around the depot, starting after
+    the largest angular gap between two consecutive stops, and the
+    vehicles take consecutive sectors. Each vehicle is filled up to its
+    share of the total demand, proportional to its capacity, so that
+    the routes are balanced.
+
+    https://en.wikipedia.org/wiki/Vehicle_routing_problem
+
+    Args:
+        depot: The starting point (Node) of every route.
+        stops: A list of Stop objects.
+        vehicles: A list of Vehicle objects.
+
+    Returns:
+        A list of lists of stops, one list per vehicle.
+
+    Raises:
+        ValueError: The vehicles cannot carry all the meals, or a stop
+            does not fit in the vehicle of its sector.
+    """
+    total_demand = sum(stop.demand for stop in stops)
+    total_capacity = sum(vehicle.capacity for vehicle in vehicles)
+    if total_demand > total_capacity:
+        raise ValueError(
+            "{} meals to deliver but the vehicles can only carry {}.".format(
+                total_demand, total_capacity))
+    assignment = [[] for _ in vehicles]
+    if not stops:
+        return assignment
+
+    angles = sweep_angles(depot, stops)
+    by_angle = numpy.argsort(angles, kind='mergesort').tolist()
+    sorted_angles = angles[by_angle]
+    gaps = numpy.diff(numpy.append(sorted_angles,
+                                   sorted_angles[0] + 2 * math.pi))
+    start = (int(numpy.argmax(gaps)) + 1) % len(stops)
+    by_angle = by_angle[start:] + by_angle[:start]
+
+    # The share of a vehicle is computed when it starts to be filled,
+    # so that the differences with the previous shares are spread over
+    # the remaining vehicles.
+    remaining_demand = total_demand
+    remaining_capacity = total_capacity
+    current = 0
+    load = 0
+    target = remaining_demand * vehicles[0].capacity / remaining_capacity
+    for i in by_angle:
+        stop = stops[i]
+        while current < len(vehicles) - 1 and (
+                load + stop.demand > vehicles[current].capacity or
+                (assignment[current] and
+                 load + stop.demand / 2.0 > target)):
+            remaining_demand -= load
+            remaining_capacity -= vehicles[current].capacity
+            current += 1
+            load = 0
+            target = (remaining_demand * vehicles[current].capacity /
+                      remaining_capacity)
+        if load + stop.demand > vehicles[current].capacity:
+            raise ValueError(
+                "The meals cannot be split among the vehicles.")
+        assignment[current].append(stop)
+        load += stop.demand
+    return assignment
+
+
+def solve(depot, stops, vehicles, metric=tsp.HAVERSINE, time_limit_ms=None,
+          construction=tsp.GREEDY):
+    """Solves the Capacitated Vehicle Routing Problem with a heuristic.
+
+    The stops are first split among the vehicles (see assign_stops),
+    then each route is sequenced by solving a TSP.
+
+    Args:
+        depot: The starting point (Node) of every route.
+        stops: A list of Stop objects.
+        vehicles: A list of Vehicle objects.
+        metric: The distance metric, see tsp.DistanceMatrix.
+        time_limit_ms: If given, the time budget of the whole solve,
+            shared among the routes in proportion to their size.
+        construction: The construction heuristic of the TSP, see
+            tsp.solve.
+
+    Returns:
+        A list of VehicleRoute objects, one per vehicle, in the same
+        order as the vehicles. A vehicle may have no stops. The distance
+        of a route is measured with the given metric, from and back to
+        the depot.
+    """
+    routes = []
+    assignment = assign_stops(depot, stops, vehicles)
+    for vehicle, route_stops in zip(vehicles, assignment):
+        route_time_limit_ms = None
+        if time_limit_ms is not None and stops:
+            route_time_limit_ms = (time_limit_ms * len(route_stops) /
+                                   len(stops))
+        tour = tsp.solve([depot] + route_stops, metric=metric,
+                         time_limit_ms=route_time_limit_ms,
+                         construction=construction)
+        matrix = tsp.DistanceMatrix(tour, metric)
+        routes.append(VehicleRoute(
+            vehicle=vehicle,
+            stops=tour[1:],
+            load=sum(stop.demand for stop in route_stops),
+            distance=matrix.tour_distance(range(len(tour)))))
+    return routes
+
+
+def get_stops(delivery_date=None):
+    """Delivery stops of the shippable orders of a day.
+
+    There is one stop per client, whose demand is the number of main
+    dishes ordered. Non geolocalized clients are excluded.
+
+    Args:
+        delivery_date: A datetime.date object, today by default.
+
+    Returns:
+        A list of Stop objects whose id is the client id.
+    """
+    orders = Order.objects.get_shippable_orders(
+        delivery_date, exclude_non_geolocalized=True
+    ).select_related(
+        'client__member__address'
+    ).prefetch_related('orders').order_by('client_id')
+    stops = collections.OrderedDict()
+    for order in orders:
+        client = order.client
+        if client.pk not in stops:
+            stops[client.pk] = Stop(
+                client.pk,
+                float(client.member.address.latitude),
+                float(client.member.address.longitude),
+                0)
+        stops[client.pk].demand += sum(
+            item.total_quantity or 0 for item in order.orders.all()
+            if item.component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH)
+    return list(stops.values())
+
+
+def plan_delivery_routes(vehicles, delivery_date=None, time_limit_ms=None):
+    """Splits the day's deliveries into routes and sequences them.
+
+    Args:
+        vehicles: A list of Vehicle objects.
+        delivery_date: A datetime.date object, today by default.
+        time_limit_ms: The time budget of the whole solve, if any.
+
+    Returns:
+        A list of VehicleRoute objects whose stop ids are client ids.
+    """
+    return solve(starting_point(), get_stops(delivery_date), vehicles,
+                 time_limit_ms=time_limit_ms)
+
+
+def get_sequence_tour(delivery_history):
+    """The delivery sequence of a DeliveryHistory as a tour.
+
+    Returns:
+        A tuple (tour, others). `tour` is a list of nodes starting with
+        the starting point, whose ids are client ids. `others` is the
+        list of the ids of the clients on the sequence that are not
+        geolocalized, or no longer exist.
+    """
+    sequence = delivery_history.client_id_sequence or []
+    clients = Client.objects.filter(
+        pk__in=sequence,
+        member__address__latitude__isnull=False,
+        member__address__longitude__isnull=False
+    ).select_related('member__address').in_bulk()
+    tour = [starting_point()]
+    others = []
+    for client_id in sequence:
+        client = clients.get(client_id)
+        if client is None:
+            others.append(client_id)
+        else:
+            tour.append(tsp.Node(client.pk,
+                                 float(client.member.address.latitude),
+                                 float(client.member.address.longitude)))
+    return tour, others
+
+
+def insert_client(delivery_history, client, metric=tsp.HAVERSINE):
+    """Inserts a client at the cheapest position of a delivery sequence.
+
+    The sequence is not optimised again (see tsp.insert_node), so this
+    is fast enough for last-minute changes. A client already on the
+    sequence is moved. The DeliveryHistory is saved.
+
+    Args:
+        delivery_history: A DeliveryHistory object.
+        client: A Client object.
+        metric: The distance metric, see tsp.DistanceMatrix.
+
+    Returns:
+        The new client id sequence.
+
+    Raises:
+        ValueError: The client is not geolocalized.
+    """
+    address = client.member.address
+    if address is None or address.latitude is None or \
+            address.longitude is None:
+        raise ValueError("The client {} is not geolocalized.".format(
+            client.pk))
+    tour, others = get_sequence_tour(delivery_history)
+    tour = [node for node in tour if node.id != client.pk]
+    tour = tsp.insert_node(
+        tour,
+        tsp.Node(client.pk, float(address.latitude),
+                 float(address.longitude)),
+        metric=metric)
+    delivery_history.client_id_sequence = (
+        [node.id for node in tour[1:]] + others)
+    delivery_history.save()
+    return delivery_history.client_id_sequence
+
+
+def remove_client(delivery_history, client_id, metric=tsp.HAVERSINE):
+    """Removes a client from a delivery sequence and repairs it locally.
+
+    See tsp.remove_node. The DeliveryHistory is saved.
+
+    Args:
+        delivery_history: A DeliveryHistory object.
+        client_id: The id of the client to remove.
+        metric: The distance metric, see tsp.DistanceMatrix.
+
+    Returns:
+        The new client id sequence.
+
+    Raises:
+        ValueError: The client is not on the sequence.
+    """
+    tour, others = get_sequence_tour(delivery_history)
+    if client_id in others:
+        others.remove(client_id)
+    else:
+        positions = [i for i, node in enumerate(tour)
+                     if i > 0 and node.id == client_id]
+        if not positions:
+            raise ValueError(
+                "The client {} is not on the delivery sequence.".format(
+                    client_id))
+        tour = tsp.remove_node(tour, positions[0], metric=metric)
+    delivery_history.client_id_sequence = (
+        [node.id for node in tour[1:]] + others)
+    delivery_history.save()
+    return delivery_history.client_id_sequence
@@ -68,4 +68,33 @@ $(function() {
         });
         $(self).attr('disabled', 'disabled');
     });
+
+    // Kitchen count: poll the background generation of the PDF files
+    function enableReport($button) {
+        $button.removeClass('disabled').attr('title', $button.data('ready-title'));
+    }
+
+    function pollReportJob() {
+        var $job = $('.report-job[data-url]');
+        $.getJSON($job.data('url'), function (job) {
+            if (!job.finished) {
+                setTimeout(pollReportJob, 2000);
+                return;
+            }
+            $job.find('.report-status').remove();
+            if (job.status === 'F') {
+                $job.find('.report-failed').show();
+            }
+            if (job.num_pages > 0) {
+                enableReport($job.find('.report-kitchen-count'));
+            }
+            if (job.num_labels > 0) {
+                enableReport($job.find('.report-labels'));
+            }
+        });
+    }
+
+    if ($('.report-job[data-url]').length) {
+        pollReportJob();
+    }
 });
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_avoided_ingredient_index(apps, schema_editor):
+    Client_avoid_ingredient = apps.get_model(
+        'member', 'Client_avoid_ingredient')
+    Restriction = apps.get_model('member', 'Restriction')
+    Incompatibility = apps.get_model('meal', 'Incompatibility')
+    AvoidedIngredientIndex = apps.get_model(
+        'member', 'AvoidedIngredientIndex')
+
+    # Same as AvoidedIngredientIndexManager.rebuild
+    rows = set()
+    for client_id, ingredient_id in \
+            Client_avoid_ingredient.objects.values_list(
+                'client_id', 'ingredient_id'):
+        rows.add((client_id, ingredient_id, None))
+    ingredients = {}
+    for restricted_item_id, ingredient_id in \
+            Incompatibility.objects.values_list(
+                'restricted_item_id', 'ingredient_id'):
+        ingredients.setdefault(restricted_item_id, []).append(ingredient_id)
+    for client_id, restricted_item_id in Restriction.objects.values_list(
+            'client_id', 'restricted_item_id'):
+        for ingredient_id in ingredients.get(restricted_item_id, []):
+            rows.add((client_id, ingredient_id, restricted_item_id))
+    AvoidedIngredientIndex.objects.bulk_create(
+        AvoidedIngredientIndex(client_id=client_id,
+                               ingredient_id=ingredient_id,
+                               restricted_item_id=restricted_item_id)
+        for client_id, ingredient_id, restricted_item_id in rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meal', '0007_auto_20170313_1442'),
+        ('member', '0031_client_option_allow_reverse_relation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvoidedIngredientIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='member.Client', verbose_name='client')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='meal.Ingredient', verbose_name='ingredient')),
+                ('restricted_item', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='meal.Restricted_item', verbose_name='restricted item')),
+            ],
+        ),
+        migrations.RunPython(build_avoided_ingredient_index,
+                             migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
+import collections
+import copy
 import datetime
 import math
 import json
-from django.db import models
+import threading
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.functions import Extract
 from django.forms import ValidationError
@@ -16,7 +19,7 @@ from annoying.fields import JSONField
 from member.formsfield import CAPhoneNumberExtField
 from meal.models import (
     COMPONENT_GROUP_CHOICES, COMPONENT_GROUP_CHOICES_MAIN_DISH,
-    COMPONENT_GROUP_CHOICES_SIDES
+    COMPONENT_GROUP_CHOICES_SIDES, Incompatibility
 )
 from note.models import Note
 
@@ -88,6 +91,22 @@ ROUTE_VEHICLES = (
 
 DEFAULT_VEHICLE = ROUTE_VEHICLES[0][0]
 
+# Number of parsed meals schedules kept by a process, see Client.schedule.
+CLIENT_SCHEDULE_CACHE_SIZE = 4096
+
+ClientSchedule = collections.namedtuple(  # Parsed meals schedule of a client.
+    'ClientSchedule',
+    ['simple_meals_schedule',  # Delivery days, or None if not set
+     'meals_default',          # Tuple ((weekday, meal default), ...)
+     'meals_schedule',         # Same as meals_default, delivery days only
+     'meal_default_week',      # Copy of the field it was parsed from
+     'delivery_type'])         # Delivery type it was parsed with
+# The meal defaults are dictionaries {component group or 'size': value}.
+
+# {(client id, updated_at): ClientSchedule}, least recently used first.
+_schedule_cache = collections.OrderedDict()
+_schedule_cache_lock = threading.Lock()
+
 
 class Member(models.Model):
 
@@ -592,6 +611,11 @@ class Client(models.Model):
         null=True
     )
 
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        null=True
+    )
+
     ingredients_to_avoid = models.ManyToManyField(
         'meal.Ingredient',
         through='Client_avoid_ingredient'
@@ -678,53 +702,110 @@ class Client(models.Model):
         """
         return self.client_notes.all()
 
+    def save(self, *args, **kwargs):
+        # updated_at changes, and with it the key of the schedule.
+        self._schedule = None
+        super(Client, self).save(*args, **kwargs)
+
     @property
-    def simple_meals_schedule(self):
+    def schedule(self):
         """
-        Returns a list of days, corresponding to the client's delivery
-        days.
+        Returns the parsed meals schedule of the client, a ClientSchedule.
+
+        It is kept by the instance, and by the process in a cache keyed by
+        the client id and updated_at, so that the client options and meal
+        defaults are parsed once per change. Saving the client or its
+        options changes updated_at (see invalidate_schedule). The values
+        of the schedule are shared and must not be modified.
         """
+        schedule = getattr(self, '_schedule', None)
+        if schedule is not None and self._is_schedule_current(schedule):
+            return schedule
+        key = None
+        if (self.pk is not None and
+                'updated_at' not in self.get_deferred_fields() and
+                self.updated_at is not None):
+            key = (self.pk, self.updated_at)
+            with _schedule_cache_lock:
+                schedule = _schedule_cache.get(key)
+                if schedule is not None:
+                    _schedule_cache.move_to_end(key)
+        # The instance may have been changed without being saved.
+        if schedule is None or not self._is_schedule_current(schedule):
+            schedule = self._parse_schedule()
+            if key is not None:
+                with _schedule_cache_lock:
+                    _schedule_cache[key] = schedule
+                    _schedule_cache.move_to_end(key)
+                    while len(_schedule_cache) > CLIENT_SCHEDULE_CACHE_SIZE:
+                        _schedule_cache.popitem(last=False)
+        self._schedule = schedule
+        return schedule
+
+    def _is_schedule_current(self, schedule):
+        return (schedule.delivery_type == self.delivery_type and
+                schedule.meal_default_week == self.meal_default_week)
+
+    def _parse_schedule(self):
+        simple_meals_schedule = None
         for co in self.client_option_set.all():
             if co.option.name == 'meals_schedule':
                 try:
-                    return json.loads(co.value)
+                    simple_meals_schedule = json.loads(co.value)
+                    break
                 except (ValueError, TypeError):  # JSON error
                     continue
-        return None
-
-    @property
-    def meals_default(self):
-        """
-        Returns a list of tuple ((weekday, meal default), ...) that
-        represents what the client wants on particular days.
-
-        The "meal default" always contains all available components.
-        If not set, it will be None.
 
-        It is possible to have zero value, representing that the client
-        has said no to a component on a particular day.
-        """
+        meal_default_week = self.meal_default_week or {}
         defaults = []
         for day, str in DAYS_OF_WEEK:
             current = {}
-            numeric_fields = []
             for component, label in COMPONENT_GROUP_CHOICES:
                 if component is COMPONENT_GROUP_CHOICES_SIDES:
                     continue  # skip "Sides"
-                item = self.meal_default_week.get(
+                current[component] = meal_default_week.get(
                     component + '_' + day + '_quantity'
                 )
-                current[component] = item
-                numeric_fields.append(item)
-
-            size = self.meal_default_week.get(
+            current['size'] = meal_default_week.get(
                 'size_' + day
             )
-            current['size'] = size
-
             defaults.append((day, current))
 
-        return defaults
+        if self.delivery_type == 'E' or simple_meals_schedule is None:
+            prefs = ()
+        else:
+            prefs = tuple((day, meal_schedule)
+                          for day, meal_schedule in defaults
+                          if day in simple_meals_schedule)
+        return ClientSchedule(
+            simple_meals_schedule=simple_meals_schedule,
+            meals_default=tuple(defaults),
+            meals_schedule=prefs,
+            meal_default_week=copy.copy(self.meal_default_week),
+            delivery_type=self.delivery_type)
+
+    @property
+    def simple_meals_schedule(self):
+        """
+        Returns a list of days, corresponding to the client's delivery
+        days.
+        """
+        return copy.deepcopy(self.schedule.simple_meals_schedule)
+
+    @property
+    def meals_default(self):
+        """
+        Returns a list of tuple ((weekday, meal default), ...) that
+        represents what the client wants on particular days.
+
+        The "meal default" always contains all available components.
+        If not set, it will be None.
+
+        It is possible to have zero value, representing that the client
+        has said no to a component on a particular day.
+        """
+        return [(day, dict(current))
+                for day, current in self.schedule.meals_default]
 
     @property
     def meals_schedule(self):
@@ -735,17 +816,11 @@ class Client(models.Model):
         Intended to be called only for Ongoing clients. For episodic clients
         or if `simple_meals_schedule` is not set, it returns empty tuple.
         """
-        defaults = self.meals_default
-        prefs = []
-        simple_meals_schedule = self.simple_meals_schedule
-
-        if self.delivery_type == 'E' or simple_meals_schedule is None:
+        schedule = self.schedule
+        if self.delivery_type == 'E' or schedule.simple_meals_schedule is None:
             return ()
-        else:
-            for day, meal_schedule in defaults:
-                if day in simple_meals_schedule:
-                    prefs.append((day, meal_schedule))
-            return prefs
+        return [(day, dict(meal_schedule))
+                for day, meal_schedule in schedule.meals_schedule]
 
     def set_simple_meals_schedule(self, schedule):
         """
@@ -755,9 +830,22 @@ class Client(models.Model):
         """
         meal_schedule_option, _ = Option.objects.get_or_create(
             name='meals_schedule')
+        # The client is in the defaults too, so that the option refers to
+        # this instance when it is updated: the schedule of this instance
+        # is invalidated by the signal handler of Client_option.
         client_option, _ = Client_option.objects.update_or_create(
             client=self, option=meal_schedule_option,
-            defaults={'value': json.dumps(schedule)})
+            defaults={'client': self, 'value': json.dumps(schedule)})
+
+    def invalidate_schedule(self):
+        """
+        Parse the meals schedule again on the next access, after a change
+        of the client options. See schedule.
+        """
+        # A new key for the schedule cached by the processes.
+        self.updated_at = timezone.now()
+        Client.objects.filter(pk=self.pk).update(updated_at=self.updated_at)
+        self._schedule = None
 
 
 class ClientScheduledStatus(models.Model):
@@ -1113,3 +1201,92 @@ class Client_avoid_component(models.Model):
         return "{} {} <has> {}".format(self.client.member.firstname,
                                        self.client.member.lastname,
                                        self.component.name)
+
+
+class AvoidedIngredientIndexManager(models.Manager):
+
+    @transaction.atomic
+    def rebuild(self, client_ids=None):
+        """Recompute the index of some clients from their requirements.
+
+        Args:
+            client_ids: A list of client ids, or None for all clients.
+        """
+        avoided = Client_avoid_ingredient.objects.all()
+        restrictions = Restriction.objects.all()
+        index = self.all()
+        if client_ids is not None:
+            client_ids = list(client_ids)
+            avoided = avoided.filter(client_id__in=client_ids)
+            restrictions = restrictions.filter(client_id__in=client_ids)
+            index = index.filter(client_id__in=client_ids)
+        index.delete()
+
+        rows = set()
+        for client_id, ingredient_id in avoided.values_list(
+                'client_id', 'ingredient_id'):
+            rows.add((client_id, ingredient_id, None))
+        restricted = restrictions.values_list(
+            'client_id', 'restricted_item_id')
+        ingredients = {}
+        for restricted_item_id, ingredient_id in \
+                Incompatibility.objects.filter(
+                    restricted_item_id__in={r for c, r in restricted}
+                ).values_list('restricted_item_id', 'ingredient_id'):
+            ingredients.setdefault(restricted_item_id, []).append(
+                ingredient_id)
+        for client_id, restricted_item_id in restricted:
+            for ingredient_id in ingredients.get(restricted_item_id, []):
+                rows.add((client_id, ingredient_id, restricted_item_id))
+        self.bulk_create(
+            AvoidedIngredientIndex(client_id=client_id,
+                                   ingredient_id=ingredient_id,
+                                   restricted_item_id=restricted_item_id)
+            for client_id, ingredient_id, restricted_item_id in rows)
+
+    def rebuild_restricted_items(self):
+        """Recompute the index of all the clients having restrictions."""
+        self.rebuild(Restriction.objects.values_list(
+            'client_id', flat=True).distinct())
+
+
+class AvoidedIngredientIndex(models.Model):
+    """The ingredients that a client must avoid.
+
+    This is the closure of the client's restricted items through the
+    incompatibilities, with the ingredients that he avoids explicitly,
+    so that clashes with a menu can be found with a single join. It is
+    kept up to date by the signal handlers of the member app: saves
+    rebuild the index of the clients concerned, deletions only remove
+    the rows that depended on the deleted object, which is safe during
+    cascading deletions.
+    """
+    client = models.ForeignKey(
+        'member.Client',
+        verbose_name=_('client'),
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+
+    ingredient = models.ForeignKey(
+        'meal.Ingredient',
+        verbose_name=_('ingredient'),
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+
+    # None for an ingredient that the client avoids explicitly
+    restricted_item = models.ForeignKey(
+        'meal.Restricted_item',
+        verbose_name=_('restricted item'),
+        related_name='+',
+        null=True,
+        on_delete=models.CASCADE
+    )
+
+    objects = AvoidedIngredientIndexManager()
+
+    def __str__(self):
+        return "{} <avoids> {} ({})".format(self.client_id,
+                                            self.ingredient_id,
+                                            self.restricted_item_id)
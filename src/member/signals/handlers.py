@@ -1,7 +1,9 @@
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from ..models import ClientScheduledStatus
+from meal.models import Incompatibility
+from ..models import (AvoidedIngredientIndex, Client, Client_avoid_ingredient,
+                      Client_option, ClientScheduledStatus, Restriction)
 
 
 @receiver(
@@ -12,3 +14,56 @@ from ..models import ClientScheduledStatus
 def ensure_pair_remove(sender, instance, **kwargs):
     if instance.get_pair:
         ClientScheduledStatus.objects.get(pk=instance.get_pair.pk).delete()
+
+
+@receiver(post_save, sender=Restriction,
+          dispatch_uid="post_save.avoided_ingredient_index_restriction")
+@receiver(post_save, sender=Client_avoid_ingredient,
+          dispatch_uid="post_save.avoided_ingredient_index_avoid_ingredient")
+def client_avoided_ingredients_saved(sender, instance, **kwargs):
+    AvoidedIngredientIndex.objects.rebuild([instance.client_id])
+
+
+@receiver(post_delete, sender=Restriction,
+          dispatch_uid="post_delete.avoided_ingredient_index_restriction")
+def restriction_deleted(sender, instance, **kwargs):
+    AvoidedIngredientIndex.objects.filter(
+        client_id=instance.client_id,
+        restricted_item_id=instance.restricted_item_id).delete()
+
+
+@receiver(post_delete, sender=Client_avoid_ingredient,
+          dispatch_uid="post_delete.avoided_ingredient_index_avoid_ingredient")
+def avoid_ingredient_deleted(sender, instance, **kwargs):
+    AvoidedIngredientIndex.objects.filter(
+        client_id=instance.client_id,
+        ingredient_id=instance.ingredient_id,
+        restricted_item__isnull=True).delete()
+
+
+@receiver(post_save, sender=Incompatibility,
+          dispatch_uid="post_save.avoided_ingredient_index_incompatibility")
+def incompatibility_saved(sender, instance, **kwargs):
+    # The previous restricted item or ingredient of the incompatibility
+    # is not known: incompatibilities are rarely modified.
+    AvoidedIngredientIndex.objects.rebuild_restricted_items()
+
+
+@receiver(post_delete, sender=Incompatibility,
+          dispatch_uid="post_delete.avoided_ingredient_index_incompatibility")
+def incompatibility_deleted(sender, instance, **kwargs):
+    AvoidedIngredientIndex.objects.filter(
+        restricted_item_id=instance.restricted_item_id,
+        ingredient_id=instance.ingredient_id).delete()
+
+
+@receiver(post_save, sender=Client_option,
+          dispatch_uid="post_save.client_schedule_option")
+@receiver(post_delete, sender=Client_option,
+          dispatch_uid="post_delete.client_schedule_option")
+def client_option_changed(sender, instance, **kwargs):
+    # The meals schedule is a client option.
+    if Client_option.client.is_cached(instance):
+        instance.client.invalidate_schedule()
+    else:
+        Client(pk=instance.client_id).invalidate_schedule()
@@ -9,18 +9,21 @@ from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.utils.six import StringIO
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 
 from member.models import (
     Member, Client, Address, Referencing,
     Contact, Option, Client_option, Restriction, Route,
     Client_avoid_ingredient, Client_avoid_component,
-    ClientScheduledStatus,
+    ClientScheduledStatus, AvoidedIngredientIndex,
     CELL, HOME, EMAIL, DAYS_OF_WEEK
 )
 from meal.models import (
-    Restricted_item, Ingredient, Component, COMPONENT_GROUP_CHOICES
+    Restricted_item, Ingredient, Component, COMPONENT_GROUP_CHOICES,
+    Incompatibility, Menu
 )
-from order.models import Order
+from order.models import Order, kitchen_requirements
 from member.factories import(
     RouteFactory, ClientFactory, ClientScheduledStatusFactory,
     MemberFactory, EmergencyContactFactory, DeliveryHistoryFactory
@@ -527,6 +530,62 @@ class ClientMealDefaultWeekTestCase(TestCase):
         ms = self.clientTest.meals_schedule
         self.assertEqual(ms, ())
 
+    def test_client_schedule_cached(self):
+        """
+        The schedule is parsed once per instance, and once per process for
+        the instances of the same client.
+        """
+        # A new updated_at, that is not in the cache yet
+        Client.objects.get(pk=self.clientTest.pk).save()
+        client = Client.objects.get(pk=self.clientTest.pk)
+        with self.assertNumQueries(2):  # client options and their option
+            ms = client.meals_schedule
+        with self.assertNumQueries(0):
+            self.assertEqual(client.meals_schedule, ms)
+            self.assertEqual(client.simple_meals_schedule,
+                             ['monday', 'wednesday', 'friday'])
+        client = Client.objects.get(pk=self.clientTest.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(client.meals_schedule, ms)
+        # The values returned can be modified.
+        client.meals_schedule[0][1]['main_dish'] = 5
+        self.assertEqual(dict(client.meals_schedule)['monday']['main_dish'], 1)
+
+    def test_client_schedule_invalidated(self):
+        """
+        The schedule is parsed again when the client or its meals schedule
+        change.
+        """
+        client = Client.objects.get(pk=self.clientTest.pk)
+        self.assertEqual(len(client.meals_schedule), 3)
+        updated_at = client.updated_at
+        with CaptureQueriesContext(connection) as queries:
+            client.set_simple_meals_schedule(['monday'])
+        # updated_at is changed once
+        self.assertEqual(
+            len([query for query in queries.captured_queries
+                 if query['sql'].startswith('UPDATE "member_client"')]), 1)
+        self.assertGreater(client.updated_at, updated_at)
+        self.assertEqual(dict(client.meals_schedule).keys(), {'monday'})
+        self.assertEqual(
+            dict(Client.objects.get(pk=client.pk).meals_schedule).keys(),
+            {'monday'})
+
+        client.meal_default_week = dict(client.meal_default_week,
+                                        main_dish_monday_quantity=3)
+        self.assertEqual(
+            dict(client.meals_schedule)['monday']['main_dish'], 3)
+        client.delivery_type = 'E'
+        client.save()
+        self.assertEqual(Client.objects.get(pk=client.pk).meals_schedule, ())
+
+        other = Client.objects.get(pk=client.pk)
+        other.delivery_type = 'O'
+        other.save()
+        Client_option.objects.filter(client=client).delete()
+        self.assertIsNone(
+            Client.objects.get(pk=client.pk).simple_meals_schedule)
+
 
 class RestrictionTestCase(TestCase):
 
@@ -595,6 +654,77 @@ class ClientAvoidIngredientTestCase(TestCase):
         self.assertTrue(ingredient.name in str(client_avoid_ingredient))
 
 
+class AvoidedIngredientIndexTestCase(TestCase):
+
+    fixtures = ['routes.json']
+
+    def setUp(self):
+        self.restricted_client = ClientFactory()
+        self.pork = Restricted_item.objects.create(
+            name='pork', restricted_item_group='meat')
+        self.bacon = Ingredient.objects.create(name='bacon')
+        self.ham = Ingredient.objects.create(name='ham')
+        self.walnuts = Ingredient.objects.create(name='walnuts')
+        Incompatibility.objects.create(restricted_item=self.pork,
+                                       ingredient=self.bacon)
+        self.delivery_date = date.today()
+        Menu.objects.create(date=self.delivery_date)
+        OrderFactory(client=self.restricted_client,
+                     delivery_date=self.delivery_date)
+
+    def assertIndex(self, ingredients):
+        """The kitchen finds the given ingredients to avoid."""
+        self.assertEqual(
+            {row.ingredient for row in kitchen_requirements(
+                self.delivery_date, self.delivery_date,
+                [self.restricted_client.pk])
+             if row.ingredient is not None},
+            {ingredient.name for ingredient in ingredients})
+
+    def test_index_follows_requirements(self):
+        self.assertIndex([])
+        restriction = Restriction.objects.create(
+            client=self.restricted_client, restricted_item=self.pork)
+        self.assertIndex([self.bacon])
+        incompatibility = Incompatibility.objects.create(
+            restricted_item=self.pork, ingredient=self.ham)
+        self.assertIndex([self.bacon, self.ham])
+        Client_avoid_ingredient.objects.create(
+            client=self.restricted_client, ingredient=self.walnuts)
+        self.assertIndex([self.bacon, self.ham, self.walnuts])
+        incompatibility.delete()
+        self.assertIndex([self.bacon, self.walnuts])
+        restriction.delete()
+        self.assertIndex([self.walnuts])
+        self.restricted_client.ingredients_to_avoid.clear()
+        self.assertIndex([])
+
+    def test_rebuild(self):
+        Restriction.objects.create(
+            client=self.restricted_client, restricted_item=self.pork)
+        Client_avoid_ingredient.objects.create(
+            client=self.restricted_client, ingredient=self.bacon)
+        rows = set(AvoidedIngredientIndex.objects.values_list(
+            'client_id', 'ingredient_id', 'restricted_item_id'))
+        self.assertEqual(rows, {
+            (self.restricted_client.pk, self.bacon.pk, self.pork.pk),
+            (self.restricted_client.pk, self.bacon.pk, None)})
+        AvoidedIngredientIndex.objects.all().delete()
+        AvoidedIngredientIndex.objects.rebuild()
+        self.assertEqual(set(AvoidedIngredientIndex.objects.values_list(
+            'client_id', 'ingredient_id', 'restricted_item_id')), rows)
+
+    def test_cascading_deletions(self):
+        Restriction.objects.create(
+            client=self.restricted_client, restricted_item=self.pork)
+        Client_avoid_ingredient.objects.create(
+            client=self.restricted_client, ingredient=self.walnuts)
+        self.walnuts.delete()
+        self.assertIndex([self.bacon])
+        self.restricted_client.delete()
+        self.assertFalse(AvoidedIngredientIndex.objects.exists())
+
+
 class ClientAvoidComponentTestCase(TestCase):
 
     @classmethod
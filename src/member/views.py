@@ -767,7 +767,8 @@ class ClientAllergiesView(ClientView):
         context['active_tab'] = 'prefs'
         context['client_status'] = Client.CLIENT_STATUS
         context['weekdays'] = DAYS_OF_WEEK
-        sms = self.object.simple_meals_schedule
+        schedule = self.object.schedule
+        sms = schedule.simple_meals_schedule
         if sms:
             weekdays_dict = dict(DAYS_OF_WEEK)
             context['delivery_days'] = list(map(
@@ -778,7 +779,7 @@ class ClientAllergiesView(ClientView):
             lambda t: t[0] != COMPONENT_GROUP_CHOICES_SIDES,
             COMPONENT_GROUP_CHOICES
         ))
-        context['meals_default'] = dict(self.object.meals_default)
+        context['meals_default'] = dict(schedule.meals_default)
         context['size_choices'] = dict(SIZE_CHOICES)
 
         """
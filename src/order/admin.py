@@ -1,9 +1,13 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
 from order.models import Order, Order_item, OrderStatusChange
 
 
 def make_delivered(modeladmin, request, queryset):
-    queryset.update(status='D')
+    try:
+        Order.objects.update_orders_status(queryset, 'D')
+    except ValidationError as error:
+        modeladmin.message_user(request, error.messages[0], messages.ERROR)
 make_delivered.short_description = "Mark selected orders as delivered"
 
 
@@ -0,0 +1,165 @@
+"""Generation of the scheduled orders of the ongoing clients.
+
+The clients are split in shards by route, and the shards can be run in
+parallel by several processes, each with its own database connection.
+Since a client is in one shard only, two shards never create the same
+order, and the orders that another process creates at the same time are
+skipped, see OrderManager.insert_ignore.
+"""
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import time
+
+from django.db import connections
+from django.db.models import prefetch_related_objects
+
+from member.models import Client
+from .models import Order, ORDER_BULK_BATCH_SIZE
+
+OrderGeneration = collections.namedtuple(  # Summary of a generation.
+    'OrderGeneration',
+    ['clients',    # Number of clients
+     'existing',   # Number of orders that already existed
+     'created',    # Number of orders created
+     'orders',     # Counter {delivery date: created and existing orders}
+     'timings'])   # OrderedDict {phase: seconds}
+
+
+def shard_clients(clients, shards):
+    """Split clients in shards, keeping the clients of a route together.
+
+    The routes are assigned from the largest to the smallest, each one to
+    the shard having the fewest clients so far.
+
+    Args:
+        clients : A list of (client id, route id) tuples.
+        shards : The maximum number of shards.
+
+    Returns:
+        A list of non-empty lists of client ids.
+    """
+    routes = collections.defaultdict(list)
+    for client_id, route_id in clients:
+        routes[route_id].append(client_id)
+    result = [[] for i in range(max(shards, 1))]
+    for route_id, client_ids in sorted(
+            routes.items(), key=lambda item: (-len(item[1]), str(item[0]))):
+        min(result, key=len).extend(client_ids)
+    return [client_ids for client_ids in result if client_ids]
+
+
+def generate_orders(delivery_dates, client_ids,
+                    batch_size=ORDER_BULK_BATCH_SIZE, shard=None):
+    """Create the scheduled orders of ongoing clients on several dates.
+
+    The clients, their schedules and the existing orders are loaded once,
+    the orders are planned in memory, then inserted in batches. See
+    OrderManager.plan_orders and OrderManager.insert_orders.
+
+    Args:
+        delivery_dates : A list of datetime.date objects.
+        client_ids : The ids of the clients, or None for all the ongoing
+            clients.
+        batch_size : The number of orders inserted per transaction.
+        shard : If given, the number of the shard printed with the
+            progress.
+
+    Returns:
+        An OrderGeneration object.
+    """
+    timings = collections.OrderedDict()
+    prefix = '' if shard is None else "Shard {}: ".format(shard)
+
+    start = time.perf_counter()
+    clients = Client.ongoing.all()
+    if client_ids is not None:
+        clients = clients.filter(pk__in=client_ids)
+    clients = list(clients)
+    prefetch_related_objects(clients, 'client_option_set__option')
+    existing = Order.objects.existing_orders(delivery_dates, clients)
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan = Order.objects.plan_orders(delivery_dates, clients, existing)
+    timings['plan'] = time.perf_counter() - start
+
+    def progress(inserted, total):
+        print("{0}{1}/{2} orders inserted.".format(prefix, inserted, total))
+
+    start = time.perf_counter()
+    Order.objects.insert_orders(plan, batch_size, progress)
+    timings['insert'] = time.perf_counter() - start
+
+    return OrderGeneration(
+        clients=len(clients), existing=len(existing),
+        created=len(plan.new_orders),
+        orders=collections.Counter(
+            order.delivery_date for order in plan.orders),
+        timings=timings)
+
+
+def generate_orders_shard(delivery_dates, client_ids, batch_size, shard):
+    """Run generate_orders in a worker process.
+
+    The connection inherited from the parent process is closed by
+    generate_orders_in_parallel, so that the shard opens its own.
+    """
+    try:
+        return generate_orders(delivery_dates, client_ids, batch_size, shard)
+    finally:
+        connections.close_all()
+
+
+def merge_generations(generations):
+    """Merge the summaries of shards run in parallel.
+
+    The counts are added, and the time of a phase is that of the slowest
+    shard.
+
+    Returns:
+        An OrderGeneration object.
+    """
+    timings = collections.OrderedDict()
+    orders = collections.Counter()
+    for generation in generations:
+        orders.update(generation.orders)
+        for phase, seconds in generation.timings.items():
+            timings[phase] = max(timings.get(phase, 0), seconds)
+    return OrderGeneration(
+        clients=sum(g.clients for g in generations),
+        existing=sum(g.existing for g in generations),
+        created=sum(g.created for g in generations),
+        orders=orders, timings=timings)
+
+
+def generate_orders_in_parallel(delivery_dates, workers,
+                                batch_size=ORDER_BULK_BATCH_SIZE):
+    """Create the scheduled orders of all the ongoing clients.
+
+    The clients are sharded by route (see shard_clients) and every shard
+    is run by a process of its own, with its own database connection and
+    transactions.
+
+    Args:
+        delivery_dates : A list of datetime.date objects.
+        workers : The number of processes. With 1, the orders are
+            created by this process.
+        batch_size : The number of orders inserted per transaction.
+
+    Returns:
+        An OrderGeneration object.
+    """
+    shards = []
+    if workers != 1:
+        shards = shard_clients(
+            Client.ongoing.values_list('pk', 'route_id'), workers)
+    if len(shards) < 2:
+        return generate_orders(delivery_dates, None, batch_size)
+    # The worker processes must not share the connection of this one.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        generations = list(executor.map(
+            generate_orders_shard,
+            [delivery_dates] * len(shards), shards,
+            [batch_size] * len(shards), range(1, len(shards) + 1)))
+    return merge_generations(generations)
@@ -1,13 +1,20 @@
+import collections
+import time
+
 from django.core.management.base import BaseCommand
-from order.models import Order
-from member.models import Client
+from order.generation import generate_orders_in_parallel
+from order.models import ORDER_BULK_BATCH_SIZE
 from datetime import datetime, timedelta
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 
 
 class Command(BaseCommand):
     help = 'Create new orders for a given delivery date for all\
-            ongoing active clients using their meals defaults.'
+            ongoing active clients using their meals defaults.\
+            The clients, their schedules and the existing orders are\
+            loaded once for all the days, and the orders are inserted\
+            in batches. The clients can be split by route between\
+            several processes.'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -23,22 +30,40 @@ class Command(BaseCommand):
             default=1,
             type=int
         )
+        parser.add_argument(
+            '--batch-size',
+            help='The number of orders inserted per transaction.',
+            default=ORDER_BULK_BATCH_SIZE,
+            type=int
+        )
+        parser.add_argument(
+            '--workers',
+            help=(
+                'The number of processes creating the orders, each one '
+                'for the clients of some routes.'
+            ),
+            default=1,
+            type=int
+        )
 
     def handle(self, *args, **options):
         start_date = datetime.strptime(
             options['delivery_date'], '%Y-%m-%d'
         ).date()
         days = options['days']
+        delivery_dates = [start_date + timedelta(days=i)
+                          for i in range(days)]
 
         # Only active ongoing clients can receive orders
-        clients = Client.ongoing.all()
+        generation = generate_orders_in_parallel(
+            delivery_dates, options['workers'], options['batch_size'])
+        print("{0} clients, {1} existing orders, {2} orders created "
+              "in {3} days from {4}.".format(
+                  generation.clients, generation.existing,
+                  generation.created, days, start_date))
 
-        for i in range(days):
-            # Create the orders
-            delivery_date = start_date + timedelta(days=i)
-            orders = Order.objects.auto_create_orders(
-                delivery_date, clients
-            )
+        start = time.perf_counter()
+        for delivery_date in delivery_dates:
             # Log the execution
             LogEntry.objects.log_action(
                 user_id=1, content_type_id=1,
@@ -47,5 +72,11 @@ class Command(BaseCommand):
                 action_flag=ADDITION,
             )
             print("{0} orders created on {1}: to be delivered on {2}.".format(
-                len(orders), start_date, delivery_date
+                generation.orders[delivery_date], start_date, delivery_date
             ))
+        timings = collections.OrderedDict(generation.timings)
+        timings['log'] = time.perf_counter() - start
+
+        print("Timings: " + ", ".join(
+            "{0} {1:.2f}s".format(phase, seconds)
+            for phase, seconds in timings.items()))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 02:25
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations, models
+
+
+def find_duplicates(Order):
+    """
+    Several active orders of a client on the same date could be created
+    before. The order that went further than 'Ordered' is kept, else the
+    last one; the other ones, still 'Ordered', are cancelled. Delivered,
+    billed or paid orders are never changed: when a client has several of
+    them on a date, they must be resolved by hand.
+
+    Returns:
+      The orders to cancel, as a list of (pk, delivery date), and the
+      conflicts to resolve, as a list of strings.
+    """
+    orders = {}
+    for pk, client_id, delivery_date, status in Order.objects.exclude(
+            status='C').order_by('-pk').values_list(
+                'pk', 'client_id', 'delivery_date', 'status'):
+        orders.setdefault((client_id, delivery_date), []).append(
+            (pk, status))
+    duplicates = []
+    conflicts = []
+    for (client_id, delivery_date), group in sorted(orders.items()):
+        if len(group) == 1:
+            continue
+        processed = [pk for pk, status in group if status != 'O']
+        if len(processed) > 1:
+            conflicts.append("client {}, {}: orders {}".format(
+                client_id, delivery_date,
+                ", ".join(str(pk) for pk in sorted(processed))))
+        kept = processed[0] if processed else group[0][0]
+        duplicates.extend((pk, delivery_date) for pk, status in group
+                          if pk != kept and status == 'O')
+    return duplicates, conflicts
+
+
+def check_duplicates(apps, schema_editor):
+    # Runs before the schema is changed, so that the migration can be
+    # run again once the conflicts are resolved.
+    duplicates, conflicts = find_duplicates(apps.get_model('order', 'Order'))
+    if conflicts:
+        raise RuntimeError(
+            "Some clients have several delivered, billed or paid orders "
+            "on the same date. Cancel the extra orders, then run the "
+            "migration again:\n" + "\n".join(conflicts))
+
+
+def set_is_active(apps, schema_editor):
+    Order = apps.get_model('order', 'Order')
+    OrderStatusChange = apps.get_model('order', 'OrderStatusChange')
+    KitchenSnapshot = apps.get_model('delivery', 'KitchenSnapshot')
+    Order.objects.filter(status='C').update(is_active=None)
+    duplicates, conflicts = find_duplicates(Order)
+    for start in range(0, len(duplicates), 500):
+        batch = duplicates[start:start + 500]
+        OrderStatusChange.objects.bulk_create([
+            OrderStatusChange(
+                order_id=pk, status_from='O', status_to='C',
+                reason='Duplicate order of the client on this date')
+            for pk, delivery_date in batch])
+        Order.objects.filter(
+            pk__in=[pk for pk, delivery_date in batch]
+        ).update(status='C', is_active=None)
+    # The kitchen counts of the coming dates change.
+    KitchenSnapshot.objects.filter(
+        date__in=set(delivery_date for pk, delivery_date in duplicates),
+        date__gte=date.today()).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0003_kitchensnapshot'),
+        ('member', '0032_avoidedingredientindex'),
+        ('order', '0015_auto_20170410_1029'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='order',
+            name='is_active',
+            field=models.NullBooleanField(default=True, editable=False, verbose_name='active'),
+        ),
+        migrations.RunPython(set_is_active, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='order',
+            unique_together=set([('client', 'delivery_date', 'is_active')]),
+        ),
+    ]
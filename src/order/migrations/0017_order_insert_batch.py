@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 02:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0016_order_is_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='insert_batch',
+            field=models.CharField(default=None, editable=False, max_length=32, null=True, verbose_name='insert batch'),
+        ),
+    ]
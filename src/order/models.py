@@ -1,9 +1,12 @@
 import collections
 from datetime import date, datetime
 import re
+import uuid
 
-from django.db import models, connection, transaction
+from django.db import (models, connection, connections, transaction,
+                       IntegrityError)
 from django.db.models import Q
+from django.db.models.sql import InsertQuery
 from django.utils.translation import ugettext_lazy as _
 from django_filters import FilterSet, ChoiceFilter, CharFilter
 from django.urls import reverse
@@ -32,6 +35,7 @@ ORDER_STATUS = (
 )
 
 ORDER_STATUS_ORDERED = ORDER_STATUS[0][0]
+ORDER_STATUS_CANCELLED = ORDER_STATUS[3][0]
 
 SIZE_CHOICES = (
     ('', ''),
@@ -59,6 +63,72 @@ SIDE_PRICE_LOW_INCOME = 0.75
 MAIN_PRICE_SOLIDARY = 3.50
 SIDE_PRICE_SOLIDARY = 0.50
 
+# Number of orders inserted per transaction by bulk_create_orders.
+ORDER_BULK_BATCH_SIZE = 500
+
+OrderPlan = collections.namedtuple(  # Orders to create, see plan_orders.
+    'OrderPlan',
+    ['orders',      # Created and existing orders, by date then client
+     'new_orders',  # Order objects to insert, without primary key
+     'items'])      # {(client id, delivery date): unsaved Order_items}
+
+
+def order_is_active(status):
+    """
+    Value of Order.is_active for an order status: True, or None for a
+    cancelled order.
+    """
+    return None if status == ORDER_STATUS_CANCELLED else True
+
+
+# Database vendors whose INSERT statements can skip the duplicate rows,
+# see insert_ignore_sql.
+INSERT_IGNORE_VENDORS = ('mysql', 'sqlite', 'postgresql')
+
+
+def insert_ignore_sql(conn, statement, pk_column='id'):
+    """
+    Change an INSERT statement so that the rows breaking a unique index
+    are skipped instead of raising an error. The other errors (NULL
+    values, foreign keys, data too long) are still raised.
+    """
+    if conn.vendor == 'mysql':
+        # INSERT IGNORE would also turn the other errors into warnings.
+        return statement + ' ON DUPLICATE KEY UPDATE {0} = {0}'.format(
+            conn.ops.quote_name(pk_column))
+    if conn.vendor == 'sqlite':
+        return statement.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+    if conn.vendor == 'postgresql':
+        return statement + ' ON CONFLICT DO NOTHING'
+    raise NotImplementedError(
+        "Unsupported database: {}".format(conn.vendor))
+
+
+def scheduled_items(items):
+    """
+    Convert the items of one day of a meals schedule into the items of
+    an order, as expected by create_order.
+
+    Parameters:
+      items : a dictionary {component group or 'size': value}, or None
+
+    Returns:
+      A dictionary, empty if nothing is scheduled.
+    """
+    if items is None:
+        return {}
+    individual_items = {}
+    for key, value in items.items():
+        # Skip the items that are not scheduled
+        if value is None:
+            continue
+        if 'size' in key:
+            replaced_key = key + '_default'
+        else:
+            replaced_key = key + '_default_quantity'
+        individual_items[replaced_key] = value
+    return individual_items
+
 
 class OrderManager(models.Manager):
 
@@ -156,49 +226,228 @@ class OrderManager(models.Manager):
           clients : a list of one or many client objects
 
         Returns:
-          Created orders.
+          Created orders, and the orders that already existed for these
+          clients on this date.
         """
-        created_orders = []
-        messages = []
-        weekday = delivery_date.weekday()  # Monday is 0, Sunday is 6
-        day = DAYS_OF_WEEK[weekday][0]     # 0 -> 'monday', 6 -> 'sunday'
-        for client in clients:
-            try:
-                order = Order.objects.get(client=client,
-                                          delivery_date=delivery_date)
-                created_orders.append(order)
-                continue
-            except Order.DoesNotExist:
-                # If no order for this client/date, create it and attach items
-                items = dict(client.meals_schedule).get(day, None)
+        return self.bulk_create_orders([delivery_date], clients)
 
-                # Skip this client if no scheduled delivery
-                if items is None:
-                    continue
+    def bulk_create_orders(self, delivery_dates, clients,
+                           batch_size=ORDER_BULK_BATCH_SIZE):
+        """
+        Create the orders of the given clients on several delivery dates,
+        from their meals schedule, as auto_create_orders does.
 
-                filtered_items = {
-                    k: v for k, v in items.items() if v is not None
-                }
+        The existing orders are loaded in one query, and the new orders and
+        order items are inserted with bulk_create, `batch_size` orders per
+        transaction. See plan_orders and insert_orders.
+
+        Parameters:
+          delivery_dates : a list of dates
+          clients : a list or queryset of client objects
+
+        Returns:
+          The created and existing orders, by date then in the order of
+          the clients.
+        """
+        clients = list(clients)
+        plan = self.plan_orders(
+            delivery_dates, clients,
+            self.existing_orders(delivery_dates, clients))
+        self.insert_orders(plan, batch_size)
+        return plan.orders
+
+    def existing_orders(self, delivery_dates, clients):
+        """
+        Load the active orders of the given clients on several delivery
+        dates, in one query. Cancelled orders are ignored, so that the
+        client gets a new order.
+
+        Returns:
+          A dictionary {(client id, delivery date): order}.
+        """
+        # Filtering on the dates only keeps the query short when there
+        # are many clients.
+        client_ids = set(client.id for client in clients)
+        return {
+            (order.client_id, order.delivery_date): order
+            for order in self.filter(
+                delivery_date__in=delivery_dates,
+                is_active=True).select_related('client')
+            if order.client_id in client_ids
+        }
+
+    def plan_orders(self, delivery_dates, clients, existing):
+        """
+        Build in memory the orders to create for the given clients on
+        several delivery dates, from their meals schedule.
+
+        The schedule of a client is read once, and its items are computed
+        once per weekday. The items and prices are those of create_order.
 
-                # Skip this client if nothing to order
-                if not filtered_items:
+        Parameters:
+          delivery_dates : a list of dates
+          clients : a list of client objects
+          existing : the orders that must not be created again, see
+            existing_orders
+
+        Returns:
+          An OrderPlan object.
+        """
+        models.prefetch_related_objects(clients, 'client_option_set__option')
+        plan = OrderPlan(orders=[], new_orders=[], items={})
+        weekdays = {}  # (client id, weekday) -> scheduled items
+        for delivery_date in delivery_dates:
+            weekday = delivery_date.weekday()
+            for client in clients:
+                order = existing.get((client.id, delivery_date))
+                if order is not None:
+                    plan.orders.append(order)
+                    continue
+                if (client.id, weekday) not in weekdays:
+                    schedule = dict(client.schedule.meals_schedule)
+                    for i, (day, trans) in enumerate(DAYS_OF_WEEK):
+                        weekdays[(client.id, i)] = scheduled_items(
+                            schedule.get(day))
+                items = weekdays[(client.id, weekday)]
+                if not items:
                     continue
+                order = Order(client=client, delivery_date=delivery_date)
+                plan.items[(client.id, delivery_date)] = \
+                    self.make_order_items(
+                        items, self.get_client_prices(client))
+                plan.orders.append(order)
+                plan.new_orders.append(order)
+        return plan
+
+    def insert_orders(self, plan, batch_size=ORDER_BULK_BATCH_SIZE,
+                      progress=None):
+        """
+        Insert the new orders of a plan and their items with bulk_create,
+        `batch_size` orders per transaction.
 
-                individual_items = {}
-                for key, value in filtered_items.items():
-                    if 'size' in key:
-                        replaced_key = key + '_default'
-                    else:
-                        replaced_key = key + '_default_quantity'
-                    individual_items[replaced_key] = value
+        Since bulk_create sends no signal, the kitchen snapshots of the
+        clients are marked dirty here.
 
-                prices = self.get_client_prices(client)
-                order = self.create_order(
-                    delivery_date, client, individual_items, prices
-                )
+        The orders that another process created at the same time are
+        skipped (see insert_ignore), and replaced in the plan by the
+        orders of the other process. The orders of a batch are told apart
+        from them by a marker stored in Order.insert_batch.
 
-                created_orders.append(order)
-        return created_orders
+        Parameters:
+          plan : an OrderPlan object
+          batch_size : the number of orders per transaction
+          progress : if given, a function called after each transaction
+            with the number of orders inserted so far and the total
+
+        Returns:
+          The number of orders inserted, which is also the length of
+          plan.new_orders.
+        """
+        # This needs to be placed on the top when the snapshots are moved
+        # out of delivery. It causes a circular dependancy otherwise.
+        from delivery.models import KitchenSnapshot  # noqa
+        new_orders = list(plan.new_orders)
+        replaced = {}  # id of a skipped order -> order of another process
+        for start in range(0, len(new_orders), batch_size):
+            batch = new_orders[start:start + batch_size]
+            keys = set((o.client_id, o.delivery_date) for o in batch)
+            marker = uuid.uuid4().hex
+            for order in batch:
+                order.insert_batch = marker
+            with transaction.atomic():
+                self.insert_ignore(batch)
+                # The primary keys are not returned: read them back. The
+                # orders of this batch have its marker, unlike the orders
+                # created at the same time by another process.
+                pks = {}
+                others = {}
+                for order in self.filter(
+                        client__in=set(key[0] for key in keys),
+                        delivery_date__in=set(key[1] for key in keys),
+                        is_active=True):
+                    key = (order.client_id, order.delivery_date)
+                    if key not in keys:
+                        continue
+                    if order.insert_batch == marker:
+                        pks[key] = order.pk
+                    else:
+                        others[key] = order
+                batch_items = []
+                for order in batch:
+                    key = (order.client_id, order.delivery_date)
+                    if key not in pks:
+                        replaced[id(order)] = others.get(key)
+                        continue
+                    order.pk = pks[key]
+                    order._state.adding = False
+                    order._state.db = self.db
+                    for item in plan.items[key]:
+                        item.order = order
+                        batch_items.append(item)
+                Order_item.objects.bulk_create(batch_items)
+
+                dates = collections.defaultdict(list)
+                for order in batch:
+                    if order.pk is not None:
+                        dates[order.delivery_date].append(order.client_id)
+                for delivery_date, client_ids in dates.items():
+                    KitchenSnapshot.objects.mark_dirty(
+                        client_ids, delivery_date)
+            if progress is not None:
+                progress(start + len(batch), len(new_orders))
+
+        if replaced:
+            plan.new_orders[:] = [
+                o for o in plan.new_orders if id(o) not in replaced]
+            plan.orders[:] = [
+                replaced.get(id(o), o) for o in plan.orders
+                if replaced.get(id(o), o) is not None]
+        return len(plan.new_orders)
+
+    def insert_ignore(self, orders):
+        """
+        Insert orders, skipping those whose client already has an active
+        order on the delivery date, without reading the table first.
+
+        The orders are inserted with one statement per batch of the
+        database (ON DUPLICATE KEY UPDATE on MySQL, INSERT OR IGNORE on
+        sqlite, ON CONFLICT DO NOTHING on PostgreSQL), relying on the
+        unique index of Order. On the other databases, they are inserted
+        one by one, each in a savepoint. The primary keys of the orders
+        are not set, and the number of orders inserted is not returned,
+        since MySQL also counts the skipped rows: read the orders back.
+        """
+        conn = connections[self.db]
+        fields = [field for field in self.model._meta.concrete_fields
+                  if not isinstance(field, models.AutoField)]
+        if conn.vendor not in INSERT_IGNORE_VENDORS:
+            for order in orders:
+                try:
+                    with transaction.atomic(using=self.db):
+                        self._insert_sql(conn, fields, [order])
+                except IntegrityError:
+                    if not order.has_other_active_order():
+                        raise
+            return
+        batch_size = max(conn.ops.bulk_batch_size(fields, orders), 1)
+        for start in range(0, len(orders), batch_size):
+            self._insert_sql(
+                conn, fields, orders[start:start + batch_size],
+                lambda statement: insert_ignore_sql(
+                    conn, statement, self.model._meta.pk.column))
+
+    def _insert_sql(self, conn, fields, orders, change_sql=None):
+        """
+        Insert orders with an INSERT statement, changed by `change_sql`
+        if given.
+        """
+        query = InsertQuery(self.model)
+        query.insert_values(fields, orders)
+        with conn.cursor() as cursor:
+            for statement, params in query.get_compiler(self.db).as_sql():
+                if change_sql is not None:
+                    statement = change_sql(statement)
+                cursor.execute(statement, params)
 
     def create_batch_orders(self, delivery_dates, client, items,
                             override_dates=[], return_created_orders=False):
@@ -212,17 +461,13 @@ class OrderManager(models.Manager):
             delivery_date = datetime.strptime(
                 delivery_date_str, "%Y-%m-%d"
             ).date()
-            prior_order = Order.objects.filter(
-                client=client, delivery_date=delivery_date
-            )
-            if prior_order.exists():
-                if delivery_date_str in override_dates:
-                    # If an order is already created, override the original(s)
-                    for x in prior_order:
-                        x.status = 'C'
-                        x.save()
-                else:
-                    continue
+            if delivery_date_str in override_dates:
+                # If an order is already created, override the original(s)
+                for x in Order.objects.filter(
+                        client=client, delivery_date=delivery_date,
+                        is_active=True):
+                    x.status = 'C'
+                    x.save()
             individual_items = {}
             for key, value in items.items():
                 if delivery_date_str in key:
@@ -231,9 +476,13 @@ class OrderManager(models.Manager):
                         'default'
                     )
                     individual_items[replaced_key] = value
-            order = self.create_order(
-                delivery_date, client, individual_items, prices
-            )
+            try:
+                order = self.create_order(
+                    delivery_date, client, individual_items, prices
+                )
+            except IntegrityError:
+                # The client already has an active order on this date
+                continue
             created_orders.append(order)
 
         if not return_created_orders:
@@ -255,9 +504,28 @@ class OrderManager(models.Manager):
                 ...
             }
         Every main dish comes with a free side dish. (thus not billable)
+
+        Raises IntegrityError if the client already has an active order on
+        the delivery date.
         """
         order = Order.objects.create(client=client,
                                      delivery_date=delivery_date)
+        for order_item in self.make_order_items(items, prices):
+            order_item.order = order
+            order_item.save()
+
+        return order
+
+    def make_order_items(self, items, prices):
+        """
+        Build the order items of an order, without saving them.
+        See create_order for the format of items.
+        Every main dish comes with a free side dish. (thus not billable)
+
+        Returns:
+          A list of Order_item objects, whose order is not set.
+        """
+        order_items = []
         free_side_dishes = items.get('main_dish_default_quantity') or 0
 
         for component_group, trans in COMPONENT_GROUP_CHOICES:
@@ -269,7 +537,6 @@ class OrderManager(models.Manager):
                     continue
 
                 common_kwargs = {
-                    'order': order,
                     'component_group': component_group,
                     'order_item_type': ORDER_ITEM_TYPE_CHOICES_COMPONENT
                 }
@@ -279,52 +546,62 @@ class OrderManager(models.Manager):
                     if items['size_default'] == 'L':
                         price += item_qty * prices['side']
                     # main dish
-                    Order_item.objects.create(
+                    order_items.append(Order_item(
                         size=items['size_default'],
                         total_quantity=item_qty,
                         price=price,
                         billable_flag=True,
-                        **common_kwargs)
+                        **common_kwargs))
                 else:
                     # side dish: deduct+billable
                     deduct = min(free_side_dishes, item_qty)
                     free_side_dishes -= deduct
                     if deduct > 0:
                         # free side dishes
-                        Order_item.objects.create(
+                        order_items.append(Order_item(
                             size=None,
                             total_quantity=deduct,
                             price=deduct * prices['side'],
                             billable_flag=False,
-                            **common_kwargs)
+                            **common_kwargs))
 
                     billable = item_qty - deduct
                     if billable > 0:
                         # billable side dishes
-                        Order_item.objects.create(
+                        order_items.append(Order_item(
                             size=None,
                             total_quantity=billable,
                             price=billable * prices['side'],
                             billable_flag=True,
-                            **common_kwargs)
+                            **common_kwargs))
 
         for order_item_type, trans in ORDER_ITEM_TYPE_CHOICES:
             if order_item_type != ORDER_ITEM_TYPE_CHOICES_COMPONENT:
                 additional = items.get('{0}_default'.format(order_item_type))
                 if additional:
-                    Order_item.objects.create(
-                        order=order,
+                    order_items.append(Order_item(
                         price=0,
                         billable_flag=False,
-                        order_item_type=order_item_type)
+                        order_item_type=order_item_type))
 
-        return order
+        return order_items
 
     """
     Allow changing status of multiple orders at once.
+
+    Raises ValidationError if a cancelled order would become active while
+    its client has another active order on the delivery date.
     """
     def update_orders_status(self, orders, new):
-        count = orders.update(status=new)
+        try:
+            with transaction.atomic():
+                count = orders.update(
+                    status=new, is_active=order_is_active(new))
+        except IntegrityError:
+            raise ValidationError(
+                _("This client already has an order on this date."),
+                code='duplicate_order'
+            )
         return count
 
 
@@ -333,6 +610,9 @@ class Order(models.Model):
     class Meta:
         verbose_name_plural = _('orders')
         ordering = ['-delivery_date']
+        # A client has at most one active order per delivery date: the
+        # cancelled orders are not in the index, since is_active is NULL.
+        unique_together = ('client', 'delivery_date', 'is_active')
 
     # Order information
     creation_date = models.DateField(
@@ -360,8 +640,52 @@ class Order(models.Model):
         on_delete=models.CASCADE
     )
 
+    # True, or None when the order is cancelled, see save().
+    is_active = models.NullBooleanField(
+        verbose_name=_('active'),
+        default=True,
+        editable=False
+    )
+
+    # Marker of the batch of OrderManager.insert_orders that inserted the
+    # order, if any.
+    insert_batch = models.CharField(
+        verbose_name=_('insert batch'),
+        max_length=32,
+        null=True,
+        default=None,
+        editable=False
+    )
+
     objects = OrderManager()
 
+    def clean(self):
+        """
+        Make sure that the client has no other active order on the
+        delivery date.
+        """
+        if order_is_active(self.status) and self.has_other_active_order():
+            raise ValidationError(
+                _("This client already has an order on this date."),
+                code='duplicate_order'
+            )
+
+    def has_other_active_order(self):
+        """
+        Check whether the client has another active order on the delivery
+        date.
+        """
+        return bool(
+            self.client_id and self.delivery_date and
+            Order.objects.filter(
+                client_id=self.client_id,
+                delivery_date=self.delivery_date,
+                is_active=True).exclude(pk=self.pk).exists())
+
+    def save(self, *args, **kwargs):
+        self.is_active = order_is_active(self.status)
+        super(Order, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('order:view', kwargs={'pk': self.pk})
 
@@ -425,7 +749,7 @@ class Order(models.Model):
         )
 
     @staticmethod
-    def get_kitchen_items(delivery_date):
+    def get_kitchen_items(delivery_date, client_ids=None):
         """Get all client meal order specifics for delivery date.
 
         For each client that has ordered a meal for 'delivery_date',
@@ -433,99 +757,97 @@ class Order(models.Model):
         and the Meal Labels. This information is stored in KitchenItem
         objects. (See KitchenItem for description of each attribute).
 
+        The data is fetched with two queries, grouped by the database,
+        whatever the number of clients.
+
         Args:
             delivery_date: A datetime.date object, the date on which
                 the meals will be delivered to the clients.
+            client_ids: If given, a list of the ids of the only
+                clients to consider.
 
         Returns:
             A dictionary where the key is an Integer 'client id' and
             the value is a KitchenItem named tuple.
         """
-        kitchen_list = {}
+        return Order.get_kitchen_items_range(
+            delivery_date, delivery_date, client_ids).get(delivery_date, {})
 
-        # Day's avoid ingredients clashes.
-        for row in day_avoid_ingredient(delivery_date):
-            check_for_new_client(kitchen_list, row)
-            if (row.oiorderid and row.menucompid and
-                    row.component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH):
-                # found avoid ingredient clash in main dish
-                # should be a sorted set (or ordered dict ?)
-                kitchen_list[row.cid].incompatible_ingredients.append(
-                    row.ingredient)
-            # we Know that it is not incompatible with main dish
-            if (row.oiorderid and row.menucompid and
-                    row.component_group == COMPONENT_GROUP_CHOICES_SIDES and
-                    row.ingredient not in
-                    kitchen_list[row.cid].sides_clashes):
-                # found new avoid ingredient clash in sides
-                kitchen_list[row.cid].sides_clashes.append(
-                    row.ingredient)
-            if (row.ingredient not in
-                    kitchen_list[row.cid].avoid_ingredients):
-                # remember ingredient to avoid
-                kitchen_list[row.cid].avoid_ingredients.append(
-                    row.ingredient)
+    @staticmethod
+    def get_kitchen_items_range(start_date, end_date, client_ids=None):
+        """Get all client meal order specifics for a range of dates.
 
-        # Day's restrictions.
-        for row in day_restrictions(delivery_date):
-            check_for_new_client(kitchen_list, row)
-            if (row.oiorderid and row.menucompid and
-                    row.component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH):
-                # found restriction clash in main dish
-                # should be a sorted set
-                kitchen_list[row.cid].incompatible_ingredients.append(
-                    row.ingredient)
-            if (row.oiorderid and row.menucompid and
-                    row.component_group == COMPONENT_GROUP_CHOICES_SIDES and
-                    row.restricted_item not in
-                    kitchen_list[row.cid].sides_clashes):
-                # found new restriction clash in sides
-                kitchen_list[row.cid].sides_clashes.append(
-                    row.restricted_item)
-            if (row.restricted_item not in
-                    kitchen_list[row.cid].restricted_items):
-                # remember restricted_item
-                kitchen_list[row.cid].restricted_items.append(
-                    row.restricted_item)
+        Same as get_kitchen_items for each day from 'start_date' to
+        'end_date' included, with the same two queries whatever the
+        number of days.
 
-        # Day's preparations.
-        for row in day_preparations(delivery_date):
-            check_for_new_client(kitchen_list, row)
-            # should be a sorted set
-            # found client with food preparation
-            kitchen_list[row.cid].preparation.append(row.food_prep)
+        Args:
+            start_date: A datetime.date object, the first delivery date.
+            end_date: A datetime.date object, the last delivery date.
+            client_ids: If given, a list of the ids of the only
+                clients to consider.
 
-        # Day's Delivery Items, Components summary and Data for all labels.
-        for row in day_delivery_items(delivery_date):
+        Returns:
+            An OrderedDict where the key is a datetime.date object and
+            the value is the dictionary returned by get_kitchen_items
+            for this date, sorted by date. Dates without orders are
+            not included.
+        """
+        kitchen_lists = collections.OrderedDict()
+        if client_ids is not None and not client_ids:
+            return kitchen_lists
+
+        # Days' clashes, restrictions and preparations.
+        for row in kitchen_requirements(start_date, end_date, client_ids):
+            kitchen_list = kitchen_lists.setdefault(
+                sql_date(row.delivery_date), {})
             check_for_new_client(kitchen_list, row)
+            item = kitchen_list[row.cid]
+            if row.food_prep is not None:
+                # found client with food preparation
+                item.preparation.add(row.food_prep)
+                continue
+            if row.restricted_item is not None:
+                # remember restricted_item
+                item.restricted_items.add(row.restricted_item)
+                sides_clash = row.restricted_item
+            else:
+                # remember ingredient to avoid
+                item.avoid_ingredients.add(row.ingredient)
+                sides_clash = row.ingredient
+            if row.clash_group == COMPONENT_GROUP_CHOICES_MAIN_DISH:
+                # found clash in main dish
+                item.incompatible_ingredients.add(row.ingredient)
+            elif row.clash_group == COMPONENT_GROUP_CHOICES_SIDES:
+                # found clash in sides
+                item.sides_clashes.add(sides_clash)
+
+        # Days' Delivery Items, Components summary and Data for all labels.
+        for row in kitchen_components(start_date, end_date, client_ids):
+            kitchen_list = kitchen_lists.setdefault(
+                sql_date(row.delivery_date), {})
+            check_for_new_client(kitchen_list, row)
+            item = kitchen_list[row.cid]
+            quantity = row.total_quantity or 0
             if row.component_group == COMPONENT_GROUP_CHOICES_MAIN_DISH:
-                kitchen_list[row.cid] = kitchen_list[row.cid]._replace(
-                    meal_qty=(kitchen_list[row.cid].meal_qty +
-                              row.total_quantity),
-                    meal_size=row.size)
-            old_component = \
-                kitchen_list[row.cid].meal_components.get(row.component_group)
-            if old_component:
+                item.meal_qty += quantity
+                item.meal_size = row.size
+            component = item.meal_components.get(row.component_group)
+            if component:
                 # component group already exists in the order
-                kitchen_list[row.cid].meal_components[row.component_group] = \
-                    old_component._replace(
-                        qty=old_component.qty + (row.total_quantity or 0))
+                component.qty += quantity
             else:
                 # new component group for this order
-                kitchen_list[row.cid].meal_components[row.component_group] = \
-                    MealComponent(id=row.component_id,
-                                  name=row.component_name,
-                                  qty=row.total_quantity or 0)
-            kitchen_list[row.cid] = kitchen_list[row.cid]._replace(
-                routename=row.routename)
-
-        # Sort requirements list in each value.
-        for value in kitchen_list.values():
-            value.incompatible_ingredients.sort()
-            value.restricted_items.sort()
-            value.preparation.sort()
+                item.meal_components[row.component_group] = \
+                    MealComponentBuilder(id=row.component_id,
+                                         name=row.component_name,
+                                         qty=quantity)
+            item.routename = row.routename
 
-        return kitchen_list
+        return collections.OrderedDict(
+            (delivery_date, {client_id: item.freeze()
+                             for client_id, item in kitchen_list.items()})
+            for delivery_date, kitchen_list in sorted(kitchen_lists.items()))
 
     @staticmethod
     def get_delivery_list(delivery_date, route_id):
@@ -742,46 +1064,89 @@ def sql_exec(query, values, heading=''):
     return rows
 
 
-def day_avoid_ingredient(delivery_date):
-    """ Get day's avoid ingredients clashes.
+def sql_client_filter(client_ids, values):
+    """Build the SQL condition restricting a query to some clients.
 
-    For each client that has ordered a meal for 'delivery_date', find all
-    the ingredients that he avoids and identify which of those
-    ingredients are included in the main dish for 'delivery_date'.
-    Note that the 'avoid ingredients' are the ones that the client specified
-    explicitly.
+    Modifies 'values' by adding the parameters of the condition.
 
     Args:
-        delivery_date: A datetime.date object, the date on which the meals will
-            be delivered to the clients.
+        client_ids: A list of client ids, or None for all clients.
+        values: A dictionary of parameter values : {'name': value, ...}.
+
+    Returns:
+        A string to add to the WHERE clause of the query.
+    """
+    if client_ids is None:
+        return ''
+    names = []
+    for i, client_id in enumerate(client_ids):
+        names.append('%(client_id_{})s'.format(i))
+        values['client_id_{}'.format(i)] = client_id
+    return 'AND member_client.id IN ({})'.format(', '.join(names))
+
+
+def sql_date(value):
+    """Convert a date returned by a raw SQL query to a datetime.date.
+
+    Some databases return the dates of a UNION as strings.
+    """
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value
+
+
+def kitchen_requirements(start_date, end_date, client_ids=None):
+    """ Get days' clashes, restrictions and preparations.
+
+    For each client that has ordered a meal for a date from
+    'start_date' to 'end_date' (column 'delivery_date'), find:
+      - the ingredients that he avoids (column 'ingredient');
+      - his restricted items (column 'restricted_item'), with each of the
+        ingredients that correspond to them (column 'ingredient'), and
+        once without ingredient;
+      - his food preparations (column 'food_prep').
+    When one of these ingredients is included in a component of the
+    menu of that date that the client ordered, 'clash_group' is
+    the component group of this component. Note that the 'avoid
+    ingredients' are the ones that the client specified explicitly.
+
+    The ingredients are read from the AvoidedIngredientIndex, clashes
+    are found by joining it with the ingredients of the day.
+
+    Duplicate rows are removed by the database.
+
+    Args:
+        start_date: A datetime.date object, the first delivery date.
+        end_date: A datetime.date object, the last delivery date.
+        client_ids: If given, only these clients are considered.
 
     Returns:
         A list of named tuples, each one containing the columns specified
         in the SELECT clause.
     """
     query = """
-    SELECT member_client.id AS cid,
+    SELECT order_order.delivery_date, member_client.id AS cid,
       member_member.firstname, member_member.lastname,
-      order_order.id AS oid,
-      order_order.delivery_date,
-      meal_menu.id AS menuid,
-      meal_menu_component.id AS menucompid,
       meal_ingredient.name AS ingredient,
-      meal_component.name AS compname,
-      meal_component.component_group,
-      order_order_item.id AS oiid,
-      order_order_item.order_id AS oiorderid
+      meal_restricted_item.name AS restricted_item,
+      NULL AS food_prep,
+      CASE WHEN order_order_item.order_id IS NOT NULL AND
+                meal_menu_component.id IS NOT NULL
+           THEN meal_component.component_group END AS clash_group
     FROM member_member
       JOIN member_client ON member_client.member_id = member_member.id
       JOIN order_order ON order_order.client_id = member_client.id
-      JOIN meal_menu ON meal_menu.date =                      %(delivery_date)s
-      JOIN member_client_avoid_ingredient ON
-        member_client_avoid_ingredient.client_id = member_client.id
+      JOIN meal_menu ON meal_menu.date = order_order.delivery_date
+      JOIN member_avoidedingredientindex ON
+        member_avoidedingredientindex.client_id = member_client.id
       JOIN meal_ingredient ON
-        meal_ingredient.id = member_client_avoid_ingredient.ingredient_id
+        meal_ingredient.id = member_avoidedingredientindex.ingredient_id
+      LEFT OUTER JOIN meal_restricted_item ON
+        meal_restricted_item.id =
+          member_avoidedingredientindex.restricted_item_id
       LEFT OUTER JOIN meal_component_ingredient ON
         meal_component_ingredient.ingredient_id = meal_ingredient.id AND
-          meal_component_ingredient.date =                    %(delivery_date)s
+          meal_component_ingredient.date = order_order.delivery_date
       LEFT OUTER JOIN meal_component ON
         meal_component.id = meal_component_ingredient.component_id
       LEFT OUTER JOIN order_order_item ON
@@ -792,99 +1157,32 @@ def day_avoid_ingredient(delivery_date):
       LEFT OUTER JOIN meal_menu_component ON
         meal_menu_component.component_id = meal_component.id AND
           meal_menu_component.menu_id = meal_menu.id
-    WHERE order_order.delivery_date =                         %(delivery_date)s
-    ORDER BY member_client.id
-    """
-    values = {'delivery_date': delivery_date,
-              'comp_grp_sides': COMPONENT_GROUP_CHOICES_SIDES,
-              'comp_grp_main_dish': COMPONENT_GROUP_CHOICES_MAIN_DISH}
-    return sql_exec(query, values, "****** Avoid ingredients ******")
-
-
-def day_restrictions(delivery_date):
-    """ Get day's restrictions.
-
-    For each client that has ordered a meal for 'delivery_date', find all
-    the ingredients that correspond to the restricted items that he specified
-    and identify which of those ingredients are included in the main dish
-    for 'delivery_date'.
-
-    Args:
-        delivery_date: A datetime.date object, the date on which the meals will
-            be delivered to the clients.
-
-    Returns:
-        A list of named tuples, each one containing the columns specified
-        in the SELECT clause.
-    """
-    query = """
-    SELECT member_client.id AS cid,
+    WHERE order_order.delivery_date BETWEEN %(start_date)s AND %(end_date)s
+      {client_filter}
+    UNION
+    SELECT order_order.delivery_date, member_client.id AS cid,
       member_member.firstname, member_member.lastname,
-      order_order.id AS oid,
-      order_order.delivery_date,
-      meal_menu.id AS menuid,
-      meal_menu_component.id AS menucompid,
+      NULL AS ingredient,
       meal_restricted_item.name AS restricted_item,
-      meal_ingredient.name AS ingredient,
-      meal_component.name AS compname,
-      meal_component.component_group,
-      order_order_item.id AS oiid,
-      order_order_item.order_id AS oiorderid
+      NULL AS food_prep,
+      NULL AS clash_group
     FROM member_member
       JOIN member_client ON member_client.member_id = member_member.id
       JOIN order_order ON order_order.client_id = member_client.id
-      JOIN meal_menu ON meal_menu.date =                      %(delivery_date)s
+      JOIN meal_menu ON meal_menu.date = order_order.delivery_date
       JOIN member_restriction ON
         member_restriction.client_id = member_client.id
       JOIN meal_restricted_item ON
         meal_restricted_item.id = member_restriction.restricted_item_id
-      LEFT OUTER JOIN meal_incompatibility ON
-        meal_incompatibility.restricted_item_id =
-          member_restriction.restricted_item_id
-      LEFT OUTER JOIN meal_ingredient ON
-        meal_incompatibility.ingredient_id = meal_ingredient.id
-      LEFT OUTER JOIN meal_component_ingredient ON
-        meal_component_ingredient.ingredient_id = meal_ingredient.id AND
-          meal_component_ingredient.date =                    %(delivery_date)s
-      LEFT OUTER JOIN meal_component ON
-        meal_component_ingredient.component_id = meal_component.id
-      LEFT OUTER JOIN order_order_item ON
-        order_order_item.order_id = order_order.id AND
-          (order_order_item.component_group = meal_component.component_group OR
-            (order_order_item.component_group = %(comp_grp_main_dish)s AND
-             meal_component.component_group = %(comp_grp_sides)s))
-      LEFT OUTER JOIN meal_menu_component ON
-        meal_menu_component.component_id = meal_component.id AND
-          meal_menu_component.menu_id = meal_menu.id
-    WHERE order_order.delivery_date =                         %(delivery_date)s
-    ORDER BY member_client.id
-    """
-    values = {'delivery_date': delivery_date,
-              'comp_grp_sides': COMPONENT_GROUP_CHOICES_SIDES,
-              'comp_grp_main_dish': COMPONENT_GROUP_CHOICES_MAIN_DISH}
-    return sql_exec(query, values, "****** Restrictions ******")
-
-
-def day_preparations(delivery_date):
-    """ Get day's preparations.
-
-    For each client that has ordered a meal for 'delivery_date', find all
-    the food preparations that he specified.
-
-    Args:
-        delivery_date: A datetime.date object, the date on which the meals will
-            be delivered to the clients.
-
-    Returns:
-        A list of named tuples, each one containing the columns specified
-        in the SELECT clause.
-    """
-    query = """
-    SELECT member_client.id AS cid,
+    WHERE order_order.delivery_date BETWEEN %(start_date)s AND %(end_date)s
+      {client_filter}
+    UNION
+    SELECT order_order.delivery_date, member_client.id AS cid,
       member_member.firstname, member_member.lastname,
+      NULL AS ingredient,
+      NULL AS restricted_item,
       member_option.name AS food_prep,
-      order_order.id AS oid,
-      order_order.delivery_date
+      NULL AS clash_group
     FROM member_member
       JOIN member_client ON member_client.member_id = member_member.id
       JOIN member_client_option ON
@@ -894,54 +1192,65 @@ def day_preparations(delivery_date):
       JOIN order_order_item ON
         order_order_item.component_group =           %(comp_grp_main_dish)s AND
           order_order_item.order_id = order_order.id
-    WHERE order_order.delivery_date =                     %(delivery_date)s AND
-      member_option.option_group =                             %(option_group)s
-    ORDER BY member_member.lastname, member_member.firstname
+    WHERE order_order.delivery_date BETWEEN %(start_date)s AND %(end_date)s
+      AND member_option.option_group =                         %(option_group)s
+      {client_filter}
+    ORDER BY delivery_date, cid
     """
-    values = {'delivery_date': delivery_date,
+    values = {'start_date': start_date,
+              'end_date': end_date,
               'option_group': OPTION_GROUP_CHOICES_PREPARATION,
+              'comp_grp_sides': COMPONENT_GROUP_CHOICES_SIDES,
               'comp_grp_main_dish': COMPONENT_GROUP_CHOICES_MAIN_DISH}
-    return sql_exec(query, values, "****** Preparations ******")
+    query = query.format(client_filter=sql_client_filter(client_ids, values))
+    return sql_exec(query, values, "****** Requirements ******")
 
 
-def day_delivery_items(delivery_date):
-    """ Get day's Delivery Items.
+def kitchen_components(start_date, end_date, client_ids=None):
+    """ Get days' Delivery Items, grouped by date, client and component.
 
-    For each client that has ordered something for 'delivery_date', find his
-    route and all the details and quantities for the items that have to
-    be delivered.
+    For each client that has ordered something for a date from
+    'start_date' to 'end_date' (column 'delivery_date'), find his route
+    and the total quantity ordered of each component of the menu of
+    that date.
 
     Args:
-        delivery_date: A datetime.date object, the date on which the meals will
-            be delivered to the clients.
+        start_date: A datetime.date object, the first delivery date.
+        end_date: A datetime.date object, the last delivery date.
+        client_ids: If given, only these clients are considered.
 
     Returns:
         A list of named tuples, each one containing the columns specified
         in the SELECT clause.
     """
     query = """
-    SELECT member_client.id AS cid,
+    SELECT order_order.delivery_date, member_client.id AS cid,
       member_member.firstname, member_member.lastname,
       member_route.name AS routename,
-      order_order_item.total_quantity, order_order_item.size,
-      meal_menu.id AS menuid,
-      meal_menu_component.id AS mencomid,
+      SUM(order_order_item.total_quantity) AS total_quantity,
+      MAX(order_order_item.size) AS size,
       meal_component.id AS component_id, meal_component.component_group,
       meal_component.name AS component_name
     FROM member_member
       JOIN member_client ON member_client.member_id = member_member.id
       JOIN member_route ON member_route.id = member_client.route_id
-      JOIN meal_menu ON meal_menu.date =                      %(delivery_date)s
       JOIN order_order ON order_order.client_id = member_client.id
+      JOIN meal_menu ON meal_menu.date = order_order.delivery_date
       JOIN order_order_item ON order_order_item.order_id = order_order.id
       JOIN meal_menu_component ON meal_menu_component.menu_id = meal_menu.id
       JOIN meal_component ON
         meal_component.id = meal_menu_component.component_id AND
           meal_component.component_group = order_order_item.component_group
-    WHERE order_order.delivery_date =                         %(delivery_date)s
-    ORDER BY member_member.lastname, member_member.firstname
+    WHERE order_order.delivery_date BETWEEN %(start_date)s AND %(end_date)s
+      {client_filter}
+    GROUP BY order_order.delivery_date, member_client.id,
+      member_member.firstname, member_member.lastname, member_route.name,
+      meal_component.id, meal_component.component_group, meal_component.name
+    ORDER BY order_order.delivery_date, member_member.lastname,
+      member_member.firstname, meal_component.id
     """
-    values = {'delivery_date': delivery_date}
+    values = {'start_date': start_date, 'end_date': end_date}
+    query = query.format(client_filter=sql_client_filter(client_ids, values))
     return sql_exec(query, values, "****** Delivery List ******")
 
 
@@ -958,6 +1267,7 @@ KitchenItem = collections.namedtuple(         # Meal specifics for an order.
      'restricted_items',             # All restricted items for the client
      'preparation',                  # All food preparations for the client
      'meal_components'])             # List of MealComponents objects
+# The lists of strings are sorted and have no duplicates.
 
 
 MealComponent = collections.namedtuple(       # Component specifics for a meal.
@@ -967,31 +1277,78 @@ MealComponent = collections.namedtuple(       # Component specifics for a meal.
      'qty'])                         # Quantity of this component in the order
 
 
+class KitchenItemBuilder:
+    """A KitchenItem being built, see Order.get_kitchen_items.
+
+    The attributes are the same as the ones of KitchenItem, but can be
+    modified while the rows of the queries are aggregated. The lists of
+    strings are sets, and meal_components contains MealComponentBuilder
+    objects.
+    """
+    __slots__ = KitchenItem._fields
+
+    def __init__(self, lastname, firstname):
+        self.lastname = lastname
+        self.firstname = firstname
+        self.routename = None
+        self.meal_qty = 0
+        self.meal_size = ''
+        self.incompatible_ingredients = set()
+        self.sides_clashes = set()
+        self.avoid_ingredients = set()
+        self.restricted_items = set()
+        self.preparation = set()
+        self.meal_components = {}
+
+    def freeze(self):
+        """Returns the KitchenItem named tuple."""
+        return KitchenItem(
+            lastname=self.lastname,
+            firstname=self.firstname,
+            routename=self.routename,
+            meal_qty=self.meal_qty,
+            meal_size=self.meal_size,
+            incompatible_ingredients=sorted(self.incompatible_ingredients),
+            sides_clashes=sorted(self.sides_clashes),
+            avoid_ingredients=sorted(self.avoid_ingredients),
+            restricted_items=sorted(self.restricted_items),
+            preparation=sorted(self.preparation),
+            meal_components={
+                component_group: component.freeze()
+                for component_group, component
+                in self.meal_components.items()})
+
+
+class MealComponentBuilder:
+    """A MealComponent being built, see KitchenItemBuilder."""
+    __slots__ = MealComponent._fields
+
+    def __init__(self, id, name, qty):
+        self.id = id
+        self.name = name
+        self.qty = qty
+
+    def freeze(self):
+        """Returns the MealComponent named tuple."""
+        return MealComponent(id=self.id, name=self.name, qty=self.qty)
+
+
 def check_for_new_client(kitchen_list, row):
-    """ Add KitchenItem entry when client is found the first time.
+    """ Add KitchenItemBuilder entry when client is found the first time.
 
     Modifies kitchen_list by adding an entry.
 
     Args:
         kitchen_list: A dictionary where the key is an Integer 'client id'
-            and the value is a KitchenItem named tuple.
-        row: An object having an attribute 'cid' that represents
-            an Integer 'client id'.
+            and the value is a KitchenItemBuilder object.
+        row: An object having attributes 'cid' that represents
+            an Integer 'client id', 'lastname' and 'firstname'.
     """
-    if not kitchen_list.get(row.cid):
+    if row.cid not in kitchen_list:
         # found new client
-        kitchen_list[row.cid] = KitchenItem(
+        kitchen_list[row.cid] = KitchenItemBuilder(
             lastname=row.lastname,
-            firstname=row.firstname,
-            routename=None,
-            meal_qty=0,
-            meal_size='',
-            incompatible_ingredients=[],
-            sides_clashes=[],
-            avoid_ingredients=[],
-            restricted_items=[],
-            preparation=[],
-            meal_components={})
+            firstname=row.firstname)
 
 # End Order.kitchen items helpers
 
@@ -1254,10 +1611,26 @@ class OrderStatusChange(models.Model):
                 _("Invalid order status update."),
                 code='status_from_incorrect'
             )
+        if (order_is_active(self.status_to) and
+                not order_is_active(self.order.status) and
+                self.order.has_other_active_order()):
+            raise ValidationError(
+                _("This client already has an order on this date."),
+                code='duplicate_order'
+            )
 
     def save(self, *a, **k):
         """ Process a scheduled change when saving."""
         self.full_clean()  # we defined clean method so we need to override
-        super(OrderStatusChange, self).save(*a, **k)
-        self.order.status = self.status_to
-        self.order.save()
+        try:
+            with transaction.atomic():
+                super(OrderStatusChange, self).save(*a, **k)
+                self.order.status = self.status_to
+                self.order.save()
+        except IntegrityError:
+            # Another active order was created since full_clean
+            self.order.status = self.status_from
+            raise ValidationError(
+                _("This client already has an order on this date."),
+                code='duplicate_order'
+            )
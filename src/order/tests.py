@@ -4,25 +4,33 @@ import random
 import urllib.parse
 import importlib
 import datetime
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from datetime import date
 
 from django.test import TestCase
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth.models import User
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.six import StringIO
 from django.utils.translation import ugettext as _
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
 from django.db.models import Q, Sum
 
+from delivery.models import KitchenSnapshot
 from member.models import (Client, Address, Member, Route, DAYS_OF_WEEK)
 from member.factories import RouteFactory, ClientFactory
 from meal.factories import ComponentFactory
 from order.models import Order, Order_item, MAIN_PRICE_DEFAULT, \
     OrderStatusChange, COMPONENT_GROUP_CHOICES_MAIN_DISH, \
-    ORDER_ITEM_TYPE_CHOICES_COMPONENT
+    ORDER_ITEM_TYPE_CHOICES_COMPONENT, KitchenItem, KitchenItemBuilder, \
+    MealComponent, MealComponentBuilder, scheduled_items, insert_ignore_sql
 from order.factories import OrderFactory
+from order.generation import shard_clients
+from sous_chef.tests import TestMigrations
 from sous_chef.tests import TestMixin as SousChefTestMixin
 
 
@@ -389,11 +397,32 @@ class OrderAutoCreateOnDefaultsTestCase(TestCase):
         order = OrderFactory(
             delivery_date=self.delivery_date,
             client=client,
+            status='O',
         )
         Order.objects.auto_create_orders(
             self.delivery_date, self.ongoing_clients)
         self.assertEqual(Order.objects.filter(client=client).count(), 1)
 
+    def test_auto_create_orders_cancelled_order(self):
+        """
+        A cancelled order does not prevent the creation of a new order.
+        """
+        client = self.ongoing_clients[0]
+        cancelled = OrderFactory(
+            delivery_date=self.delivery_date,
+            client=client,
+            status='C',
+        )
+        orders = Order.objects.auto_create_orders(
+            self.delivery_date, self.ongoing_clients)
+        self.assertEqual(len(orders), len(self.ongoing_clients))
+        self.assertNotIn(cancelled, orders)
+        self.assertEqual(Order.objects.get(
+            client=client, delivery_date=self.delivery_date,
+            is_active=True).status, 'O')
+        cancelled.refresh_from_db()
+        self.assertEqual(cancelled.status, 'C')
+
     def test_auto_create_orders_items(self):
         """
         Orders must be created with the meals defaults.
@@ -417,6 +446,155 @@ class OrderAutoCreateOnDefaultsTestCase(TestCase):
         self.assertEqual(fruit_salad_item.total_quantity, 1)
         self.assertEqual(items.filter(component_group='compote').count(), 0)
 
+    def test_bulk_create_orders_same_as_create_order(self):
+        """
+        The orders created in bulk must have the items and prices of
+        create_order, whatever the rate of the client.
+        """
+        client = self.ongoing_clients[0]
+        client.rate_type = 'low income'
+        client.save()
+        delivery_dates = [self.delivery_date, date(2016, 7, 22)]
+        orders = Order.objects.bulk_create_orders(
+            delivery_dates, self.ongoing_clients, batch_size=3)
+        self.assertEqual(len(orders), 2 * len(self.ongoing_clients))
+        self.assertEqual(len(set(o.pk for o in orders)), len(orders))
+
+        def item_values(order):
+            return sorted(order.orders.values_list(
+                'component_group', 'size', 'total_quantity', 'price',
+                'billable_flag', 'order_item_type'))
+
+        for order in orders:
+            reference = Order.objects.create_order(
+                date(2016, 7, 29), order.client,
+                scheduled_items(dict(order.client.meals_schedule)['friday']),
+                Order.objects.get_client_prices(order.client))
+            self.assertEqual(item_values(order), item_values(reference))
+            reference.delete()
+        self.assertEqual(orders[0].price, 9.75)
+
+    def test_one_active_order_per_date(self):
+        """
+        A client can not have two active orders on the same date, but
+        can have cancelled ones.
+        """
+        client = self.ongoing_clients[0]
+        order = Order.objects.create(client=client,
+                                     delivery_date=self.delivery_date)
+        with self.assertRaises(ValidationError):
+            Order(client=client, delivery_date=self.delivery_date).clean()
+        with transaction.atomic(), self.assertRaises(IntegrityError):
+            Order.objects.create(client=client,
+                                 delivery_date=self.delivery_date)
+        order.cancel()
+        self.assertIsNone(order.is_active)
+        Order.objects.create(client=client, delivery_date=self.delivery_date,
+                             status='C')
+        Order.objects.create(client=client, delivery_date=self.delivery_date)
+        self.assertEqual(Order.objects.filter(client=client).count(), 3)
+
+    def test_insert_ignore(self):
+        """
+        The orders of the clients having an active order are skipped.
+        """
+        OrderFactory(client=self.ongoing_clients[0],
+                     delivery_date=self.delivery_date, status='O')
+        OrderFactory(client=self.ongoing_clients[1],
+                     delivery_date=self.delivery_date, status='C')
+        Order.objects.insert_ignore([
+            Order(client=c, delivery_date=self.delivery_date,
+                  insert_batch='batch')
+            for c in self.ongoing_clients])
+        self.assertEqual(
+            set(Order.objects.filter(insert_batch='batch').values_list(
+                'client_id', flat=True)),
+            set(c.pk for c in self.ongoing_clients[1:]))
+        self.assertEqual(
+            Order.objects.filter(delivery_date=self.delivery_date,
+                                 is_active=True).count(), 4)
+
+    def test_insert_ignore_other_database(self):
+        """
+        On the databases without INSERT ... IGNORE, the orders are
+        inserted one by one, and the other errors are raised.
+        """
+        OrderFactory(client=self.ongoing_clients[0],
+                     delivery_date=self.delivery_date, status='O')
+        with patch.object(connections['default'], 'vendor', 'oracle'):
+            Order.objects.insert_ignore([
+                Order(client=c, delivery_date=self.delivery_date,
+                      insert_batch='batch')
+                for c in self.ongoing_clients])
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Order.objects.insert_ignore([
+                    Order(client_id=None, delivery_date=self.delivery_date)])
+        self.assertEqual(
+            Order.objects.filter(insert_batch='batch').count(), 3)
+        with self.assertRaises(NotImplementedError):
+            insert_ignore_sql(Mock(vendor='oracle'), 'INSERT INTO')
+
+    def test_insert_ignore_sql_mysql(self):
+        """
+        On MySQL, only the duplicate keys are ignored.
+        """
+        sql = insert_ignore_sql(
+            Mock(vendor='mysql', ops=connection.ops),
+            'INSERT INTO "order_order" ("status") VALUES (%s)')
+        self.assertNotIn('IGNORE', sql)
+        self.assertTrue(sql.endswith(
+            ' ON DUPLICATE KEY UPDATE "id" = "id"'))
+
+    def test_insert_orders_concurrent_empty_order(self):
+        """
+        An order without items created by another process while a batch
+        is inserted must not be taken for an order of the batch.
+        """
+        client = self.ongoing_clients[0]
+        plan = Order.objects.plan_orders(
+            [self.delivery_date], self.ongoing_clients, {})
+        insert_ignore = Order.objects.insert_ignore
+        other = []
+
+        def concurrent_insert_ignore(orders):
+            other.append(Order.objects.create(
+                client=client, delivery_date=self.delivery_date))
+            return insert_ignore(orders)
+
+        with patch.object(Order.objects, 'insert_ignore',
+                          side_effect=concurrent_insert_ignore):
+            inserted = Order.objects.insert_orders(plan)
+        self.assertEqual(inserted, len(self.ongoing_clients) - 1)
+        self.assertEqual(other[0].orders.count(), 0)
+        self.assertIn(other[0], plan.orders)
+        self.assertEqual(len(plan.orders), len(self.ongoing_clients))
+        for order in plan.new_orders:
+            self.assertEqual(order.orders.count(), 4)
+
+    def test_bulk_create_orders_queries(self):
+        """
+        The number of queries must not depend on the number of clients.
+        """
+        clients = Client.objects.filter(
+            pk__in=[c.pk for c in self.ongoing_clients])
+        # clients, their options, existing orders, and in the transaction
+        # of the batch: orders, primary keys, items, kitchen snapshot
+        with self.assertNumQueries(10):
+            orders = Order.objects.bulk_create_orders(
+                [self.delivery_date], clients)
+        self.assertEqual(len(orders), len(self.ongoing_clients))
+
+    def test_bulk_create_orders_marks_snapshots_dirty(self):
+        """
+        The kitchen snapshot of the date must be updated, although
+        bulk_create sends no signal.
+        """
+        with patch.object(KitchenSnapshot.objects, 'mark_dirty') as mark:
+            Order.objects.auto_create_orders(
+                self.delivery_date, self.ongoing_clients)
+        mark.assert_called_once_with(
+            [c.pk for c in self.ongoing_clients], self.delivery_date)
+
 
 class OrderManualCreateTestCase(SousChefTestMixin, TestCase):
 
@@ -1185,7 +1363,7 @@ class OrderFormTestCase(TestCase):
             'orders-MIN_NUM_FORMS': 0,
             'orders-MAX_NUM_FORMS': 100,
             'client': client.id,
-            'delivery_date': '2016-12-22',
+            'delivery_date': '2016-12-23',
             'status': 'O',
             'orders-0-component': component.id,
             'orders-0-component_group': 'main_dish',
@@ -1237,6 +1415,33 @@ class OrderStatusChangeTestCase(OrderItemTestCase):
             )
             osc.save()
 
+    def test_invalid_creation_duplicate_active_order(self):
+        order = self.order
+        order.cancel()
+        Order.objects.create(client=order.client,
+                             delivery_date=order.delivery_date)
+        with self.assertRaises(ValidationError) as context:
+            OrderStatusChange(
+                order=order,
+                status_from='C',
+                status_to='O'
+            ).save()
+        self.assertEqual(context.exception.error_dict['__all__'][0].code,
+                         'duplicate_order')
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'C')
+
+    def test_update_orders_status_duplicate_active_order(self):
+        order = self.order
+        order.cancel()
+        Order.objects.create(client=order.client,
+                             delivery_date=order.delivery_date)
+        with self.assertRaises(ValidationError):
+            Order.objects.update_orders_status(
+                Order.objects.filter(pk=order.pk), 'O')
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'C')
+
     def test_reason_field_bilingual(self):
         order = self.order
         reason = "ôn pàrlé «frânçaîs» èù£¤¢¼½¾³²±"
@@ -1298,6 +1503,25 @@ class OrderStatusChangeViewTestCase(OrderItemTestCase):
         self.order.refresh_from_db()
         self.assertEqual(self.order.status, 'B')
 
+    def test_update_status_duplicate_active_order(self):
+        self.order.cancel()
+        Order.objects.create(client=self.order.client,
+                             delivery_date=self.order.delivery_date)
+        data = {
+            'order': self.order.pk,
+            'status_to': 'O',
+            'status_from': 'C'
+        }
+        response = self.client.post(
+            reverse('order:update_status', kwargs={'pk': self.order.id}),
+            data,
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        self.assertFormError(response, 'form', None,
+                             'This client already has an order on this date.')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'C')
+
     def test_redirects_users_who_do_not_have_edit_permission(self):
         # Setup
         User.objects.create_user(
@@ -1621,6 +1845,22 @@ class RedirectAnonymousUserTestCase(SousChefTestMixin, TestCase):
         check(reverse('order:delete', kwargs={'pk': 1}))
 
 
+class SerialExecutor(object):
+    """Run the shards in the test process, which has the test database."""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def map(self, function, *iterables):
+        return map(function, *iterables)
+
+
 class CommandsTestCase(TestCase):
     "Test custom manage.py commands"
 
@@ -1723,6 +1963,83 @@ class CommandsTestCase(TestCase):
             len(self.ongoing_clients) - 4
         )
 
+    def test_generateorders_window_in_batches(self):
+        """
+        The orders of several days are planned at once and inserted in
+        batches, with the items of the weekday of each order.
+        """
+        args = ["2016-11-21"]  # Monday
+        opts = {'days': 7, 'batch_size': 3}
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            call_command('generateorders', *args, **opts)
+        output = out.getvalue()
+        self.assertIn("10 clients, 0 existing orders, 20 orders created "
+                      "in 7 days from 2016-11-21.", output)
+        self.assertIn("3/20 orders inserted.", output)
+        self.assertIn("20/20 orders inserted.", output)
+        self.assertIn("10 orders created on 2016-11-21: to be delivered on "
+                      "2016-11-25.", output)
+        self.assertIn("Timings: load", output)
+        self.assertEqual(
+            set(Order_item.objects.filter(
+                component_group=COMPONENT_GROUP_CHOICES_MAIN_DISH
+            ).values_list('order__delivery_date', 'size')),
+            {(date(2016, 11, 21), 'L'), (date(2016, 11, 25), 'R')})
+        self.assertEqual(LogEntry.objects.count(), 7)
+
+    def test_generateorders_workers(self):
+        """
+        The clients are split by route between the processes, and the
+        shards are merged into one summary.
+        """
+        routes = RouteFactory.create_batch(2)
+        for i, c in enumerate(self.ongoing_clients):
+            c.route = routes[i % 2]
+            c.save()
+        args = ["2016-11-21"]  # Monday
+        opts = {'days': 7, 'workers': 2}
+        with patch('order.generation.ProcessPoolExecutor', SerialExecutor), \
+                patch('sys.stdout', new_callable=StringIO) as out:
+            call_command('generateorders', *args, **opts)
+        output = out.getvalue()
+        self.assertIn("Shard 1: 10/10 orders inserted.", output)
+        self.assertIn("Shard 2: 10/10 orders inserted.", output)
+        self.assertIn("10 clients, 0 existing orders, 20 orders created "
+                      "in 7 days from 2016-11-21.", output)
+        self.assertEqual(Order.objects.count(), 20)
+        self.assertEqual(LogEntry.objects.count(), 7)
+
+    def test_shard_clients(self):
+        """
+        The clients of a route are in the same shard.
+        """
+        clients = [(1, 'a'), (2, 'b'), (3, 'a'), (4, None), (5, 'a'),
+                   (6, 'c'), (7, 'b')]
+        self.assertEqual(shard_clients(clients, 2),
+                         [[1, 3, 5, 6], [2, 7, 4]])
+        self.assertEqual(shard_clients(clients, 10),
+                         [[1, 3, 5], [2, 7], [4], [6]])
+        self.assertEqual(shard_clients([], 2), [])
+
+    def test_insert_orders_duplicate(self):
+        """
+        An order created by another process after the plan was made is
+        skipped, and replaces the planned order.
+        """
+        delivery_dates = [date(2016, 11, 25)]
+        plan = Order.objects.plan_orders(
+            delivery_dates, self.ongoing_clients,
+            Order.objects.existing_orders(
+                delivery_dates, self.ongoing_clients))
+        other = OrderFactory(client=self.ongoing_clients[3],
+                             delivery_date=delivery_dates[0], status='O')
+        self.assertEqual(Order.objects.insert_orders(plan), 9)
+        self.assertEqual(len(plan.new_orders), 9)
+        self.assertIn(other, plan.orders)
+        self.assertEqual(len(plan.orders), 10)
+        self.assertEqual(Order.objects.count(), 10)
+        self.assertEqual(other.orders.count(), 1)
+
 
 class OrderListViewTestCase(SousChefTestMixin, TestCase):
     def test_redirects_users_who_do_not_have_read_permission(self):
@@ -1770,3 +2087,166 @@ class OrderDetailViewTestCase(SousChefTestMixin, OrderTestCase):
         response = self.client.get(url)
         # Check
         self.assertEqual(response.status_code, 200)
+
+
+class OrderGetKitchenItemsTestCase(TestCase):
+
+    fixtures = ['sample_data']
+
+    def test_two_queries_and_sorted_requirements(self):
+        delivery_date = date(2016, 10, 13)
+        with self.assertNumQueries(2):
+            kitchen_list = Order.get_kitchen_items(delivery_date)
+        self.assertTrue(kitchen_list)
+        for item in kitchen_list.values():
+            for requirements in (item.incompatible_ingredients,
+                                 item.sides_clashes,
+                                 item.avoid_ingredients,
+                                 item.restricted_items,
+                                 item.preparation):
+                self.assertIsInstance(requirements, list)
+                self.assertEqual(requirements, sorted(set(requirements)))
+        self.assertTrue(any(item.preparation
+                            for item in kitchen_list.values()))
+        self.assertTrue(any(item.meal_qty for item in kitchen_list.values()))
+        for item in kitchen_list.values():
+            self.assertIsInstance(item, KitchenItem)
+            for meal_component in item.meal_components.values():
+                self.assertIsInstance(meal_component, MealComponent)
+
+    def test_builder_freeze(self):
+        builder = KitchenItemBuilder(lastname='Doe', firstname='Jane')
+        builder.meal_qty += 2
+        builder.preparation.update(['Puree', 'Cut up meat', 'Puree'])
+        builder.meal_components[COMPONENT_GROUP_CHOICES_MAIN_DISH] = \
+            MealComponentBuilder(id=1, name='Ratatouille', qty=2)
+        builder.meal_components[COMPONENT_GROUP_CHOICES_MAIN_DISH].qty += 1
+        item = builder.freeze()
+        self.assertEqual(item.meal_qty, 2)
+        self.assertEqual(item.preparation, ['Cut up meat', 'Puree'])
+        self.assertEqual(item.avoid_ingredients, [])
+        self.assertEqual(
+            item.meal_components[COMPONENT_GROUP_CHOICES_MAIN_DISH],
+            MealComponent(id=1, name='Ratatouille', qty=3))
+        with self.assertRaises(AttributeError):
+            builder.unknown = True
+
+    def test_range_matches_days(self):
+        start_date = date(2016, 8, 10)
+        end_date = date(2016, 10, 14)
+        with self.assertNumQueries(2):
+            kitchen_lists = Order.get_kitchen_items_range(
+                start_date, end_date)
+        self.assertEqual(list(kitchen_lists), sorted(kitchen_lists))
+        self.assertIn(date(2016, 10, 13), kitchen_lists)
+        for delivery_date, kitchen_list in kitchen_lists.items():
+            self.assertTrue(start_date <= delivery_date <= end_date)
+            self.assertEqual(kitchen_list,
+                             Order.get_kitchen_items(delivery_date))
+        self.assertEqual(
+            Order.get_kitchen_items_range(date(2016, 10, 13),
+                                          date(2016, 10, 13)),
+            {date(2016, 10, 13): Order.get_kitchen_items(date(2016, 10, 13))})
+
+
+class MigrateToLatestMixin(object):
+    """
+    Apply all the migrations before and after a migration test, so that
+    only the migrations of the tested app are run again, and the
+    following tests have the latest schema.
+    """
+
+    def migrate_to_latest(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def setUp(self):
+        self.migrate_to_latest()
+        super(MigrateToLatestMixin, self).setUp()
+
+    def tearDown(self):
+        self.migrate_to_latest()
+        super(MigrateToLatestMixin, self).tearDown()
+
+
+class TestMigrationApply0016(MigrateToLatestMixin, TestMigrations):
+    migrate_from = '0015_auto_20170410_1029'
+    migrate_to = '0016_order_is_active'
+
+    def setUpBeforeMigration(self, apps):
+        # The member app is not migrated back.
+        client = ClientFactory(route=RouteFactory())
+        Order = apps.get_model('order', 'Order')
+        self.past_date = date(2016, 11, 21)
+        self.coming_date = date.today() + datetime.timedelta(days=7)
+        self.billed = Order.objects.create(
+            client_id=client.pk, delivery_date=self.past_date, status='B')
+        self.duplicate_of_billed = Order.objects.create(
+            client_id=client.pk, delivery_date=self.past_date, status='O')
+        self.duplicate = Order.objects.create(
+            client_id=client.pk, delivery_date=self.coming_date, status='O')
+        self.ordered = Order.objects.create(
+            client_id=client.pk, delivery_date=self.coming_date, status='O')
+        self.cancelled = Order.objects.create(
+            client_id=client.pk, delivery_date=self.coming_date, status='C')
+        KitchenSnapshot.objects.create(date=self.past_date)
+        KitchenSnapshot.objects.create(date=self.coming_date)
+
+    def assertOrder(self, order, status, is_active):
+        Order = self.apps.get_model('order', 'Order')
+        self.assertEqual(
+            Order.objects.filter(pk=order.pk).values_list(
+                'status', 'is_active').get(),
+            (status, is_active))
+
+    def test_ordered_duplicates_cancelled(self):
+        self.assertOrder(self.billed, 'B', True)
+        self.assertOrder(self.duplicate_of_billed, 'C', None)
+        self.assertOrder(self.duplicate, 'C', None)
+        self.assertOrder(self.ordered, 'O', True)
+        self.assertOrder(self.cancelled, 'C', None)
+        OrderStatusChange = self.apps.get_model('order', 'OrderStatusChange')
+        self.assertEqual(
+            set(OrderStatusChange.objects.values_list(
+                'order_id', 'status_from', 'status_to')),
+            {(self.duplicate_of_billed.pk, 'O', 'C'),
+             (self.duplicate.pk, 'O', 'C')})
+        # Only the snapshots of the coming dates are computed again.
+        self.assertEqual(
+            list(KitchenSnapshot.objects.values_list('date', flat=True)),
+            [self.past_date])
+
+
+class TestMigrationApply0016Conflict(MigrateToLatestMixin, TestMigrations):
+    migrate_from = '0015_auto_20170410_1029'
+    migrate_to = '0016_order_is_active'
+
+    def setUp(self):
+        with self.assertRaises(RuntimeError) as error:
+            super(TestMigrationApply0016Conflict, self).setUp()
+        self.assertIn('orders {}, {}'.format(*self.conflict),
+                      str(error.exception))
+
+    def setUpBeforeMigration(self, apps):
+        # The member app is not migrated back.
+        client = ClientFactory(route=RouteFactory())
+        Order = apps.get_model('order', 'Order')
+        self.conflict = [
+            Order.objects.create(client_id=client.pk, status=status,
+                                 delivery_date=date(2016, 11, 21)).pk
+            for status in ('B', 'D')]
+        self.old_apps = apps
+
+    def tearDown(self):
+        # The conflict is resolved by hand.
+        Order = self.old_apps.get_model('order', 'Order')
+        Order.objects.filter(pk=self.conflict[1]).update(status='C')
+        super(TestMigrationApply0016Conflict, self).tearDown()
+
+    def test_delivered_duplicates_not_changed(self):
+        Order = self.old_apps.get_model('order', 'Order')
+        self.assertEqual(
+            list(Order.objects.order_by('pk').values_list(
+                'status', flat=True)),
+            ['B', 'D'])
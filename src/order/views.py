@@ -12,6 +12,7 @@ from django.contrib import messages
 from django.urls import reverse_lazy, reverse
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
+from django.core.exceptions import ValidationError
 from extra_views import CreateWithInlinesView, UpdateWithInlinesView
 
 from datetime import datetime
@@ -161,7 +162,7 @@ class CreateOrdersBatch(
         if self.request.method == "POST" and \
            self.request.POST.get('client'):
             c = Client.objects.get(pk=self.request.POST['client'])
-            meals_default_dict = dict(c.meals_default)
+            meals_default_dict = dict(c.schedule.meals_default)
             context['client'] = c
 
             # The dates where an order already exists.
@@ -338,7 +339,12 @@ class UpdateOrderStatus(
         }
 
     def form_valid(self, form):
-        response = super(UpdateOrderStatus, self).form_valid(form)
+        try:
+            response = super(UpdateOrderStatus, self).form_valid(form)
+        except ValidationError as error:
+            # Another active order was created at the same time
+            form.add_error(None, error)
+            return self.form_invalid(form)
         messages.add_message(
             self.request, messages.SUCCESS,
             _("The status has been changed")
@@ -57,7 +57,8 @@ class HomeView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
             )).only(
                 'route',
                 'meal_default_week',
-                'delivery_type'
+                'delivery_type',
+                'updated_at'
             )
         )).order_by('name').only('name')
 
@@ -66,8 +67,8 @@ class HomeView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
             defaults = collections.defaultdict(int)
             schedules = collections.defaultdict(int)
             for client in route.selected_clients:
-                meals_schedule = dict(client.meals_schedule)
-                meals_default = dict(client.meals_default)
+                meals_schedule = dict(client.schedule.meals_schedule)
+                meals_default = dict(client.schedule.meals_default)
 
                 # For each day, if there's a schedule, count schedule.
                 # Otherwise, count default.
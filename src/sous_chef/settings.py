@@ -60,7 +60,7 @@ INSTALLED_APPS = [
     'sous_chef',
     'billing',
     'datamigration',
-    'delivery',
+    'delivery.apps.DeliveryConfig',
     'meal',
     'member.apps.MemberConfig',
     'order',
@@ -199,6 +199,11 @@ STATICFILES_DIRS = (
 )
 STATIC_URL = '/static/'
 
+# Kitchen count PDF files are generated, and the routes are optimised, by
+# a thread of the web process. Set to False when they are run by
+# "manage.py reportworker", which optimises the routes in parallel.
+REPORT_WORKER_THREAD = True
+
 # Avatar files
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
@@ -207,3 +212,6 @@ AVATAR_PROVIDERS = (
     'avatar.providers.GravatarAvatarProvider',
     'avatar.providers.DefaultAvatarProvider',
 )
+
+# Generated PDF reports, see delivery/artifacts.py
+REPORT_ARTIFACTS_DIR = os.path.join(MEDIA_ROOT, 'reports')
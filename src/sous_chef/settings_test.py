@@ -1,3 +1,5 @@
+import tempfile
+
 from .settings import *
 
 
@@ -12,3 +14,5 @@ DATABASES = {
         'NAME': ':memory:',
     }
 }
+
+REPORT_ARTIFACTS_DIR = os.path.join(tempfile.gettempdir(), 'sous_chef_reports')